@@ -88,6 +88,26 @@ CHANNEL_LAYERS = {
         "ROUTING": "cardgame_channels_app.routing.channel_routing",
     },
 }
+CHANNEL_SESSION_ENGINE = 'django.contrib.sessions.backends.cache'  # Read on every frame, so kept in the cache rather than the database
+
+# Game
+CARD_CATALOG_TIMEOUT = 300  # Seconds a worker keeps its in-memory card catalog before reloading it
+FRAME_JSON_ENCODER = 'json'  # 'orjson' or 'ujson' write JSON frames faster when installed, json is used if they aren't
+GAME_AFFINITY = False  # Forward each game's frames to the one rungameworker that owns it, needs a cache shared between workers
+GAME_AFFINITY_REFRESH = 1  # Seconds a process trusts its list of live game workers
+GAME_AFFINITY_WORKER_TIMEOUT = 15  # Seconds a game worker stays in the list, and keeps its games' leases, after its last heartbeat; it writes its games out every third of it
+GAME_CODE_POOL_BATCH = 1000  # Free game codes added when the pool runs dry, keep it topped up with manage.py game_code_pool --keep
+GAME_INDEX_TIMEOUT = 300  # Seconds the cache answers lobby validation for a game before rechecking the database
+GAME_INDEX_MISSING_TIMEOUT = 10  # Seconds a code with no game is remembered, kept short in case another worker creates it
+GAME_STATE_STORE = None  # Play turns against e.g. {'BACKEND': 'cardgame_channels_app.state_store.RedisStateStore', 'OPTIONS': {'host': 'redis'}}, and run flush_game_writes
+GROUP_SEND_COALESCE_WINDOW = 0  # Milliseconds a game's broadcasts are held to go out as one batch, with full-state card_was_submitted merged, 0 for off
+PRESENCE_DISCONNECT_GRACE = 120  # Seconds after a player's WebSocket closes before evict_absent_players boots them, so a reload or network blip isn't fatal
+PRESENCE_HEARTBEAT_INTERVAL = 30  # Seconds between writes of a connected player's last_seen, and between client heartbeats
+PRESENCE_TIMEOUT = 300  # Seconds since a player's last frame before evict_absent_players boots them, in case their disconnect was lost
+SPECTATOR_SNAPSHOT_INTERVAL = 1  # Seconds between the public snapshots sent to a game's spectators, however often it changes
+STREAM_METRICS = False  # Record per-stream message counts, handler and query time and bytes sent, served at /metrics
+STREAM_METRICS_PUBLISH_INTERVAL = 10  # Seconds between a worker copying its metrics to the cache
+STREAM_METRICS_TIMEOUT = 3600  # Seconds the cache keeps a worker's metrics after it stops publishing
 
 # Password validation
 # https://docs.djangoproject.com/en/1.11/ref/settings/#auth-password-validators
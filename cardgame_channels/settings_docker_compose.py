@@ -27,9 +27,16 @@ DATABASES = {
     }
 }
 
+CACHES = {
+    "default": {
+        "BACKEND": "django_redis.cache.RedisCache",
+        "LOCATION": "redis://redis:6379/1",  # Shared by every worker, so the game index, spectators, metrics and game affinity agree
+    },
+}
+
 CHANNEL_LAYERS = {
     "default": {
-        "BACKEND": "asgi_redis.RedisChannelLayer",
+        "BACKEND": "cardgame_channels_app.channel_layers.BatchingRedisChannelLayer",
         "CONFIG": {
             "hosts": [("redis", 6379)],
         },
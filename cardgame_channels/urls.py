@@ -3,9 +3,10 @@
 from django.conf.urls import url
 from django.contrib import admin
 
-from cardgame_channels_app.views import HomePage
+from cardgame_channels_app.views import HomePage, StreamMetrics
 
 urlpatterns = [
     url(r'^$', HomePage.as_view(), name="home"),
     url(r'^admin/', admin.site.urls),
+    url(r'^metrics$', StreamMetrics.as_view(), name="metrics"),
 ]
@@ -1 +1,2 @@
 # ## Django App ###
+default_app_config = 'cardgame_channels_app.apps.CardgameChannelsAppConfig'
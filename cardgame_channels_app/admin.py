@@ -3,7 +3,7 @@
 # pylint: disable=C0111,E0602,F0401,R0904,E1002
 
 from django.contrib import admin
-from cardgame_channels_app.models import Card, CardGamePlayer, Game, Player
+from cardgame_channels_app.models import Card, CardGamePlayer, Deck, DeckCard, Game, Player, Round
 
 
 class CardGamePlayerInline(admin.StackedInline):
@@ -19,6 +19,19 @@ class CardAdmin(admin.ModelAdmin):
     inlines = [CardGamePlayerInline, ]
 
 
+class DeckCardInline(admin.TabularInline):
+    """Inline for DeckCard"""
+    model = DeckCard
+    raw_id_fields = ['card']
+
+
+@admin.register(Deck)
+class DeckAdmin(admin.ModelAdmin):
+    """Admin Setup for Deck"""
+    date_hierarchy = 'date_created'
+    inlines = [DeckCardInline, ]
+
+
 @admin.register(Player)
 class PlayerAdmin(admin.ModelAdmin):
     """Admin Setup for Player"""
@@ -36,3 +49,11 @@ class GameAdmin(admin.ModelAdmin):
     """Admin Setup for Game"""
     date_hierarchy = 'date_created'
     inlines = [CardGamePlayerInline, PlayerInline]
+
+
+@admin.register(Round)
+class RoundAdmin(admin.ModelAdmin):
+    """Admin Setup for Round"""
+    date_hierarchy = 'date_created'
+    list_display = ['game', 'number', 'judge', 'winner', 'green_card', 'picked_card']
+    raw_id_fields = ['game', 'judge', 'winner', 'green_card', 'picked_card']
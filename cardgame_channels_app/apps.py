@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class CardgameChannelsAppConfig(AppConfig):
     name = 'cardgame_channels_app'
+
+    def ready(self):
+        """Registers the system checks and the signal receivers"""
+        from . import card_packs, checks  # pylint: disable=W0611
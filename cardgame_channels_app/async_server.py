@@ -0,0 +1,183 @@
+"""Serves the game streams from an asyncio event loop, running the consumers on a bounded thread pool in the same process
+
+A second serving mode next to daphne and runworker, started with manage.py runasyncserver. Each frame goes straight
+to GameDemultiplexer instead of crossing the channel layer to a worker and back, and replies to the sender go
+straight back to its socket. Group broadcasts still go through the channel layer, so players connected to either
+mode see each other's moves. Only WebSockets are served, daphne keeps serving HTTP.
+"""
+import asyncio
+import functools
+import itertools
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+
+import websockets
+from channels import DEFAULT_CHANNEL_LAYER, channel_layers
+from channels.asgi import ChannelLayerWrapper
+from channels.exceptions import DenyConnection
+from channels.message import Message
+from channels.signals import consumer_finished, consumer_started
+
+LOGGER = logging.getLogger("cardgame_channels_app")
+
+
+class DirectReplyLayer(ChannelLayerWrapper):
+    """Channel layer that hands messages for the server's own connections straight to them"""
+
+    def __init__(self, layer, server):
+        super(DirectReplyLayer, self).__init__(layer.channel_layer, layer.alias, layer.routing)
+        self.server = server
+
+    def send(self, channel, message):
+        if not self.server.deliver(channel, message):
+            self.channel_layer.send(channel, message)
+
+
+class GameServer(object):
+    """Accepts WebSockets and runs their messages through the routed consumers, threads at a time"""
+
+    def __init__(self, threads=8, alias=DEFAULT_CHANNEL_LAYER, connect_timeout=5):
+        self.channel_layer = DirectReplyLayer(channel_layers[alias], self)
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.connect_timeout = connect_timeout
+        self.reply_prefix = 'asyncgame.{}!'.format(uuid.uuid4().hex)  # Group messages for every connection arrive on this one process-local channel
+        self.connection_numbers = itertools.count(1)
+        self.connections = {}  # reply channel: GameServerProtocol
+        self.loop = None
+        self.running = False
+
+    async def serve(self, host, port):
+        """Starts listening, and reading the connections' group messages from the channel layer"""
+        self.loop = asyncio.get_event_loop()
+        self.running = True
+        threading.Thread(target=self.read_group_messages, daemon=True).start()
+        return await websockets.serve(self.handle, host, port, create_protocol=functools.partial(GameServerProtocol, game_server=self))
+
+    def stop(self):
+        """Stops reading group messages and lets the thread pool finish"""
+        self.running = False
+        self.executor.shutdown(wait=True)
+
+    async def handle(self, connection, path):
+        """Passes an accepted connection's frames to the consumers until it closes, then disconnects it"""
+        sender = asyncio.ensure_future(connection.send_frames())
+        try:
+            async for frame in connection:
+                connection.order += 1
+                content = {'reply_channel': connection.reply_channel, 'path': connection.request_path, 'order': connection.order}
+                content['bytes' if isinstance(frame, bytes) else 'text'] = frame
+                asyncio.ensure_future(self.dispatch(connection, 'websocket.receive', content))
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            await self.dispatch(connection, 'websocket.disconnect', {'reply_channel': connection.reply_channel, 'path': connection.request_path, 'code': connection.close_code or 1006, 'order': connection.order + 1})
+            self.connections.pop(connection.reply_channel, None)
+            sender.cancel()
+
+    def deliver(self, channel, message):
+        """Hands a message to the connection it is for, from any thread, returning False if it isn't one of ours"""
+        connection = self.connections.get(channel)
+        if connection is None:
+            return False
+        self.loop.call_soon_threadsafe(connection.deliver, message)
+        return True
+
+    def read_group_messages(self):
+        """Passes the messages that reach this server through the channel layer to their connections"""
+        while self.running:
+            channel, message = self.channel_layer.receive_many([self.reply_prefix], block=True)
+            if channel is None:
+                time.sleep(0.001)  # The in-memory layer never blocks
+                continue
+            self.deliver(channel, message)  # Dropped if the connection has gone
+
+    async def dispatch(self, connection, channel, content):
+        """Runs the consumer for a connection's message on the thread pool, after its earlier messages"""
+        async with connection.lock:
+            await self.loop.run_in_executor(self.executor, self.consume, channel, content)
+
+    def consume(self, channel, content):
+        """Runs the consumer routed for a message, as runworker would"""
+        message = Message(content, channel, self.channel_layer)
+        match = self.channel_layer.router.match(message)
+        if match is None:
+            LOGGER.error('Could not find a consumer for %s on %s', channel, content.get('path'))
+            if channel == 'websocket.connect':
+                message.reply_channel.send({'accept': False})
+            return
+        consumer, kwargs = match
+        try:
+            consumer_started.send(sender=self.__class__, environ={})
+            consumer(message, **kwargs)
+        except DenyConnection:
+            message.reply_channel.send({'close': True})
+        except Exception:  # pylint: disable=W0703
+            LOGGER.exception('Error processing %s with consumer %s', channel, consumer)
+        finally:
+            consumer_finished.send(sender=self.__class__)  # Sends what the consumer queued and closes old DB connections
+
+
+class GameServerProtocol(websockets.WebSocketServerProtocol):
+    """One WebSocket, whose handshake waits for the consumers to accept it"""
+
+    def __init__(self, *args, game_server, **kwargs):
+        super(GameServerProtocol, self).__init__(*args, **kwargs)
+        self.game_server = game_server
+        self.lock = asyncio.Lock()
+        self.accepted = None
+        self.outbox = asyncio.Queue()  # Messages from the consumers, sent once the handshake is done
+        self.reply_channel = None
+        self.request_path = None
+        self.order = 0
+
+    async def process_request(self, path, request_headers):
+        """Sends websocket.connect to the consumers, and refuses the handshake unless they accept in time"""
+        server = self.game_server
+        self.request_path, _, query_string = path.partition('?')
+        self.reply_channel = '{}{}'.format(server.reply_prefix, next(server.connection_numbers))
+        self.accepted = asyncio.get_event_loop().create_future()
+        server.connections[self.reply_channel] = self
+        asyncio.ensure_future(server.dispatch(self, 'websocket.connect', {
+            'reply_channel': self.reply_channel,
+            'path': self.request_path,
+            'query_string': query_string,
+            'headers': [[name.lower().encode('latin1'), value.encode('latin1')] for name, value in request_headers.raw_items()],
+            'client': list(self.remote_address[:2]) if self.remote_address else None,
+            'order': 0,
+        }))
+        try:
+            accepted = await asyncio.wait_for(asyncio.shield(self.accepted), server.connect_timeout)
+        except asyncio.TimeoutError:
+            accepted = False
+        if not accepted:
+            server.connections.pop(self.reply_channel, None)
+            return HTTPStatus.FORBIDDEN, [], b''
+        return None
+
+    def deliver(self, message):
+        """Queues a message from the consumers to send down the socket, or settles the handshake with it"""
+        if not self.accepted.done():
+            if message.get('accept') is False or message.get('close'):
+                self.accepted.set_result(False)
+                return
+            if message.get('accept'):
+                self.accepted.set_result(True)
+        self.outbox.put_nowait(message)
+
+    async def send_frames(self):
+        """Sends the text, bytes and close of each queued message"""
+        while True:
+            message = await self.outbox.get()
+            try:
+                if message.get('text') is not None:
+                    await self.send(message['text'])
+                if message.get('bytes') is not None:
+                    await self.send(message['bytes'])
+                if message.get('close'):
+                    await self.close(code=1000 if message['close'] is True else message['close'])
+            except websockets.ConnectionClosed:
+                return
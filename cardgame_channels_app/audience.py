@@ -0,0 +1,111 @@
+"""Throttled public snapshots of games for spectators, who watch from an audience group instead of joining
+
+A spectator's connection joins the game's audience group. Each move asks for a snapshot, and this process sends at
+most one per game every SPECTATOR_SNAPSHOT_INTERVAL seconds, carrying the state at that moment, to the whole
+audience as one group send. Snapshots are deduplicated by state version through the cache, so a version two
+processes both see is sent once, and a game nobody watches costs one cache lookup per move.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
+
+from .channel_layers import GroupBatch
+from .frame_encodings import encode_everywhere, encoded_group_name, get_group_encodings
+from .game_logic import GameState
+
+LOGGER = logging.getLogger("cardgame_channels_app")
+
+_THROTTLES = {}
+_LOCK = threading.Lock()
+
+
+class SnapshotThrottle(object):
+    """Sends each game's snapshot interval seconds after the first move that asked for it"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.due = OrderedDict()  # game_code: when its snapshot is sent, in that order
+        self.condition = threading.Condition()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def request(self, game_code):
+        """Asks for a snapshot of the game, sent with any already waiting"""
+        with self.condition:
+            if game_code not in self.due:
+                self.due[game_code] = time.monotonic() + self.interval
+                self.condition.notify()
+
+    def flush(self, due_by=None):
+        """Sends the snapshots due by due_by, or all of them"""
+        with self.condition:
+            game_codes = []
+            while self.due and (due_by is None or next(iter(self.due.values())) <= due_by):
+                game_codes.append(self.due.popitem(last=False)[0])
+        for game_code in game_codes:
+            send_snapshot(game_code)
+
+    def run(self):
+        """Sends each snapshot when it is due"""
+        while True:
+            with self.condition:
+                while not self.due:
+                    self.condition.wait()
+                wait = next(iter(self.due.values())) - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+                continue
+            try:
+                self.flush(time.monotonic())
+            except Exception:  # pylint: disable=W0703
+                LOGGER.exception('Error sending audience snapshots')
+            finally:
+                close_old_connections()
+
+
+def audience_group(game_code):
+    """Returns the group a game's spectators are in"""
+    return 'audience_{}'.format(game_code)
+
+
+def game_changed(game_code):
+    """Asks for a snapshot for the game's spectators, if it has any"""
+    if cache.get(_audience_key(game_code)):
+        get_throttle().request(game_code)
+
+
+def get_public_state(state):
+    """Returns everything about a GameState anyone may see, which is all of it but the hands"""
+    return {'game_code': state.game_code, 'version': state.version, 'players': state.players, 'green_card': state.green_card, 'submitted_cards': state.submitted_cards, 'all_players_submitted': state.all_players_submitted, 'judge': state.judge}
+
+
+def get_throttle():
+    """Returns this process's SnapshotThrottle for the SPECTATOR_SNAPSHOT_INTERVAL"""
+    interval = getattr(settings, 'SPECTATOR_SNAPSHOT_INTERVAL', 1)
+    with _LOCK:
+        if interval not in _THROTTLES:
+            _THROTTLES[interval] = SnapshotThrottle(interval)
+        return _THROTTLES[interval]
+
+
+def keep_audience(game_code):
+    """Notes that a game has spectators, for PRESENCE_TIMEOUT seconds unless one sends a frame again"""
+    cache.set(_audience_key(game_code), True, getattr(settings, 'PRESENCE_TIMEOUT', 300))
+
+
+def send_snapshot(game_code):
+    """Sends the game's public state to its audience, unless this version has already been sent"""
+    state = GameState(game_code)
+    if not state.players or not cache.add('audience:{}:sent:{}'.format(game_code, state.version), True, 60):
+        return
+    content = {'stream': 'spectate', 'payload': {'data': get_public_state(state)}}
+    group = audience_group(game_code)
+    GroupBatch().send([(encoded_group_name(group, encoding), message) for encoding, message in encode_everywhere(content, get_group_encodings([group])[group]).items()], immediately=True)
+
+
+def _audience_key(game_code):
+    return 'audience:{}'.format(game_code)
@@ -0,0 +1,57 @@
+"""In-process catalog of Card data, loaded once per worker since cards only change through the admin or loaddata"""
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .frame_encodings import EncodedValues
+from .models import Card
+
+CardRecord = namedtuple('CardRecord', ['pk', 'name', 'text', 'type'])
+
+_CATALOG = {'cards': None, 'values': {}, 'loaded_at': 0.0}
+
+
+def get_card(card_pk):
+    """Returns the CardRecord for a card pk, reloading the catalog once if the card is new"""
+    cards = _get_cards()
+    if card_pk not in cards:
+        invalidate()
+        cards = _get_cards()
+        if card_pk not in cards:
+            raise Card.DoesNotExist('Card {} does not exist'.format(card_pk))
+    return cards[card_pk]
+
+
+def get_card_values(card_pk):
+    """Gets a values version of a card, shaped like Card.objects.values('pk', 'name', 'text'), shared and encoded to JSON once"""
+    card = get_card(card_pk)
+    values = _CATALOG['values'].get(card_pk)
+    if values is None:
+        values = _CATALOG['values'][card_pk] = EncodedValues(pk=card.pk, name=card.name, text=card.text)
+    return values
+
+
+def get_card_values_list(card_pks):
+    """Gets a values list of cards, ordered by name like the Card model"""
+    return [get_card_values(card_pk) for card_pk in sorted(card_pks, key=lambda card_pk: get_card(card_pk).name)]
+
+
+@receiver(post_delete, sender=Card)
+@receiver(post_save, sender=Card)
+def invalidate(**kwargs):
+    """Drops the catalog so the next lookup reloads it, called when a card is saved, deleted or loaded from a fixture"""
+    _CATALOG['cards'] = None
+    _CATALOG['values'] = {}
+
+
+def _get_cards():
+    """Returns the pk to CardRecord map, loading it if it is missing or older than CARD_CATALOG_TIMEOUT seconds"""
+    timeout = getattr(settings, 'CARD_CATALOG_TIMEOUT', 300)  # Bounds how long other processes' card edits go unseen
+    if _CATALOG['cards'] is None or time.monotonic() - _CATALOG['loaded_at'] > timeout:
+        _CATALOG['cards'] = {card[0]: CardRecord(*card) for card in Card.objects.order_by().values_list('pk', 'name', 'text', 'type')}
+        _CATALOG['values'] = {}
+        _CATALOG['loaded_at'] = time.monotonic()
+    return _CATALOG['cards']
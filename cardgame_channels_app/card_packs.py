@@ -0,0 +1,88 @@
+"""Imports card packs into Decks a chunk at a time, so packs of any size load in bounded memory
+
+Each row is a dict with the card's name, type (green or red) and text, and optionally its key and deck. A card is
+found by its key, '<type>:<name>' unless given, so importing a pack again updates its cards rather than adding them
+twice. Each Deck's memberships copy their card's type, so games drawing from decks read the memberships alone.
+"""
+import itertools
+from collections import OrderedDict
+
+from django.db import transaction
+from django.db.models import Case, CharField, TextField, Value, When
+from django.db.models.signals import post_save, pre_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from . import card_catalog
+from .models import Card, Deck, DeckCard
+
+CARD_FIELDS = ['name', 'type', 'text']
+
+
+def import_cards(rows, deck_name=None, chunk_size=500):
+    """Upserts the rows' cards a chunk per transaction, adding each to its row's deck or deck_name, yielding each chunk's counts"""
+    rows = enumerate(rows, 1)
+    deck_pks = {}  # name: pk of the decks seen so far
+    try:
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                break
+            yield _import_chunk(chunk, deck_name, deck_pks)
+    finally:
+        card_catalog.invalidate()  # Bulk queries send no Card signals
+
+
+def read_row(row, number, deck_name=None):
+    """Returns the (key, card field values, deck name) of an import row, raising ValueError if it isn't a card"""
+    name = (row.get('name') or '').strip()
+    card_type = (row.get('type') or '').strip().lower()
+    if not name or card_type not in (Card.GREEN, Card.RED):
+        raise ValueError('Row {}: a card needs a name and a type of {} or {}'.format(number, Card.GREEN, Card.RED))
+    key = (row.get('key') or '').strip() or '{}:{}'.format(card_type, name)
+    return key, {'name': name, 'type': card_type, 'text': row.get('text') or ''}, (row.get('deck') or '').strip() or deck_name
+
+
+def _import_chunk(chunk, deck_name, deck_pks):
+    """Upserts one chunk of numbered rows with a handful of queries, returning its counts"""
+    cards = OrderedDict()  # key: card field values, the last row winning
+    memberships = set()  # (deck name, key)
+    for number, row in chunk:
+        key, values, row_deck_name = read_row(row, number, deck_name)
+        cards[key] = values
+        if row_deck_name:
+            memberships.add((row_deck_name, key))
+
+    with transaction.atomic():
+        existing = {card['key']: card for card in Card.objects.filter(key__in=list(cards)).values('pk', 'key', *CARD_FIELDS)}
+        Card.objects.bulk_create([Card(key=key, **values) for key, values in cards.items() if key not in existing])
+        changed = {existing[key]['pk']: values for key, values in cards.items() if key in existing and any(existing[key][field] != values[field] for field in CARD_FIELDS)}
+        if changed:
+            Card.objects.filter(pk__in=list(changed)).update(date_updated=timezone.now(), **{
+                field: Case(*[When(pk=pk, then=Value(values[field])) for pk, values in changed.items()], output_field=TextField() if field == 'text' else CharField())
+                for field in CARD_FIELDS})
+            DeckCard.objects.filter(card_id__in=list(changed)).update(type=Case(*[When(card_id=pk, then=Value(values['type'])) for pk, values in changed.items()], output_field=CharField()))
+
+        card_pks = dict(Card.objects.filter(key__in=list(cards)).values_list('key', 'pk'))  # bulk_create doesn't set pks on every database
+        for name in {name for name, _ in memberships} - set(deck_pks):
+            deck_pks[name] = Deck.objects.get_or_create(name=name)[0].pk
+        keys = {card_pk: key for key, card_pk in card_pks.items()}
+        wanted = {(deck_pks[name], card_pks[key]) for name, key in memberships}
+        added = wanted - set(DeckCard.objects.filter(deck_id__in={deck_pk for deck_pk, _ in wanted}, card_id__in=list(keys)).values_list('deck_id', 'card_id'))
+        DeckCard.objects.bulk_create([DeckCard(deck_id=deck_pk, card_id=card_pk, type=cards[keys[card_pk]]['type']) for deck_pk, card_pk in sorted(added)])
+
+    return {'cards': len(cards), 'created': len(cards) - len(existing), 'updated': len(changed), 'added_to_decks': len(added)}
+
+
+@receiver(pre_save, sender=DeckCard)
+def copy_card_type(instance, raw=False, **kwargs):
+    """Copies the card's type onto a deck membership added outside the importer, e.g. in the admin"""
+    if not raw and instance.type is None:
+        instance.type = Card.objects.values_list('type', flat=True).get(pk=instance.card_id)
+
+
+@receiver(post_save, sender=Card)
+def update_card_type(instance, created=False, raw=False, **kwargs):
+    """Keeps the type copied onto a card's deck memberships in step with the card"""
+    if not created and not raw:
+        DeckCard.objects.filter(card_id=instance.pk).exclude(type=instance.type).update(type=instance.type)
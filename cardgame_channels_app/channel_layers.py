@@ -0,0 +1,210 @@
+"""Channel layer support for sending a different message to each of many groups as one batch
+
+With GROUP_SEND_COALESCE_WINDOW set, a game's group messages are held for that many milliseconds from the first one,
+then sent together as a single batch. A message marked as replacing earlier ones (one that carries the latest
+state, e.g. a full-state card_was_submitted) drops the still-held message on the same group and stream.
+"""
+import atexit
+import itertools
+import logging
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+
+import redis
+from asgi_redis import RedisChannelLayer
+from channels import DEFAULT_CHANNEL_LAYER, channel_layers
+from channels.message import pending_message_store
+from django.conf import settings
+
+LOGGER = logging.getLogger("cardgame_channels_app")
+GROUP_SEND_STATS = Counter()  # publishes to the channel layer, group messages they carried, messages replaced before sending, and channels skipped for being full
+
+_COALESCERS = {}
+_LOCK = threading.Lock()
+
+
+class BatchingRedisChannelLayer(RedisChannelLayer):
+    """RedisChannelLayer that delivers many group messages with two pipelined round trips per shard"""
+
+    extensions = RedisChannelLayer.extensions + ['send_group_many']
+
+    def send_group_many(self, group_messages):
+        """Sends each (group, message) pair, looking up every group in one pipeline and delivering in another
+
+        Returns the channels that were skipped for being full, as send_group skips them, and raises the first other
+        error once the rest of the batch has gone out.
+        """
+        lookups = {}
+        now = int(time.time())
+        for group, _ in group_messages:
+            index = self.consistent_hash(group)
+            pipeline = lookups.setdefault(index, self.connection(index).pipeline(transaction=False))
+            pipeline.zremrangebyscore(self._group_key(group), 0, now - self.group_expiry)
+            pipeline.zrange(self._group_key(group), 0, -1)
+        results = {index: iter(pipeline.execute()) for index, pipeline in lookups.items()}
+
+        deliveries = {}  # shard index: (pipeline, channels in the order their sends were queued)
+        for group, message in group_messages:
+            group_results = results[self.consistent_hash(group)]
+            next(group_results)  # Count of expired channels removed
+            for channel in next(group_results):
+                self._pipeline_send(deliveries, channel.decode('utf8'), message)
+
+        full_channels = []
+        errors = []
+        for index, (pipeline, channels) in deliveries.items():
+            counts = self.connection(index).pipeline(transaction=False)
+            for channel, result in zip(channels, pipeline.execute(raise_on_error=False)):
+                if not isinstance(result, redis.exceptions.ResponseError):
+                    stat_name = self.STAT_MESSAGES_COUNT
+                elif result.args[0] == 'full':
+                    stat_name = self.STAT_CHANNEL_FULL
+                    full_channels.append(channel)
+                else:
+                    errors.append(result)
+                    continue
+                self._incr_statistics_counter(stat_name=stat_name, channel=channel, connection=counts)
+            if len(counts):
+                counts.execute()
+        if errors:
+            raise errors[0]
+        return full_channels
+
+    def _pipeline_send(self, deliveries, channel, message):
+        """Queues the same set-and-push as send() onto the pipeline for the channel's shard"""
+        if '!' in channel:
+            message = dict(message.items())
+            message['__asgi_channel__'] = channel
+            channel = self.non_local_name(channel)
+        if '!' in channel or '?' in channel:
+            index = self.consistent_hash(channel)
+        else:
+            index = next(self._send_index_generator)
+        pipeline, channels = deliveries.setdefault(index, (self.connection(index).pipeline(transaction=False), []))
+        self.chansend(
+            keys=[self.prefix + uuid.uuid4().hex, self.prefix + channel],
+            args=[self.serialize(message), self.expiry, self.get_capacity(channel)],
+            client=pipeline,
+        )
+        channels.append(channel)
+
+
+class GroupBatch(object):
+    """Sends one message to each of many groups, deferred until the consumer finishes just like Group.send"""
+
+    def __init__(self, alias=DEFAULT_CHANNEL_LAYER, channel_layer=None):
+        self.channel_layer = channel_layer or channel_layers[alias]
+
+    def send(self, group_messages, immediately=False):
+        """Sends a list of (group, message) pairs, in one batch if the channel layer supports it"""
+        if not immediately and pending_message_store.active:
+            pending_message_store.append(self, group_messages)
+            return
+        full_channels = []
+        if 'send_group_many' in getattr(self.channel_layer, 'extensions', []):
+            full_channels = self.channel_layer.send_group_many(group_messages)
+            publishes = 1
+        else:
+            for group, message in group_messages:
+                self.channel_layer.send_group(group, message)
+            publishes = len(group_messages)
+        with _LOCK:
+            GROUP_SEND_STATS.update(publishes=publishes, messages=len(group_messages))
+            if full_channels:
+                GROUP_SEND_STATS['channel_full'] += len(full_channels)
+        if full_channels:
+            LOGGER.warning('Skipped %d full channels sending to groups: %s', len(full_channels), ', '.join(full_channels))
+
+    def __str__(self):
+        return 'GroupBatch'
+
+
+class GameGroupBatch(GroupBatch):
+    """GroupBatch for one game's messages on a stream, which go through the game's coalescing window when there is one"""
+
+    def __init__(self, game_code, stream, replace=False, window=None, alias=DEFAULT_CHANNEL_LAYER, channel_layer=None):
+        super(GameGroupBatch, self).__init__(alias, channel_layer)
+        self.game_code = game_code
+        self.stream = stream
+        self.replace = replace
+        self.window = window  # Milliseconds, GROUP_SEND_COALESCE_WINDOW if None
+
+    def send(self, group_messages, immediately=False):
+        """Holds the (group, message) pairs for the game's next batch, or sends them now if coalescing is off"""
+        if not immediately and pending_message_store.active:
+            pending_message_store.append(self, group_messages)
+            return
+        coalescer = get_group_coalescer(self.channel_layer, self.window)
+        if coalescer:
+            coalescer.add(self.game_code, self.stream, group_messages, self.replace)
+        else:
+            super(GameGroupBatch, self).send(group_messages, immediately=True)
+
+    def __str__(self):
+        return 'GameGroupBatch'
+
+
+class GroupCoalescer(object):
+    """Holds each game's group messages until window seconds after the first, then sends every due game's messages as one batch"""
+
+    def __init__(self, window, channel_layer):
+        self.window = window
+        self.batch = GroupBatch(channel_layer=channel_layer)
+        self.pending = OrderedDict()  # game_code: (deadline, OrderedDict of key: (group, message)), in deadline order
+        self.condition = threading.Condition()
+        self.keys = itertools.count()
+        threading.Thread(target=self.run, daemon=True).start()
+        atexit.register(self.flush)
+
+    def add(self, game_code, stream, group_messages, replace=False):
+        """Holds the (group, message) pairs for the game's batch, dropping held messages on the same group and stream if replace"""
+        with self.condition:
+            if game_code not in self.pending:
+                self.pending[game_code] = (time.monotonic() + self.window, OrderedDict())
+                self.condition.notify()
+            held = self.pending[game_code][1]
+            for group, message in group_messages:
+                key = (group, stream) if replace else next(self.keys)
+                if held.pop(key, None) is not None:  # Goes to the end, after whatever was sent in between
+                    with _LOCK:
+                        GROUP_SEND_STATS['replaced'] += 1
+                held[key] = (group, message)
+
+    def flush(self, due_by=None):
+        """Sends the messages of every game whose window has closed by due_by, or of every game"""
+        with self.condition:
+            due = []
+            while self.pending and (due_by is None or next(iter(self.pending.values()))[0] <= due_by):
+                due.extend(self.pending.popitem(last=False)[1][1].values())
+        if due:
+            self.batch.send(due, immediately=True)
+
+    def run(self):
+        """Flushes each game when its window closes"""
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                wait = next(iter(self.pending.values()))[0] - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+                continue
+            try:
+                self.flush(time.monotonic())
+            except Exception:  # pylint: disable=W0703
+                LOGGER.exception('Error sending coalesced group messages')
+
+
+def get_group_coalescer(channel_layer, window=None):
+    """Returns this process's GroupCoalescer for the channel layer and window in milliseconds, GROUP_SEND_COALESCE_WINDOW if None, or None if the window is 0"""
+    if window is None:
+        window = getattr(settings, 'GROUP_SEND_COALESCE_WINDOW', 0)
+    if not window:
+        return None
+    with _LOCK:
+        key = (channel_layer, window)
+        if key not in _COALESCERS:
+            _COALESCERS[key] = GroupCoalescer(window / 1000, channel_layer)
+        return _COALESCERS[key]
@@ -0,0 +1,31 @@
+"""System checks for settings that only work when every worker shares one cache"""
+from django.conf import settings
+from django.core.checks import Warning, register  # pylint: disable=W0622
+
+from .frame_encodings import DEFAULT_ENCODING, ENCODINGS
+
+PROCESS_LOCAL_CACHES = ('django.core.cache.backends.locmem.LocMemCache', 'django.core.cache.backends.dummy.DummyCache')
+PROCESS_LOCAL_CHANNEL_LAYERS = ('asgiref.inmemory.ChannelLayer',)
+SHARED_CACHE_SETTINGS = ('GAME_AFFINITY', 'STREAM_METRICS')
+
+
+@register()
+def check_shared_cache(app_configs, **kwargs):
+    """Warns when workers coordinate through the cache, with a setting that needs it or across processes, but the default cache is process-local"""
+    backend = settings.CACHES['default']['BACKEND']
+    if backend not in PROCESS_LOCAL_CACHES:
+        return []
+    problems = ['{} is on'.format(name) for name in SHARED_CACHE_SETTINGS if getattr(settings, name, False)]
+    if settings.CHANNEL_LAYERS.get('default', {}).get('BACKEND') not in PROCESS_LOCAL_CHANNEL_LAYERS:  # Workers can run in processes of their own
+        if getattr(settings, 'CHANNEL_SESSION_ENGINE', settings.SESSION_ENGINE) == 'django.contrib.sessions.backends.cache':
+            problems.append('CHANNEL_SESSION_ENGINE keeps channel sessions in the cache')
+        if set(ENCODINGS) - {DEFAULT_ENCODING}:
+            problems.append("Frame encodings count each group's connections in the cache")
+    return [
+        Warning(
+            '{}, but the default cache is the process-local {}'.format(problem, backend.rsplit('.', 1)[-1]),
+            hint='Point CACHES at a cache shared by every worker, as the docker-compose settings do with Redis.',
+            id='cardgame_channels_app.W001',
+        )
+        for problem in problems
+    ]
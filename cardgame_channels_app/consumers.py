@@ -1,12 +1,59 @@
 import logging
+import time
 
-from channels import Group
-from channels.generic.websockets import WebsocketDemultiplexer, JsonWebsocketConsumer
+from channels import DEFAULT_CHANNEL_LAYER, Channel, Group, channel_layers
+from channels.message import Message
+from channels.sessions import session_for_reply_channel
+from channels.generic.websockets import WebsocketDemultiplexer, WebsocketMultiplexer, JsonWebsocketConsumer
+from django.conf import settings
+from django.http import QueryDict
 
-from cardgame_channels_app.forms import JoinGameForm, GameCodeForm, GameCodeCardForm, BootPlayerForm
+from cardgame_channels_app import audience, game_affinity, stream_metrics
+from cardgame_channels_app.channel_layers import GameGroupBatch, GroupBatch
+from cardgame_channels_app.frame_encodings import DEFAULT_ENCODING, ENCODINGS, JsonEncoding, add_group_encoding, discard_group_encoding, encode_everywhere, encoded_group_name, get_group_encodings
+from cardgame_channels_app.forms import JoinGameForm, CreateGameForm, GameCodeForm, GameCodeCardForm, BootPlayerForm
+from cardgame_channels_app.game_codes import GameCodesExhausted
 from cardgame_channels_app.game_logic import *
 
 LOGGER = logging.getLogger("cardgame_channels_app")
+NOT_JOINED_ERRORS = {'game_code': ['You have not joined that game.']}
+
+
+def get_joined_ids(message, game_code):
+    """Returns the (game_id, player_id) the connection joined game_code with, or None if it hasn't joined that game"""
+    session = message.channel_session
+    if session.get('game_code') != game_code:
+        return None
+    return session['game_id'], session['player_id']
+
+
+def group_send_player_booted(multiplexer, state, player_pk, player_name, valid=True, full_state=False, version=None):
+    """Tells everyone in the game a player was booted, at the state version their boot made if several were booted at once"""
+    data = {'game_code': state.game_code, 'version': version or state.version, 'player_name': player_name, 'player_pk': player_pk, 'submitted_cards': state.submitted_cards, 'all_players_submitted': state.all_players_submitted, 'valid': valid}
+    if full_state:
+        data.update({'players': state.players, 'judge': state.judge})
+    multiplexer.group_send(state.game_code, 'boot_player', {'data': data}, game_code=state.game_code)
+    audience.game_changed(state.game_code)
+
+
+def close_evicted_connection(reply_channel, game_code, player_pk):
+    """Takes an evicted player's connection out of its groups in every encoding, drops its session and closes it"""
+    session = session_for_reply_channel(reply_channel)
+    leave_groups(session, reply_channel, channel_layers[DEFAULT_CHANNEL_LAYER])
+    for name in (game_code, 'player_{}'.format(player_pk)):  # In case the session expired first
+        for encoding in ENCODINGS:
+            Group(encoded_group_name(name, encoding)).discard(reply_channel)
+    session.flush()  # So closing the connection leaves nothing again
+    Channel(reply_channel).send({'close': True})
+
+
+def leave_groups(session, reply_channel, channel_layer):
+    """Takes a connection out of the groups its session joined, at the encoding it joined them with"""
+    encoding = session.get('encoding', DEFAULT_ENCODING)
+    for name in set(session.get('groups', [])):
+        Group(encoded_group_name(name, encoding), channel_layer=channel_layer).discard(reply_channel)
+    for name in session.get('groups', []):  # Once for each time it was added and counted
+        discard_group_encoding(name, encoding)
 
 
 class BootPlayerConsumer(JsonWebsocketConsumer):
@@ -17,13 +64,18 @@ class BootPlayerConsumer(JsonWebsocketConsumer):
         boot_player_form = BootPlayerForm(content)
         if boot_player_form.is_valid():
             game_code = boot_player_form.cleaned_data.get('game_code')
-            player_name = boot_player_from_game(game_code, boot_player_form.cleaned_data.get('player_pk'))
+            joined_ids = get_joined_ids(self.message, game_code)
+            if not joined_ids:
+                multiplexer.send({'action': 'boot_player', 'data': {'error': 'boot failed', 'errors': NOT_JOINED_ERRORS}})
+                return
+            game_id = joined_ids[0]
+            player_name = boot_player_from_game(game_code, boot_player_form.cleaned_data.get('player_pk'), game_id)
             if player_name:
                 valid = True
             else:
                 player_name = 'Unknown'
                 valid = False
-            multiplexer.group_send(game_code, 'boot_player', {'data': {'game_code': game_code, 'player_name': player_name, 'players': get_game_player_values_list(game_code), 'submitted_cards': get_submitted_cards_values_list(game_code), 'all_players_submitted': get_all_players_submitted(game_code), 'judge': get_judge_player_values(game_code), 'valid': valid}})
+            group_send_player_booted(multiplexer, GameState(game_code, game_id), boot_player_form.cleaned_data.get('player_pk'), player_name, valid, kwargs.get('full_state'))
         else:
             multiplexer.send({'action': 'boot_player', 'data': {'error': 'join failed', 'errors': boot_player_form.errors}})
 
@@ -33,8 +85,42 @@ class CreateGameConsumer(JsonWebsocketConsumer):
 
     def receive(self, content, **kwargs):
         multiplexer = kwargs.get('multiplexer')
-        game_code = create_game_code()
-        multiplexer.send({'action': 'create_game', 'data': {'game_code': game_code}})
+        create_game_form = CreateGameForm(content)
+        if create_game_form.is_valid():
+            try:
+                game_code = create_game_code(create_game_form.cleaned_data['deck_pks'])
+            except GameCodesExhausted as error:
+                multiplexer.send({'action': 'create_game', 'data': {'error': 'create game failed', 'errors': {'__all__': [str(error)]}}})
+                return
+            multiplexer.send({'action': 'create_game', 'data': {'game_code': game_code}})
+        else:
+            multiplexer.send({'action': 'create_game', 'data': {'error': 'create game failed', 'errors': create_game_form.errors}})
+
+
+class GameStateConsumer(JsonWebsocketConsumer):
+    """Takes a game_code and sends back the full public state of the game, and a joined player's hand, for clients that missed a broadcast"""
+
+    def receive(self, content, **kwargs):
+        multiplexer = kwargs.get('multiplexer')
+        game_code_form = GameCodeForm(content)
+        if game_code_form.is_valid():
+            game_code = game_code_form.cleaned_data.get('game_code')
+            joined_ids = get_joined_ids(self.message, game_code)
+            state = GameState(game_code, joined_ids[0] if joined_ids else None)
+            data = audience.get_public_state(state)
+            if joined_ids:
+                data['player_cards'] = state.get_hand(joined_ids[1])  # Hands only come in messages to the player, which a full channel drops
+            multiplexer.send({'action': 'game_state', 'data': data})
+        else:
+            multiplexer.send({'action': 'game_state', 'data': {'error': 'game state failed', 'errors': game_code_form.errors}})
+
+
+class HeartbeatConsumer(JsonWebsocketConsumer):
+    """Answers a client's keep-alive, which marks its player as seen like any other frame"""
+
+    def receive(self, content, **kwargs):
+        multiplexer = kwargs.get('multiplexer')
+        multiplexer.send({'action': 'heartbeat', 'data': {'interval': getattr(settings, 'PRESENCE_HEARTBEAT_INTERVAL', 30)}})
 
 
 class JoinGameConsumer(JsonWebsocketConsumer):
@@ -45,13 +131,21 @@ class JoinGameConsumer(JsonWebsocketConsumer):
         join_form = JoinGameForm(content)
         if join_form.is_valid():
             game_code = join_form.cleaned_data.get('game_code')
-            player = add_player_to_game(game_code, join_form.cleaned_data.get('player_name'))
+            player = add_player_to_game(game_code, join_form.cleaned_data.get('player_name'), self.message.reply_channel.name)
+            session = self.message.channel_session
+            groups = session.get('groups', []) + [game_code, 'player_{}'.format(player.pk)]  # Left again on disconnect
+            session.update({'game_code': game_code, 'game_id': player.game_id, 'player_id': player.pk, 'groups': groups, 'seen_at': time.time()})  # Later turns from this connection use these ids
 
-            Group(game_code, channel_layer=multiplexer.reply_channel.channel_layer).add(multiplexer.reply_channel)  # Add joiner to group for this came code, since auto-add only happens on connect
-            Group('player_{}'.format(player.pk), channel_layer=multiplexer.reply_channel.channel_layer).add(multiplexer.reply_channel)  # Add joiner to group for this player name, since auto-add only happens on connect
+            multiplexer.add_to_group(game_code)  # Add joiner to group for this came code, since auto-add only happens on connect
+            multiplexer.add_to_group('player_{}'.format(player.pk))  # Add joiner to group for this player name, since auto-add only happens on connect
 
-            multiplexer.send({'action': 'join_game', 'data': {'game_code': game_code, 'player': get_player_values(player.pk), 'player_cards': get_cards_in_hand_values_list(player.pk), 'green_card': get_matching_card_values(game_code), 'submitted_cards': get_submitted_cards_values_list(game_code), 'all_players_submitted': get_all_players_submitted(game_code), 'judge': get_judge_player_values(game_code)}})
-            multiplexer.group_send(game_code, 'player_joined_game', {'data': {'game_code': game_code, 'player': get_player_values(player.pk), 'players': get_game_player_values_list(player.game.code)}})  # notify everyone in the game a player has joined
+            state = GameState(game_code, player.game_id)
+            multiplexer.send({'action': 'join_game', 'data': {'game_code': game_code, 'version': state.version, 'player': state.get_player(player.pk), 'players': state.players, 'player_cards': state.get_hand(player.pk), 'green_card': state.green_card, 'submitted_cards': state.submitted_cards, 'all_players_submitted': state.all_players_submitted, 'judge': state.judge}})
+            data = {'game_code': game_code, 'version': state.version, 'player': state.get_player(player.pk)}
+            if kwargs.get('full_state'):
+                data['players'] = state.players
+            multiplexer.group_send(game_code, 'player_joined_game', {'data': data}, game_code=game_code)  # notify everyone in the game a player has joined
+            audience.game_changed(game_code)
         else:
             multiplexer.send({'action': 'join_game', 'data': {'error': 'join failed', 'errors': join_form.errors}})
 
@@ -63,23 +157,52 @@ class PickCardConsumer(JsonWebsocketConsumer):
         multiplexer = kwargs.get('multiplexer')
         pick_card_form = GameCodeCardForm(content)
         if pick_card_form.is_valid():
-            cgp = pick_card(pick_card_form.cleaned_data.get('game_code'), pick_card_form.cleaned_data.get('card_pk'))
-            players = list(cgp.game.players.values('pk', 'name', 'status', 'score'))
-            judge = get_judge_player_values(cgp.game.code)
-            green_card = get_matching_card_values(cgp.game.code)
-
-            # notify everyone card was picked
-            multiplexer.group_send(cgp.game.code, 'pick_card', {'data': {'picked_player': get_player_values(cgp.player.pk), 'card': get_card_values(cgp.game.code, cgp.card), 'players': players}})
-
-            # Draw new cards and send out to everyone, one by one
-            replenish_hands(cgp.game.code)
-            for player in players:
-                player_cards = get_cards_in_hand_values_list(player.get('pk'))
-                multiplexer.group_send('player_{}'.format(player.get('pk')), 'new_cards', {'data': {'game_code': cgp.game.code, 'judge': judge, 'green_card': green_card, 'cards': player_cards}})
+            game_code = pick_card_form.cleaned_data.get('game_code')
+            joined_ids = get_joined_ids(self.message, game_code)
+            if not joined_ids:
+                multiplexer.send({'action': 'pick_card', 'data': {'error': 'pick card failed', 'errors': NOT_JOINED_ERRORS}})
+                return
+            game_id = joined_ids[0]
+            cgp = pick_card(game_code, pick_card_form.cleaned_data.get('card_pk'), game_id)
+            if not cgp:  # Already picked, most likely by a duplicate message
+                multiplexer.send({'action': 'pick_card', 'data': {'error': 'pick card failed', 'errors': {'card_pk': ['That card has not been submitted.']}}})
+                return
+
+            # pick_card has dealt everyone new cards, so snapshot the game for everyone's messages
+            state = GameState(game_code, game_id)
+            judge = state.judge
+            green_card = state.green_card
+
+            # notify everyone card was picked, they all go back to waiting except the picked player who is now the judge
+            data = {'game_code': game_code, 'version': state.version, 'picked_player': state.get_player(cgp.player_id), 'card': get_card_values(cgp.card_id)}
+            if kwargs.get('full_state'):
+                data['players'] = state.players
+            multiplexer.group_send(game_code, 'pick_card', {'data': data}, game_code=game_code)
+
+            # Send out everyone's new cards as one batch
+            multiplexer.group_send_many('new_cards', [('player_{}'.format(player.get('pk')), {'data': {'game_code': game_code, 'version': state.version, 'judge': judge, 'green_card': green_card, 'cards': state.get_hand(player.get('pk'))}}) for player in state.players], game_code=game_code)
+            audience.game_changed(game_code)
         else:
             multiplexer.send({'action': 'pick_card', 'data': {'error': 'pick card failed', 'errors': pick_card_form.errors}})
 
 
+class SpectateConsumer(JsonWebsocketConsumer):
+    """Takes a game_code and sends back its public state, then throttled snapshots of it as it changes, without joining the game"""
+
+    def receive(self, content, **kwargs):
+        multiplexer = kwargs.get('multiplexer')
+        game_code_form = GameCodeForm(content)
+        if game_code_form.is_valid():
+            game_code = game_code_form.cleaned_data.get('game_code')
+            session = self.message.channel_session
+            session.update({'spectating': game_code, 'groups': session.get('groups', []) + [audience.audience_group(game_code)]})  # Left again on disconnect
+            multiplexer.add_to_group(audience.audience_group(game_code))
+            audience.keep_audience(game_code)
+            multiplexer.send({'action': 'spectate', 'data': audience.get_public_state(GameState(game_code))})
+        else:
+            multiplexer.send({'action': 'spectate', 'data': {'error': 'spectate failed', 'errors': game_code_form.errors}})
+
+
 class SubmitCardConsumer(JsonWebsocketConsumer):
     """Takes a game code and card_pk and marks that card as submitted"""
 
@@ -87,9 +210,23 @@ class SubmitCardConsumer(JsonWebsocketConsumer):
         multiplexer = kwargs.get('multiplexer')
         submit_card_form = GameCodeCardForm(content)
         if submit_card_form.is_valid():
-            cgp = submit_card(submit_card_form.cleaned_data.get('game_code'), submit_card_form.cleaned_data.get('card_pk'))
-            multiplexer.group_send('player_{}'.format(cgp.player.pk), 'submit_card', {'data': {'game_code': cgp.game.code, 'cards': get_cards_in_hand_values_list(cgp.player.pk)}})
-            multiplexer.group_send(cgp.game.code, 'card_was_submitted', {'data': {'game_code': cgp.game.code, 'submitting_player': get_player_values(cgp.player.pk), 'players': get_game_player_values_list(cgp.game.code), 'card': get_card_values(cgp.game.code, cgp.card), 'submitted_cards': get_submitted_cards_values_list(cgp.game.code), 'all_players_submitted': get_all_players_submitted(cgp.game.code)}})  # notify everyone card was submitted
+            game_code = submit_card_form.cleaned_data.get('game_code')
+            joined_ids = get_joined_ids(self.message, game_code)
+            if not joined_ids:
+                multiplexer.send({'action': 'submit_card', 'data': {'error': 'submit card failed', 'errors': NOT_JOINED_ERRORS}})
+                return
+            game_id, player_id = joined_ids
+            cgp = submit_card(game_code, submit_card_form.cleaned_data.get('card_pk'), game_id, player_id)
+            if not cgp:  # Already submitted, most likely by a duplicate message
+                multiplexer.send({'action': 'submit_card', 'data': {'error': 'submit card failed', 'errors': {'card_pk': ['That card is not in your hand.']}}})
+                return
+            state = GameState(game_code, game_id)
+            multiplexer.group_send('player_{}'.format(cgp.player_id), 'submit_card', {'data': {'game_code': game_code, 'cards': state.get_hand(cgp.player_id)}}, game_code=game_code)
+            data = {'game_code': game_code, 'version': state.version, 'submitting_player': state.get_player(cgp.player_id), 'card': get_card_values(cgp.card_id), 'all_players_submitted': state.all_players_submitted}
+            if kwargs.get('full_state'):
+                data.update({'players': state.players, 'submitted_cards': state.submitted_cards})
+            multiplexer.group_send(game_code, 'card_was_submitted', {'data': data}, game_code=game_code, replace=kwargs.get('full_state'))  # notify everyone card was submitted, a full state replaces one still being held
+            audience.game_changed(game_code)
         else:
             multiplexer.send({'action': 'submit_card', 'data': {'error': 'submit card failed', 'errors': submit_card_form.errors}})
 
@@ -118,15 +255,140 @@ class ValidatePlayerNameConsumer(JsonWebsocketConsumer):
             multiplexer.send({'action': 'validate_player_name', 'data': {'game_code': validate_player_form.cleaned_data.get('game_code'), 'player_name': validate_player_form.cleaned_data.get('player_name'), 'valid': False, 'errors': validate_player_form.errors}})
 
 
+class GameMultiplexer(WebsocketMultiplexer):
+    """Multiplexer that encodes frames the way the connection asked for, and can send a different payload to each of many groups in one batch"""
+
+    encoding = JsonEncoding
+    coalesce_window = None  # Milliseconds a game's group messages are held for, GROUP_SEND_COALESCE_WINDOW if None
+
+    def add_to_group(self, name):
+        """Adds this connection to a group, alongside the other connections using the same encoding"""
+        Group(encoded_group_name(name, self.encoding.name), channel_layer=self.reply_channel.channel_layer).add(self.reply_channel)
+        add_group_encoding(name, self.encoding.name)
+
+    @classmethod
+    def encode(cls, stream, payload):
+        """Encodes stream + payload for outbound sending"""
+        message = cls.encoding.encode({'stream': stream, 'payload': payload})
+        stream_metrics.count_sent([message])
+        return message
+
+    @classmethod
+    def group_send(cls, name, stream, payload, close=False, game_code=None, replace=False):
+        """Sends the payload to everyone in the group, encoded once per encoding, in the game's coalescing window if given one"""
+        group_messages = cls.encode_for_groups(stream, [(name, payload)])
+        if close:
+            for _, message in group_messages:
+                message['close'] = True
+        (GameGroupBatch(game_code, stream, replace, cls.coalesce_window) if game_code else GroupBatch()).send(group_messages)
+
+    @classmethod
+    def group_send_many(cls, stream, group_payloads, game_code=None):
+        """Sends each (group name, payload) pair on the stream, as a single channel layer batch"""
+        (GameGroupBatch(game_code, stream, window=cls.coalesce_window) if game_code else GroupBatch()).send(cls.encode_for_groups(stream, group_payloads))
+
+    @staticmethod
+    def encode_for_groups(stream, group_payloads):
+        """Returns (group, message) pairs that reach every connection in each group, for just the encodings its connections use, serializing each payload once"""
+        group_encodings = get_group_encodings([name for name, _ in group_payloads])
+        group_messages = [(encoded_group_name(name, encoding), message) for name, payload in group_payloads for encoding, message in encode_everywhere({'stream': stream, 'payload': payload}, group_encodings[name]).items()]
+        stream_metrics.count_sent([message for _, message in group_messages], len(group_payloads))
+        return group_messages
+
+
+ENCODED_MULTIPLEXERS = {}  # (encoding name, coalesce_window): GameMultiplexer subclass, made when first needed
+
+
+def get_multiplexer_class(encoding, coalesce_window=None):
+    """Returns the GameMultiplexer for an encoding and a coalescing window in milliseconds, GROUP_SEND_COALESCE_WINDOW if None"""
+    key = (encoding, coalesce_window)
+    if key not in ENCODED_MULTIPLEXERS:
+        ENCODED_MULTIPLEXERS[key] = type('GameMultiplexer', (GameMultiplexer,), {'encoding': ENCODINGS[encoding], 'coalesce_window': coalesce_window})
+    return ENCODED_MULTIPLEXERS[key]
+
+
 class GameDemultiplexer(WebsocketDemultiplexer):
     # Looks at the 'stream' value to route the incoming request to the correct consumer
+    # Broadcasts carry only what changed, tagged with the game's state version; a client that sees a version gap asks
+    # the game_state stream for a full snapshot. Set full_state_broadcasts for clients that expect whole lists every time.
+    # Clients pick their frame encoding when they connect with ?encoding=, one of frame_encodings.ENCODINGS.
+
+    channel_session = True
+    full_state_broadcasts = False
+    coalesce_window = None  # Milliseconds the consumers' broadcasts are held for, GROUP_SEND_COALESCE_WINDOW if None
 
     consumers = {
         "boot_player": BootPlayerConsumer,
         "create_game": CreateGameConsumer,
+        "game_state": GameStateConsumer,
+        "heartbeat": HeartbeatConsumer,
         "join_game": JoinGameConsumer,
         "pick_card": PickCardConsumer,
+        "spectate": SpectateConsumer,
         "submit_card": SubmitCardConsumer,
         "validate_game_code": ValidateGameCodeConsumer,
         "validate_player_name": ValidatePlayerNameConsumer,
     }
+
+    @property
+    def multiplexer_class(self):
+        """Multiplexer for the encoding this connection asked for, with this demultiplexer's coalescing window"""
+        return get_multiplexer_class(self.message.channel_session.get('encoding', DEFAULT_ENCODING), self.coalesce_window)
+
+    def connect(self, message, **kwargs):
+        """Remembers the frame encoding the client asked for, and accepts the connection once if we have it"""
+        encoding = QueryDict(message.content.get('query_string', '')).get('encoding', DEFAULT_ENCODING)
+        if encoding not in ENCODINGS:
+            message.reply_channel.send({'accept': False})
+            return
+        message.channel_session['encoding'] = encoding
+        message.reply_channel.send({'accept': True})  # None of the consumers act on connect, so it isn't forwarded for each to accept again
+
+    def disconnect(self, message, **kwargs):
+        """Leaves the groups the connection joined, so broadcasts stop going to it, marks its player disconnected for evict_absent_players and drops its session"""
+        session = message.channel_session
+        leave_groups(session, message.reply_channel.name, message.channel_layer)
+        if 'player_id' in session:
+            mark_player_seen(session['player_id'], connected=False)
+        super(GameDemultiplexer, self).disconnect(message, **kwargs)
+        session.flush()  # Nothing reads it again, and the cache would otherwise hold it until it expires
+
+    def raw_receive(self, message, **kwargs):
+        """Decodes binary frames with the connection's encoding, text frames are always JSON"""
+        if 'bytes' in message:
+            self.receive(ENCODINGS[message.channel_session.get('encoding', DEFAULT_ENCODING)].decode(message['bytes']), **kwargs)
+        else:
+            super(GameDemultiplexer, self).raw_receive(message, **kwargs)
+
+    def receive(self, content, **kwargs):
+        """Forwards the frame to the worker that owns its game, or marks the player seen, lets the consumers know whether to broadcast full state and records the stream's metrics"""
+        payload = content.get('payload') if isinstance(content, dict) else None
+        if isinstance(payload, dict) and game_affinity.route_message(self.message, payload.get('game_code')):
+            return
+        self.mark_seen()
+        kwargs['full_state'] = self.full_state_broadcasts
+        if not stream_metrics.enabled():
+            super(GameDemultiplexer, self).receive(content, **kwargs)
+            return
+        stream = content.get('stream') if isinstance(content, dict) else None
+        with stream_metrics.record(stream if stream in self.consumers else 'unknown'):
+            super(GameDemultiplexer, self).receive(content, **kwargs)
+
+    def mark_seen(self):
+        """Updates the connection's player's last_seen, or keeps its game's audience, at most once every PRESENCE_HEARTBEAT_INTERVAL seconds"""
+        session = self.message.channel_session
+        if ('player_id' in session or 'spectating' in session) and time.time() - session.get('seen_at', 0) >= getattr(settings, 'PRESENCE_HEARTBEAT_INTERVAL', 30):
+            session['seen_at'] = time.time()
+            if 'player_id' in session:
+                mark_player_seen(session['player_id'])
+            if 'spectating' in session:
+                audience.keep_audience(session['spectating'])
+
+
+def receive_forwarded(message, **kwargs):
+    """Handles a frame another process forwarded to this game worker, as if it had arrived on websocket.receive, then hands off the games it doesn't own"""
+    if message.content.get('rebalance'):
+        game_affinity.flush_games()
+    else:
+        GameDemultiplexer(Message(message.content, 'websocket.receive', message.channel_layer), **kwargs)
+    game_affinity.hand_off_games(game_affinity.get_workers())  # Including one it was only sent because it still held it
@@ -1,10 +1,10 @@
 """Django Forms"""
 
-from django.core.exceptions import ObjectDoesNotExist
 from django.forms import CharField, Form, HiddenInput, IntegerField, ValidationError
 from django.utils.html import strip_tags, escape
 
-from cardgame_channels_app.models import Game, Player
+from cardgame_channels_app.game_index import game_exists, get_player_names
+from cardgame_channels_app.models import Card, Deck, DeckCard
 
 
 class JoinGameForm(Form):
@@ -16,30 +16,47 @@ class JoinGameForm(Form):
         """Since Game Code and Player Name depend on each other, we need to validate them together"""
         cleaned_data = super(JoinGameForm, self).clean()
 
-        # If the data survived the initial cleaning, then check it against the database
+        # If the data survived the initial cleaning, then check it against the game index
         if cleaned_data.get('player_name') and cleaned_data.get('game_code'):
             # Try and make game_code safe
             game_code = escape(strip_tags(cleaned_data['game_code'].lower()))
 
             # Check if game_code exists
-            try:
-                Game.objects.get(code=game_code)
+            player_names = get_player_names(game_code)
+            if player_names is not None:
                 self.cleaned_data['game_code'] = game_code
-            except ObjectDoesNotExist:
+            else:
                 self.add_error('game_code', 'Unfortunately, that game code does not exist.')
 
             # Try and make player_name safe
             player_name = escape(strip_tags(self.cleaned_data['player_name']))
 
             # Check if player_name is already taken
-            try:
-                Player.objects.get(game__code=game_code, name__iexact=player_name)
-
+            if player_names and player_name.lower() in player_names:
                 self.add_error('player_name', 'Unfortunately, that player name is already taken.')
-            except ObjectDoesNotExist:  # Must be unique if did not exist
+            else:  # Must be unique if did not exist
                 self.cleaned_data['player_name'] = player_name
 
 
+class CreateGameForm(Form):
+    """Form to create a game drawing from a list of deck names, or from every card if there are none"""
+
+    def clean(self):
+        cleaned_data = super(CreateGameForm, self).clean()
+        names = self.data.get('decks') or []
+        if not isinstance(names, list) or not all(isinstance(name, str) for name in names):
+            raise ValidationError('Decks must be a list of deck names.')
+        decks = dict(Deck.objects.filter(name__in=names).values_list('name', 'pk'))
+        missing = [name for name in names if name not in decks]
+        if missing:
+            raise ValidationError('Unfortunately, there is no deck named {}.'.format(', '.join(missing)))
+        colors = set(DeckCard.objects.filter(deck_id__in=decks.values()).values_list('type', flat=True).distinct()) if decks else {Card.GREEN, Card.RED}
+        if not {Card.GREEN, Card.RED} <= colors:
+            raise ValidationError('Those decks need both green and red cards.')
+        cleaned_data['deck_pks'] = sorted(decks.values())
+        return cleaned_data
+
+
 class GameCodeForm(Form):
     """Form to create new games"""
     game_code = CharField(label="Game Code", max_length="4", required=True)
@@ -48,9 +65,7 @@ class GameCodeForm(Form):
         game_code = escape(strip_tags(self.cleaned_data['game_code'].lower()))
 
         # Check if game_code exists
-        try:
-            Game.objects.get(code=game_code)
-        except ObjectDoesNotExist:
+        if not game_exists(game_code):
             self.add_error('game_code', 'Unfortunately, that game code does not exist.')
 
         return game_code
@@ -72,6 +87,3 @@ class BootPlayerForm(Form):
 
     def clean_game_code(self):
         return escape(strip_tags(self.cleaned_data['game_code']))
-
-    def clean_player_pk(self):
-        return escape(strip_tags(self.cleaned_data['player_pk']))
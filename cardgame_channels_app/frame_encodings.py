@@ -0,0 +1,210 @@
+"""WebSocket frame encodings a client can ask for when it connects, e.g. ws://host/game/?encoding=msgpack
+
+JSON frames are written by FRAME_JSON_ENCODER, and each message is serialized to JSON once, shared by the JSON encodings.
+Values that never change, like cards, can carry their JSON in an EncodedValues, which is spliced into frames as is.
+
+Each group keeps a count in the cache of its connections using each encoding, so a broadcast is only encoded and
+sent for the encodings someone in the group uses. The default is always sent, since connections can also be added
+to a group directly, and a group with no counts at all, e.g. after the cache lost them, gets every encoding.
+"""
+import json
+import logging
+import uuid
+import zlib
+
+import msgpack
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.serializers.json import DjangoJSONEncoder
+
+LOGGER = logging.getLogger("cardgame_channels_app")
+DEFAULT_ENCODING = 'json'
+GROUP_ENCODINGS_TIMEOUT = 86400  # Seconds a group's encoding counts are kept after its last join, as long as the channel layer keeps group members by default
+FRAGMENT_MARKER = '\x00{}:'.format(uuid.uuid4().hex)  # Starts the placeholder for a spliced value, unguessable so player names can't mimic it
+
+_DUMPS = {}  # FRAME_JSON_ENCODER: dumps function
+
+
+class EncodedValues(dict):
+    """Read-only values that carry their own compact JSON, so every frame they go in reuses it, copy with dict() to change them"""
+
+    __slots__ = ('json',)
+
+    def __init__(self, *args, **kwargs):
+        super(EncodedValues, self).__init__(*args, **kwargs)
+        self.json = get_json_dumps()(self)
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('EncodedValues are shared and read-only, change a dict() copy')
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _read_only
+
+    def __reduce__(self):
+        """Pickles, copies and deep copies as a plain dict, since rebuilding through the read-only dict methods fails"""
+        return dict, (dict(self),)
+
+
+class JsonEncoding(object):
+    """Plain JSON text frames, what every client gets unless it asks for something else"""
+
+    name = 'json'
+
+    @staticmethod
+    def encode(content):
+        """Returns the channels message for a frame holding content"""
+        return {'text': dumps_frame(content)}
+
+    @staticmethod
+    def from_json(text):
+        """Returns the channels message for a frame holding content already serialized to JSON"""
+        return {'text': text}
+
+    @staticmethod
+    def decode(data):
+        """Returns the content of a binary frame"""
+        return json.loads(data.decode('utf8'))
+
+
+class DeflateJsonEncoding(object):
+    """JSON compressed with zlib into binary frames, readable in the browser with DecompressionStream('deflate')"""
+
+    name = 'json-deflate'
+
+    @staticmethod
+    def encode(content):
+        """Returns the channels message for a frame holding content"""
+        return DeflateJsonEncoding.from_json(dumps_frame(content))
+
+    @staticmethod
+    def from_json(text):
+        """Returns the channels message for a frame holding content already serialized to JSON"""
+        return {'bytes': zlib.compress(text.encode('utf8'))}
+
+    @staticmethod
+    def decode(data):
+        """Returns the content of a binary frame"""
+        return json.loads(zlib.decompress(data).decode('utf8'))
+
+
+class MsgpackEncoding(object):
+    """MessagePack binary frames"""
+
+    name = 'msgpack'
+    from_json = None  # Packs the content itself
+
+    @staticmethod
+    def encode(content):
+        """Returns the channels message for a frame holding content"""
+        return {'bytes': msgpack.packb(content, use_bin_type=True)}
+
+    @staticmethod
+    def decode(data):
+        """Returns the content of a binary frame"""
+        return msgpack.unpackb(data, raw=False)
+
+
+ENCODINGS = {encoding.name: encoding for encoding in (JsonEncoding, DeflateJsonEncoding, MsgpackEncoding)}
+
+
+def add_group_encoding(name, encoding):
+    """Counts a connection using encoding into group name, so the group's broadcasts are encoded for it, and keeps all the group's counts for another GROUP_ENCODINGS_TIMEOUT"""
+    key = _group_encoding_key(name, encoding)
+    cache.add(key, 0, GROUP_ENCODINGS_TIMEOUT)
+    try:
+        cache.incr(key)
+    except ValueError:  # Expired in between
+        cache.set(key, 1, GROUP_ENCODINGS_TIMEOUT)
+    touch = getattr(cache, 'touch', None)  # Django 2.1 and django-redis have it, incr keeps the expiry the key was added with
+    if touch:
+        for other_encoding in ENCODINGS:
+            touch(_group_encoding_key(name, other_encoding), GROUP_ENCODINGS_TIMEOUT)
+
+
+def discard_group_encoding(name, encoding):
+    """Counts a connection using encoding out of group name again"""
+    try:
+        cache.decr(_group_encoding_key(name, encoding))  # Left at 0 rather than deleted, which could lose a concurrent add
+    except ValueError:
+        pass  # Already expired
+
+
+def dumps_frame(content):
+    """Returns content as compact JSON, splicing in the JSON its payload data's EncodedValues carry instead of encoding them again"""
+    dumps = get_json_dumps()
+    payload = content.get('payload')
+    data = payload.get('data') if isinstance(payload, dict) else None
+    if not isinstance(data, dict):
+        return dumps(content)
+    fragments = {}
+    for key, value in data.items():  # Only lists pay back the splicing, a lone card is as quick to encode again
+        if isinstance(value, list) and value and all(isinstance(item, EncodedValues) for item in value):
+            fragments[key] = '[{}]'.format(','.join(item.json for item in value))
+    if not fragments:
+        return dumps(content)
+    placeholders = dict(data, **{key: FRAGMENT_MARKER + key for key in fragments})
+    text = dumps(dict(content, payload=dict(payload, data=placeholders)))
+    for key, fragment in fragments.items():
+        text = text.replace('"\\u0000{}{}"'.format(FRAGMENT_MARKER[1:], key), fragment, 1)  # JSON encoders all escape the marker's NUL
+    return text
+
+
+def encode_everywhere(content, encodings=None):
+    """Returns {encoding name: channels message} for content in each of encodings or all of them, serializing it to JSON just once for all the JSON encodings"""
+    text = None
+    messages = {}
+    for name in encodings or ENCODINGS:
+        encoding = ENCODINGS[name]
+        if encoding.from_json:
+            text = text or dumps_frame(content)
+            messages[name] = encoding.from_json(text)
+        else:
+            messages[name] = encoding.encode(content)
+    return messages
+
+
+def encoded_group_name(name, encoding):
+    """Returns the group that the connections in group name using encoding belong to, so each group message is encoded once"""
+    return name if encoding == DEFAULT_ENCODING else '{}.{}'.format(name, encoding)
+
+
+def get_group_encodings(names):
+    """Returns {group name: names of the encodings its connections use} for the groups, the default always among them, and every encoding for a group with no counts"""
+    keys = {_group_encoding_key(name, encoding): (name, encoding) for name in names for encoding in ENCODINGS}
+    counts = cache.get_many(list(keys))
+    counted = {keys[key][0] for key in counts}
+    group_encodings = {name: [DEFAULT_ENCODING] for name in names}
+    for key, (name, encoding) in keys.items():
+        if encoding != DEFAULT_ENCODING and (name not in counted or counts.get(key, 0) > 0):
+            group_encodings[name].append(encoding)
+    return group_encodings
+
+
+def get_json_dumps():
+    """Returns FRAME_JSON_ENCODER's function from content to compact JSON text, falling back to the json module if it isn't installed"""
+    name = getattr(settings, 'FRAME_JSON_ENCODER', 'json')
+    if name not in _DUMPS:
+        try:
+            _DUMPS[name] = _load_dumps(name)
+        except ImportError:
+            LOGGER.warning('FRAME_JSON_ENCODER %s is not installed, encoding frames with json', name)
+            _DUMPS[name] = _load_dumps('json')
+    return _DUMPS[name]
+
+
+def _load_dumps(name):
+    """Returns the dumps function for a FRAME_JSON_ENCODER, importing its library"""
+    default = DjangoJSONEncoder().default  # For dates, decimals and the like, as the json module encodes them
+    if name == 'json':
+        return json.JSONEncoder(default=default, separators=(',', ':')).encode
+    if name == 'orjson':
+        import orjson
+        return lambda content: orjson.dumps(content, default=default).decode('utf8')
+    if name == 'ujson':
+        import ujson
+        return lambda content: ujson.dumps(content, default=default)
+    raise ImproperlyConfigured('FRAME_JSON_ENCODER must be json, orjson or ujson, not {}'.format(name))
+
+
+def _group_encoding_key(name, encoding):
+    return 'group-encodings:{}:{}'.format(name, encoding)
@@ -0,0 +1,152 @@
+"""Routes each game's messages to one worker, picked by rendezvous hashing of the game code over the live game workers
+
+Workers started with rungameworker register in the cache, which must be shared between all processes (the
+docker-compose settings use Redis), and listen on a channel of their own. With GAME_AFFINITY on, GameDemultiplexer
+forwards a frame about a game to the worker that owns it, so one single-threaded worker sees all of a game's moves in
+order and can keep the game in a LocalStateStore. When workers join or leave only the games whose owner changed move.
+
+A worker holding a game in its store also holds the game's handover lease in the cache. The new owner of a game
+forwards its frames on to the lease's holder until the holder, after its next message, writes the game out, drops it
+and releases the lease, so the game is never loaded while another worker still has changes to it. Each worker also
+writes out its games' queued changes every time its heartbeat nudges it, which bounds what a crash can lose.
+"""
+import hashlib
+import os
+import re
+import socket
+import time
+
+from channels import Channel
+from django.conf import settings
+from django.core.cache import cache
+from django.dispatch import Signal, receiver
+
+from .game_logic import apply_game_writes
+from .state_store import LocalStateStore, get_state_store
+from .worker_registry import WorkerRegistry
+
+WORKER_CHANNEL_PREFIX = 'game.worker.'
+WORKERS = WorkerRegistry('game-affinity:workers')
+
+rebalanced = Signal(providing_args=['workers'])  # Sent when a process sees the set of game workers change
+
+_STATE = {'worker': None, 'workers': (), 'loaded_at': 0.0}
+
+
+def claim_game(game_code):
+    """Takes the game's handover lease for this worker and returns its name, or returns the live worker still holding the game"""
+    worker = _STATE['worker']
+    key = _lease_key(game_code)
+    holder = cache.get(key)
+    if holder == worker:
+        return worker
+    if holder is not None and holder in get_workers():
+        return holder
+    timeout = getattr(settings, 'GAME_AFFINITY_WORKER_TIMEOUT', 15)
+    if holder is None:
+        if not cache.add(key, worker, timeout):
+            return cache.get(key) or worker  # Another worker claimed it first
+    else:
+        cache.set(key, worker, timeout)  # Its holder died, with whatever it hadn't written out
+    store = get_state_store()
+    if isinstance(store, LocalStateStore):
+        with store.lock(game_code):
+            store.delete(game_code)  # A copy loaded without the lease, e.g. for a spectator snapshot, may be stale
+    return worker
+
+
+def flush_games():
+    """Writes out the queued changes of every game this worker holds, and renews their handover leases"""
+    store = get_state_store()
+    if not isinstance(store, LocalStateStore) or not _STATE['worker']:
+        return
+    game_codes = list(store.games)
+    for game_code in game_codes:
+        with store.lock(game_code):
+            apply_game_writes(store, game_code)
+    cache.set_many({_lease_key(game_code): _STATE['worker'] for game_code in game_codes}, getattr(settings, 'GAME_AFFINITY_WORKER_TIMEOUT', 15))
+
+
+def get_owner(game_code, workers):
+    """Returns the worker with the highest hash of itself and the game code, or None if there are no workers"""
+    if not workers:
+        return None
+    return max(workers, key=lambda worker: hashlib.md5('{}:{}'.format(worker, game_code).encode('utf8')).digest())
+
+
+def get_workers():
+    """Returns the live game workers' names, rechecking the cache every GAME_AFFINITY_REFRESH seconds"""
+    if time.monotonic() - _STATE['loaded_at'] > getattr(settings, 'GAME_AFFINITY_REFRESH', 1):
+        workers = tuple(sorted(WORKERS.names()))
+        _STATE['loaded_at'] = time.monotonic()
+        if workers != _STATE['workers']:
+            _STATE['workers'] = workers
+            rebalanced.send(sender=None, workers=workers)
+    return _STATE['workers']
+
+
+def make_worker_name():
+    """Returns a name for this process that is unique among workers and valid in a channel name"""
+    return re.sub(r'[^a-zA-Z\d\-_.]', '-', '{}-{}'.format(socket.gethostname(), os.getpid()))
+
+
+def register_worker(name):
+    """Adds a worker to the game workers, or renews its registration"""
+    WORKERS.register(name, getattr(settings, 'GAME_AFFINITY_WORKER_TIMEOUT', 15))
+
+
+def request_rebalance(name, channel_layer):
+    """Asks a worker to check for workers joining or leaving and write out its games between two of its messages, see receive_forwarded"""
+    Channel(WORKER_CHANNEL_PREFIX + name, channel_layer=channel_layer).send({'rebalance': True}, immediately=True)
+
+
+def route_message(message, game_code):
+    """Forwards a frame to the worker that owns its game, or still holds it, and returns True, or returns False to handle it here"""
+    if not game_code or not getattr(settings, 'GAME_AFFINITY', False):
+        return False
+    worker = _STATE['worker']
+    if not message.content.get('game_worker'):
+        owner = get_owner(game_code, get_workers())
+        if owner is not None and owner != worker:
+            _forward(message, owner)
+            return True
+    if worker and isinstance(get_state_store(), LocalStateStore):
+        holder = claim_game(game_code)
+        if holder != worker:
+            _forward(message, holder)
+            return True
+    return False
+
+
+def set_worker(name):
+    """Makes this process the game worker with the name, or no game worker"""
+    _STATE['worker'] = name
+
+
+def unregister_worker(name):
+    """Takes a worker out of the game workers"""
+    WORKERS.unregister(name)
+
+
+@receiver(rebalanced)
+def hand_off_games(workers, **kwargs):
+    """Writes out and drops the stored games this worker doesn't own, releasing their leases so their owner loads them fresh"""
+    store = get_state_store()
+    worker = _STATE['worker']
+    if not isinstance(store, LocalStateStore) or not worker:
+        return
+    for game_code in list(store.games):
+        if get_owner(game_code, workers) != worker:
+            with store.lock(game_code):
+                apply_game_writes(store, game_code)
+                store.delete(game_code)
+            if cache.get(_lease_key(game_code)) == worker:
+                cache.delete(_lease_key(game_code))
+
+
+def _forward(message, worker):
+    Channel(WORKER_CHANNEL_PREFIX + worker, channel_layer=message.channel_layer).send(dict(message.content, game_worker=worker), immediately=True)
+
+
+def _lease_key(game_code):
+    return 'game-affinity:lease:{}'.format(game_code)
@@ -0,0 +1,99 @@
+"""Pool of free game codes, so creating a game takes the next code instead of guessing until an insert succeeds
+
+Keep the pool topped up with manage.py game_code_pool --keep, so games are created without refilling it. A refill on
+the request path only samples as many codes as it adds, and two concurrent refills that pick the same code just
+leave the other's codes to be taken.
+"""
+import itertools
+import logging
+import random
+import string
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from .models import Game, GameCode
+
+LOGGER = logging.getLogger("cardgame_channels_app")
+CODE_CHARS = string.ascii_lowercase
+CODE_LENGTH = 4
+CODE_SPACE = len(CODE_CHARS) ** CODE_LENGTH
+ALLOCATE_ATTEMPTS = 3  # Tries at refilling an empty pool before giving up
+SAMPLE_ATTEMPTS = 3  # Rounds of random codes tried before a refill lists every free code instead
+LOOKUP_CHUNK = 500  # Codes checked per query, within every database's parameter limit
+
+
+class GameCodesExhausted(Exception):
+    """Every game code is in use"""
+
+
+def allocate_game_code():
+    """Takes the next code out of the pool, refilling the pool first if it is empty"""
+    for _ in range(ALLOCATE_ATTEMPTS):
+        with transaction.atomic():
+            game_code = GameCode.objects.select_for_update(skip_locked=True).first()  # Concurrent allocators each skip to a different code
+            if game_code:
+                game_code.delete()
+                return game_code.code
+        fill_game_code_pool(getattr(settings, 'GAME_CODE_POOL_BATCH', 1000))
+    raise GameCodesExhausted('All {} game codes are in use'.format(CODE_SPACE))
+
+
+def fill_game_code_pool(count=None):
+    """Adds up to count (or all) codes that are neither in use nor already pooled, in random order, and returns how many"""
+    free_codes = _sample_free_codes(count) if count is not None else None
+    if free_codes is None:  # Every code, or too few left to find by sampling
+        taken = set(Game.objects.values_list('code', flat=True)).union(GameCode.objects.values_list('code', flat=True))
+        free_codes = [code for code in (''.join(chars) for chars in itertools.product(CODE_CHARS, repeat=CODE_LENGTH)) if code not in taken]
+        free_codes = random.sample(free_codes, len(free_codes) if count is None else min(count, len(free_codes)))
+    try:
+        with transaction.atomic():
+            GameCode.objects.bulk_create([GameCode(code=code) for code in free_codes])
+    except IntegrityError:
+        return 0  # A concurrent refill pooled some of the same codes, and its codes will do
+    if count is not None and len(free_codes) < count:
+        LOGGER.warning('Only %s free game codes were left to add to the pool', len(free_codes))
+    return len(free_codes)
+
+
+def get_game_code_pool_stats():
+    """Returns how the code space splits between games, the pool and codes not yet pooled"""
+    in_use = Game.objects.count()
+    pooled = GameCode.objects.count()
+    return {'capacity': CODE_SPACE, 'in_use': in_use, 'pooled': pooled, 'unpooled': CODE_SPACE - in_use - pooled, 'occupancy': in_use / CODE_SPACE}
+
+
+@receiver(post_delete, sender=Game)
+def release_game_code(instance, **kwargs):
+    """Puts a deleted game's code back at the end of the pool, so it is the last to be handed out again"""
+    if len(instance.code) == CODE_LENGTH and set(instance.code) <= set(CODE_CHARS):
+        GameCode.objects.get_or_create(code=instance.code)
+
+
+def code_at(index):
+    """Returns the game code at index in the code space, without listing the codes before it"""
+    chars = []
+    for _ in range(CODE_LENGTH):
+        index, char_index = divmod(index, len(CODE_CHARS))
+        chars.append(CODE_CHARS[char_index])
+    return ''.join(reversed(chars))
+
+
+def _sample_free_codes(count):
+    """Returns count random free codes, looking up only the codes sampled, or None if too few free codes turn up"""
+    free_codes = []
+    for _ in range(SAMPLE_ATTEMPTS):
+        wanted = count - len(free_codes)
+        found = set(free_codes)
+        candidates = [code for code in map(code_at, random.sample(range(CODE_SPACE), min(CODE_SPACE, 2 * wanted))) if code not in found]
+        taken = set()
+        for start in range(0, len(candidates), LOOKUP_CHUNK):
+            chunk = candidates[start:start + LOOKUP_CHUNK]
+            taken.update(Game.objects.filter(code__in=chunk).values_list('code', flat=True))
+            taken.update(GameCode.objects.filter(code__in=chunk).values_list('code', flat=True))
+        free_codes.extend([code for code in candidates if code not in taken][:wanted])
+        if len(free_codes) == count:
+            return free_codes
+    return None
@@ -0,0 +1,49 @@
+"""Cached index of the game codes in use and the player names taken in each, so lobby validation rarely needs the database
+
+Kept in the default cache, which every worker must share for their indexes to agree; the docker-compose settings use
+Redis. With a process-local cache one worker keeps answering from a stale entry after another worker's change.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from .models import Game
+
+NO_GAME = False  # Cached for codes that have no game, since the cache returns None for a miss
+
+
+def add_game(game_code):
+    """Records a new game with no players"""
+    cache.set(_key(game_code), [], getattr(settings, 'GAME_INDEX_TIMEOUT', 300))
+
+
+def forget_game(game_code):
+    """Drops a game's entry, so the next lookup reloads it after its players change"""
+    cache.delete(_key(game_code))
+
+
+def game_exists(game_code):
+    """Returns whether there is a game with this code"""
+    return get_player_names(game_code) is not None
+
+
+def get_player_names(game_code):
+    """Returns the lowercased names of a game's players, or None if there is no such game"""
+    names = cache.get(_key(game_code))
+    if names is None:
+        rows = list(Game.objects.filter(code=game_code).values_list('players__name', flat=True))  # [None] for a game with no players
+        names = [name.lower() for name in rows if name] if rows else NO_GAME
+        timeout = getattr(settings, 'GAME_INDEX_TIMEOUT', 300) if rows else getattr(settings, 'GAME_INDEX_MISSING_TIMEOUT', 10)
+        cache.set(_key(game_code), names, timeout)
+    return None if names is NO_GAME else set(names)
+
+
+@receiver(post_delete, sender=Game)
+def forget_deleted_game(instance, **kwargs):
+    """Drops a deleted game's entry"""
+    forget_game(instance.code)
+
+
+def _key(game_code):
+    return 'game-index:{}'.format(game_code)
@@ -1,87 +1,341 @@
 """Card Game Logic"""
+import itertools
+import logging
+import random
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import timedelta
+
 from django.core.exceptions import ObjectDoesNotExist
-from django.db import IntegrityError
-from django.utils.crypto import get_random_string
+from django.db import IntegrityError, transaction
+from django.db.models import Case, CharField, F, IntegerField, Q, Value, When
+from django.utils import timezone
 
+from . import card_catalog, game_index
+from .game_codes import allocate_game_code
 from .models import *
+from .state_store import get_state_store
+
+LOGGER = logging.getLogger("cardgame_channels_app")
+DECK_FIELDS = ['green_deck', 'green_deck_position', 'red_deck', 'red_deck_position']
+DECK_POSITION_FIELDS = ['green_deck_position', 'red_deck_position']
+HAND_SIZE = 5  # Red cards each player holds
 
 
-def add_player_to_game(game_code, player_name):
-    """Creates a new Person object and adds to an existing game"""
-    game = Game.objects.get(code=game_code)
-    player = Player.objects.create(name=player_name, game=game)
-    draw_card(game, player, 'red', 5)
-    if not CardGamePlayer.objects.filter(game=game, status='matching'):
-        # draw green card for new player if no one is currently the judge (and make them the judge)
-        draw_card(game, player)
-        player.status = Player.JUDGE
-        player.save()
+class GameState(object):
+    """Snapshot of a game's players and cards in play, loaded with two queries so payloads can be built in memory"""
+
+    def __init__(self, game_code, game_id=None):
+        self.game_code = game_code
+        store = get_state_store()
+        if store:  # Active games are read from the state store without touching the database
+            hot_game = HotGame.get(store, game_code)
+            self.players, self.cards, self.version = hot_game.players, hot_game.cards, hot_game.version
+        else:
+            game_filter = {'game_id': game_id} if game_id else {'game__code': game_code}  # The id skips the join on code
+            self.players = list(Player.objects.filter(**game_filter).values('pk', 'name', 'status', 'score', version=F('game__state_version')))
+            self.version = self.players[0]['version'] if self.players else 0
+            for player in self.players:
+                del player['version']
+            self.cards = get_cards_in_play_values_list(game_code, game_id)
+
+    @property
+    def all_players_submitted(self):
+        """True when no player is still waiting to submit a card to the judge"""
+        return not [player for player in self.players if player.get('status') == Player.WAITING]
+
+    @property
+    def green_card(self):
+        """Values of the card being matched, or None if there isn't one"""
+        for card_pk, _, status in self.cards:
+            if status == CardGamePlayer.MATCHING:
+                return dict(card_catalog.get_card_values(card_pk), status='matching')
+        return None
+
+    @property
+    def judge(self):
+        """Values of the judge player, or None if there isn't one"""
+        return next((player for player in self.players if player.get('status') == Player.JUDGE), None)
+
+    @property
+    def submitted_cards(self):
+        """Values list of the cards submitted to the judge"""
+        return card_catalog.get_card_values_list([card_pk for card_pk, _, status in self.cards if status == CardGamePlayer.SUBMITTED])
+
+    def get_hand(self, player_pk):
+        """Values list of the cards in a player's hand"""
+        return card_catalog.get_card_values_list([card_pk for card_pk, card_player_pk, status in self.cards if card_player_pk == player_pk and status == CardGamePlayer.HAND])
+
+    def get_player(self, player_pk):
+        """Values of a player in the game, or None if they aren't in it"""
+        return next((player for player in self.players if player.get('pk') == player_pk), None)
+
+
+class HotGame(object):
+    """A game's live state held in the state store, so turns can be played against it and written to the database later"""
+
+    def __init__(self, store, game_code, state):
+        self.store = store
+        self.game_code = game_code
+        self.game = Game(pk=state['game_id'], code=game_code, **{field: state[field] for field in DECK_FIELDS})
+        self.players = state['players']
+        self.cards = state['cards']  # [card_pk, player_pk, status] for each card in play
+        self.version = state['state_version']
+
+    @classmethod
+    def get(cls, store, game_code):
+        """Returns the game from the store, locking it to load it from the database if it isn't there yet"""
+        state = store.get(game_code)
+        if state is not None:
+            return cls(store, game_code, state)
+        with store.lock(game_code):
+            return cls.load(store, game_code)
+
+    @classmethod
+    def load(cls, store, game_code):
+        """Returns the game from the store, loading it from the database if it isn't there, for a caller holding its lock"""
+        state = store.get(game_code)
+        if state is None:
+            apply_game_writes(store, game_code)  # Writes left behind by state that expired from the store
+            game = Game.objects.get(code=game_code)
+            take_from_deck(game, Card.GREEN, 0)  # Shuffles decks for games created without them
+            take_from_deck(game, Card.RED, 0)
+            state = {field: getattr(game, field) for field in DECK_FIELDS}
+            state.update({
+                'game_id': game.pk,
+                'state_version': game.state_version,
+                'players': get_game_player_values_list(game_code),
+                'cards': [list(card) for card in get_cards_in_play_values_list(game_code)],
+            })
+            store.set(game_code, state)
+        return cls(store, game_code, state)
+
+    def get_card(self, card_pk):
+        """Returns the [card_pk, player_pk, status] entry for a card in play, or None if it isn't in play"""
+        for card in self.cards:
+            if card[0] == card_pk:
+                return card
+        return None
+
+    def pick_card(self, card_pk):
+        """Same as pick_card, against the stored state"""
+        picked_card = self.get_card(card_pk)
+        if picked_card is None or picked_card[2] != CardGamePlayer.SUBMITTED:
+            return None
+        winner_pk = picked_card[1]
+
+        # Green card, picked card and losing cards all leave play
+        self.cards = [card for card in self.cards if card[2] == CardGamePlayer.HAND]
+        for player in self.players:
+            if player['pk'] == winner_pk:
+                player['status'] = Player.JUDGE
+                player['score'] += 1
+            else:
+                player['status'] = Player.WAITING
+
+        hand_sizes = [(player['pk'], len([card for card in self.cards if card[1] == player['pk']])) for player in self.players]
+        new_cards = [[cgp.card_id, cgp.player_id, cgp.status] for cgp in deal_hands(self.game, hand_sizes)]
+        new_cards.extend([green_card_pk, winner_pk, CardGamePlayer.MATCHING] for green_card_pk in take_from_deck(self.game, Card.GREEN, 1))
+        self.cards.extend(new_cards)
+        self.save({
+            'action': 'pick_card', 'card_pk': card_pk, 'player_pk': winner_pk, 'new_cards': new_cards,
+            'green_deck_position': self.game.green_deck_position, 'red_deck_position': self.game.red_deck_position,
+        })
+        return CardGamePlayer(card_id=card_pk, game_id=self.game.pk, player_id=winner_pk, status=CardGamePlayer.PICKED)
+
+    def save(self, write):
+        """Stores the changed state and queues the write that brings the database up to date with it"""
+        self.version += 1  # Each queued write bumps the database's state_version once when it is applied
+        state = {field: getattr(self.game, field) for field in DECK_FIELDS}
+        state.update({'game_id': self.game.pk, 'state_version': self.version, 'players': self.players, 'cards': self.cards})
+        self.store.set(self.game_code, state)
+        self.store.push_write(self.game_code, write)
+
+    def submit_card(self, card_pk, player_id=None):
+        """Same as submit_card, against the stored state"""
+        card = self.get_card(card_pk)
+        if card is None or card[2] != CardGamePlayer.HAND or (player_id and card[1] != player_id):
+            return None
+        card[2] = CardGamePlayer.SUBMITTED
+        for player in self.players:
+            if player['pk'] == card[1]:
+                player['status'] = Player.SUBMITTED
+        self.save({'action': 'submit_card', 'card_pk': card_pk, 'player_pk': card[1]})
+        return CardGamePlayer(card_id=card_pk, game_id=self.game.pk, player_id=card[1], status=CardGamePlayer.SUBMITTED)
+
+
+def add_player_to_game(game_code, player_name, reply_channel=''):
+    """Creates a new Person object and adds to an existing game, remembering the reply_channel of the connection they joined from"""
+    with cold_game(game_code):
+        game = Game.objects.get(code=game_code)
+        player = Player.objects.create(name=player_name, game=game, reply_channel=reply_channel)
+        player.hand_size = draw_card(game, player, Card.RED, HAND_SIZE)
+        if not CardGamePlayer.objects.filter(game=game, status='matching'):
+            # draw green card for new player if no one is currently the judge (and make them the judge)
+            draw_card(game, player)
+            player.status = Player.JUDGE
+            player.save(update_fields=['status'])
+            bump_state_version(game)
+        else:
+            bump_state_version(game, waiting_player_count=F('waiting_player_count') + 1)
+    game_index.forget_game(game_code)
     return player
 
 
-def boot_player_from_game(game_code, player_pk):
-    """Returns the player_name of the booted player if they aren't the judge, False if they don't exist or are the judge"""
+def apply_game_writes(store, game_code):
+    """Applies a game's queued writes to the database for a caller holding its store lock, returning how many were applied"""
+    writes = store.get_writes(game_code)
+    if not writes:
+        return 0
     try:
-        player = Player.objects.get(pk=player_pk)
-        player_name = player.name
-        if player.status != Player.JUDGE:  # Only delete if there is still a judge left
-            player.delete()
-            return player_name
-        else:
+        with transaction.atomic():
+            game = Game.objects.select_for_update().get(code=game_code)
+            for write in writes:
+                if write['action'] == 'submit_card':
+                    record_submit(game, write['card_pk'], write['player_pk'])
+                else:
+                    game.green_deck_position = write['green_deck_position']
+                    game.red_deck_position = write['red_deck_position']
+                    new_cards = [CardGamePlayer(card_id=card_pk, game=game, player_id=player_pk, status=status) for card_pk, player_pk, status in write['new_cards']]
+                    record_pick(game, write['card_pk'], write['player_pk'], new_cards)
+    except Game.DoesNotExist:
+        LOGGER.warning('Dropping %s queued writes for deleted game %s', len(writes), game_code)
+    store.clear_writes(game_code, len(writes))
+    return len(writes)
+
+
+def boot_player_from_game(game_code, player_pk, game_id=None):
+    """Returns the player_name of the booted player if they aren't the judge, False if they don't exist or are the judge"""
+    with cold_game(game_code):
+        try:
+            player = Player.objects.get(pk=player_pk, **({'game_id': game_id} if game_id else {}))
+            player_name = player.name
+            if player.status != Player.JUDGE:  # Only delete if there is still a judge left
+                player.delete()
+                if player.game_id:
+                    bump_state_version(Game(pk=player.game_id), waiting_player_count=F('waiting_player_count') - int(player.status == Player.WAITING))
+                game_index.forget_game(game_code)
+                return player_name
+            else:
+                return False
+        except ObjectDoesNotExist:
             return False
-    except ObjectDoesNotExist:
-        return False
 
 
-def create_game_code():
-    """Create a Unique Game Code"""
-    game_code = ""
-    not_a_unique_code = True
-    while not_a_unique_code:
-        game_code = get_random_string(4, allowed_chars='abcdefghijklmnopqrstuvwxyz')
+def bump_state_version(game, changes=1, **fields):
+    """Adds the number of changes to a game's state_version and marks it active, saving any other given fields in the same statement"""
+    Game.objects.filter(pk=game.pk).update(state_version=F('state_version') + changes, date_updated=timezone.now(), **fields)
+
+
+@contextmanager
+def cold_game(game_code):
+    """Writes out and drops a game's stored state, keeping it locked while the block changes the game in the database"""
+    store = get_state_store()
+    if not store:
+        yield
+        return
+    with store.lock(game_code):
+        apply_game_writes(store, game_code)
+        store.delete(game_code)
+        yield
+
+
+def create_game_code(deck_pks=()):
+    """Create a game with the next code from the pool, drawing from the decks or from every card if there are none"""
+    green_deck = shuffle_deck(Card.GREEN, deck_pks=deck_pks)
+    red_deck = shuffle_deck(Card.RED, deck_pks=deck_pks)
+    while True:
+        game_code = allocate_game_code()
         try:
-            Game.objects.create(code=game_code)
-            not_a_unique_code = False
+            with transaction.atomic():
+                game = Game.objects.create(code=game_code, green_deck=green_deck, red_deck=red_deck)
+                if deck_pks:
+                    game.decks.add(*deck_pks)
+            break
         except IntegrityError:  # pragma: nocover
-            not_a_unique_code = True
+            pass  # Code was used outside the pool, e.g. in the admin, so it stays out of the pool
+    if get_state_store():
+        get_state_store().delete(game_code)  # In case a deleted game with this code was still stored
+    game_index.add_game(game_code)
     return game_code
 
 
+def deal_from_deck(game, color=Card.GREEN, count=1):
+    """Locks the game and takes the next count card pks off of its shuffled deck"""
+    with transaction.atomic():
+        locked_game = Game.objects.select_for_update().get(pk=game.pk)
+        card_pks = take_from_deck(locked_game, color, count)
+        if card_pks:
+            locked_game.save(update_fields=DECK_POSITION_FIELDS)
+    return card_pks
+
+
+def deal_hands(game, hand_sizes=None):
+    """Returns unsaved CardGamePlayers that fill every player's hand, for a game the caller holds locked"""
+    if hand_sizes is None:
+        hand_sizes = Player.objects.filter(game=game).values_list('pk', 'hand_size')
+    shortages = [(player_pk, HAND_SIZE - hand_size) for player_pk, hand_size in hand_sizes if hand_size < HAND_SIZE]
+    card_pks = iter(take_from_deck(game, Card.RED, sum(shortage for _, shortage in shortages)))
+    return [
+        CardGamePlayer(card_id=card_pk, game=game, player_id=player_pk, status=CardGamePlayer.HAND)
+        for player_pk, shortage in shortages
+        for card_pk in itertools.islice(card_pks, shortage)
+    ]
+
+
 def draw_card(game, player=None, color=Card.GREEN, count=1):
-    """Draws a random card that has not been used already"""
+    """Draws the next cards off of the game's shuffled deck, which never repeats a card, and returns how many were drawn"""
     if color == Card.GREEN:
         status = CardGamePlayer.MATCHING
     else:
         status = CardGamePlayer.HAND
-    draw_again = True
-    while draw_again:
-        draw_again = False
-        used_cards = CardGamePlayer.objects.filter(game=game).values_list('card__id', flat=True)
-        cards = Card.objects.exclude(id__in=used_cards).filter(type=color).order_by('?')[:count]
-        for card in cards:
-            try:
-                CardGamePlayer.objects.create(
-                    card=card,
-                    game=game,
-                    player=player,
-                    status=status
-                )
-            except IntegrityError:  # pragma: nocover
-                draw_again = True  # Try Again
+    new_cards = CardGamePlayer.objects.bulk_create([
+        CardGamePlayer(card_id=card_pk, game=game, player=player, status=status)
+        for card_pk in deal_from_deck(game, color, count)
+    ])
+    if player and status == CardGamePlayer.HAND and new_cards:
+        Player.objects.filter(pk=player.pk).update(hand_size=F('hand_size') + len(new_cards))
+    return len(new_cards)
+
+
+def evict_absent_players(timeout_seconds, grace_seconds=0):
+    """Deletes non-judge players whose connection closed over grace_seconds ago or who sent nothing for timeout_seconds, yielding the game_code, game_id, [(pk, name, reply_channel)] evicted and resulting version of each game"""
+    now = timezone.now()
+    absent = Player.objects.filter(game__isnull=False).exclude(status=Player.JUDGE).filter(
+        Q(connected=False, last_seen__lt=now - timedelta(seconds=grace_seconds)) | Q(last_seen__lt=now - timedelta(seconds=timeout_seconds)))  # Disconnecting stamps last_seen
+    games = {}
+    for game_code, game_id, player_pk in absent.values_list('game__code', 'game_id', 'pk'):
+        games.setdefault((game_code, game_id), []).append(player_pk)
+    for (game_code, game_id), player_pks in games.items():
+        with cold_game(game_code), transaction.atomic():
+            version = Game.objects.select_for_update().filter(pk=game_id).values_list('state_version', flat=True).first()  # Holds off other changes until the versions are handed out
+            players = list(Player.objects.filter(pk__in=player_pks, game_id=game_id).exclude(status=Player.JUDGE).values_list('pk', 'name', 'reply_channel', 'status'))  # One may have been picked as judge since
+            if version is None or not players:
+                continue
+            CardGamePlayer.objects.filter(player_id__in=[pk for pk, _, _, _ in players]).delete()
+            Player.objects.filter(pk__in=[pk for pk, _, _, _ in players]).delete()
+            bump_state_version(Game(pk=game_id), len(players), waiting_player_count=F('waiting_player_count') - sum(status == Player.WAITING for _, _, _, status in players))
+        game_index.forget_game(game_code)
+        yield {'game_code': game_code, 'game_id': game_id, 'players': [(pk, name, reply_channel) for pk, name, reply_channel, _ in players], 'version': version + len(players)}
 
 
 def get_all_players_submitted(game_code):
     """Returns true or false that all the players have submitted their cards to the judge"""
-    try:
-        waiting_players = Player.objects.filter(game__code=game_code, status=Player.WAITING)
-        return False if waiting_players else True
-    except ObjectDoesNotExist:  # pragma: nocover
-        return True
+    return not Game.objects.filter(code=game_code, waiting_player_count__gt=0).exists()
 
 
 def get_cards_in_hand_values_list(player):
     """Gets all the cards in a players's hand and return as a values list"""
-    return list(Card.objects.filter(cardgameplayer__player=player, cardgameplayer__status=CardGamePlayer.HAND).values('pk', 'name', 'text'))
+    return card_catalog.get_card_values_list(CardGamePlayer.objects.filter(player=player, status=CardGamePlayer.HAND).values_list('card_id', flat=True))
+
+
+def get_cards_in_play_values_list(game_code, game_id=None):
+    """Gets the card pk, player pk and status of every card in play in a game_code, filtering on game_id instead when given"""
+    game_filter = {'game_id': game_id} if game_id else {'game__code': game_code}
+    return list(CardGamePlayer.objects.filter(
+        status__in=[CardGamePlayer.HAND, CardGamePlayer.SUBMITTED, CardGamePlayer.MATCHING], **game_filter
+    ).order_by().values_list('card_id', 'player_id', 'status'))
 
 
 def get_game_player_values_list(game_code):
@@ -96,9 +350,7 @@ def get_judge_player_values(game_code):
 
 def get_matching_card_values(game_code):
     """Gets the matching card for a game_code and return as values"""
-    card = Card.objects.values('pk', 'name', 'text').get(cardgameplayer__game__code=game_code, cardgameplayer__status=CardGamePlayer.MATCHING)
-    card['status'] = 'matching'
-    return card
+    return dict(card_catalog.get_card_values(CardGamePlayer.objects.values_list('card_id', flat=True).get(game__code=game_code, status=CardGamePlayer.MATCHING)), status='matching')
 
 
 def get_player_values(player_pk):
@@ -106,60 +358,154 @@ def get_player_values(player_pk):
     return Player.objects.values('pk', 'name', 'status', 'score').get(pk=player_pk)
 
 
-def get_card_values(game_code, card):
+def get_card_values(card_pk):
     """Gets a values version of a card"""
-    return Card.objects.values('pk', 'name', 'text').get(pk=card.pk, cardgameplayer__game__code=game_code)
+    return card_catalog.get_card_values(card_pk)
 
 
 def get_submitted_cards_values_list(game_code):
     """Gets all the submitted cards for a game_code and return as a values list"""
-    return list(Card.objects.filter(cardgameplayer__game__code=game_code, cardgameplayer__status=CardGamePlayer.SUBMITTED).values('pk', 'name', 'text'))
+    return card_catalog.get_card_values_list(CardGamePlayer.objects.filter(game__code=game_code, status=CardGamePlayer.SUBMITTED).values_list('card_id', flat=True))
 
 
-def pick_card(game_code, card_pk):
-    """Marks a CardGamePlayer as picked by the Judge"""
-    game = Game.objects.get(code=game_code)
+def hand_size_after_deal(new_cards):
+    """Returns an expression for Player.hand_size that adds each player's newly dealt hand cards"""
+    dealt = Counter(cgp.player_id for cgp in new_cards if cgp.status == CardGamePlayer.HAND)
+    return Case(*[When(pk=player_pk, then=F('hand_size') + count) for player_pk, count in dealt.items()], default=F('hand_size'), output_field=IntegerField())
 
-    # Assign Picked Card as Winnings
-    green_card = CardGamePlayer.objects.get(game=game, status=CardGamePlayer.MATCHING)
-    green_card.status = CardGamePlayer.WON
-    green_card.save()
 
-    # Set everyone back to being a player
-    Player.objects.filter(game=game).update(status=Player.WAITING)
+def mark_player_seen(player_pk, connected=True):
+    """Records that a player was just heard from, and whether their connection is still open"""
+    Player.objects.filter(pk=player_pk).update(last_seen=timezone.now(), connected=connected)
 
-    # Put the card that was picked into the backlog, and assign winner as judge
-    cgp = CardGamePlayer.objects.get(game=game, card__pk=card_pk)
-    cgp.status = CardGamePlayer.PICKED
-    cgp.save()
 
-    cgp.player.score += 1
-    cgp.player.status = Player.JUDGE
-    cgp.player.save()
+def pick_card(game_code, card_pk, game_id=None):
+    """Marks a submitted CardGamePlayer as picked by the Judge and deals the next round, returning None if it isn't submitted"""
+    store = get_state_store()
+    if store:
+        with store.lock(game_code):
+            return HotGame.load(store, game_code).pick_card(card_pk)
 
-    # Mark non-winning cards as losers
-    CardGamePlayer.objects.filter(game=cgp.game, status=CardGamePlayer.SUBMITTED).update(status=CardGamePlayer.LOST)
+    with transaction.atomic():
+        game = Game.objects.select_for_update().get(**({'pk': game_id} if game_id else {'code': game_code}))  # Serializes turns for this game
+        cgp = CardGamePlayer.objects.filter(game=game, card_id=card_pk).first()
+        if cgp is None or cgp.status != CardGamePlayer.SUBMITTED:
+            return None  # Already picked and archived by a duplicate message, or never submitted
 
-    replenish_hands(cgp.game.code)
-    draw_card(game=cgp.game, player=cgp.player)  # New Green Card to Picked Player
+        # Refill hands and give the winner the new green card
+        new_cards = deal_hands(game)
+        new_cards.extend(
+            CardGamePlayer(card_id=green_card_pk, game=game, player_id=cgp.player_id, status=CardGamePlayer.MATCHING)
+            for green_card_pk in take_from_deck(game, Card.GREEN, 1)
+        )
+        record_pick(game, card_pk, cgp.player_id, new_cards)
+    cgp.status = CardGamePlayer.PICKED
     return cgp
 
 
+def reap_idle_games(idle_seconds, batch_size=100):
+    """Deletes games untouched for idle_seconds a batch per transaction, yielding the rows and seconds each batch took"""
+    store = get_state_store()
+    while True:
+        started = time.monotonic()
+        dirty_game_codes = store.dirty_game_codes() if store else []  # Turns played since the last flush haven't reached date_updated yet
+        with transaction.atomic():
+            games = list(Game.objects.select_for_update(skip_locked=True).filter(date_updated__lt=timezone.now() - timedelta(seconds=idle_seconds)).exclude(code__in=dirty_game_codes).order_by('date_updated').values_list('pk', 'code')[:batch_size])
+            if not games:
+                return
+            game_pks = [game_pk for game_pk, _ in games]
+            cards = CardGamePlayer.objects.filter(game_id__in=game_pks).delete()[0]
+            Round.objects.filter(game_id__in=game_pks).delete()
+            players = Player.objects.filter(game_id__in=game_pks).delete()[0]
+            Game.objects.filter(pk__in=game_pks).delete()
+        if store:
+            for _, game_code in games:
+                store.delete(game_code)
+        yield {'games': len(games), 'players': players, 'cards': cards, 'seconds': time.monotonic() - started}
+
+
+def record_pick(game, card_pk, winner_pk, new_cards):
+    """Writes a pick to the database with a fixed number of statements, for a game the caller holds locked"""
+    # Green card and submitted cards leave play, archived as one Round so CardGamePlayer only holds the cards in play
+    finished_cgps = CardGamePlayer.objects.filter(game=game, status__in=[CardGamePlayer.MATCHING, CardGamePlayer.SUBMITTED])
+    finished_cards = sorted(finished_cgps.values_list('card_id', 'player_id', 'status'))
+    green_card_pk, judge_pk = next(((card_id, player_id) for card_id, player_id, status in finished_cards if status == CardGamePlayer.MATCHING), (None, None))
+    game.round += 1
+    Round.objects.create(
+        game=game, number=game.round, judge_id=judge_pk, winner_id=winner_pk, green_card_id=green_card_pk, picked_card_id=card_pk,
+        submitted_cards=','.join(str(card_id) for card_id, _, status in finished_cards if status == CardGamePlayer.SUBMITTED),
+    )
+    finished_cgps.delete()
+
+    # Winner scores and becomes the judge, everyone else goes back to being a player with a full hand
+    player_count = Player.objects.filter(game=game).update(
+        status=Case(When(pk=winner_pk, then=Value(Player.JUDGE)), default=Value(Player.WAITING), output_field=CharField()),
+        score=Case(When(pk=winner_pk, then=F('score') + 1), default=F('score'), output_field=IntegerField()),
+        hand_size=hand_size_after_deal(new_cards),
+    )
+
+    # New hands and green card in one insert
+    CardGamePlayer.objects.bulk_create(new_cards)
+    bump_state_version(game, round=game.round, waiting_player_count=max(player_count - 1, 0), **{field: getattr(game, field) for field in DECK_POSITION_FIELDS})
+
+
+def record_submit(game, card_pk, player_pk):
+    """Writes a submitted card to the database, for a game the caller holds locked"""
+    CardGamePlayer.objects.filter(game=game, card_id=card_pk).update(status=CardGamePlayer.SUBMITTED)
+    was_waiting = Player.objects.filter(pk=player_pk, status=Player.WAITING).update(status=Player.SUBMITTED, hand_size=F('hand_size') - 1)
+    if not was_waiting:  # Only the first card a player submits in a round counts towards everyone having submitted
+        Player.objects.filter(pk=player_pk).update(status=Player.SUBMITTED, hand_size=F('hand_size') - 1)
+    bump_state_version(game, waiting_player_count=F('waiting_player_count') - was_waiting)
+
+
 def replenish_hands(game_code):
-    """Replenishes the hands of all players in the game"""
-    game = Game.objects.get(code=game_code)
-    for player in game.players.all():
-        hand_card_count = player.cardgameplayer_set.filter(status='hand').count()
-        if hand_card_count < 5:
-            draw_card(game, player, color='red', count=(5 - hand_card_count))
-
-
-def submit_card(game_code, card_pk):
-    """Submits a CardGamePlayer to the Judge"""
-    game = Game.objects.get(code=game_code)
-    cgp = CardGamePlayer.objects.get(game=game, card__pk=card_pk)
+    """Replenishes the hands of all players in the game, dealing all the needed cards with one insert"""
+    with cold_game(game_code), transaction.atomic():
+        game = Game.objects.select_for_update().get(code=game_code)
+        new_cards = deal_hands(game)
+        if new_cards:
+            CardGamePlayer.objects.bulk_create(new_cards)
+            Player.objects.filter(game=game).update(hand_size=hand_size_after_deal(new_cards))
+            game.save(update_fields=DECK_POSITION_FIELDS)
+
+
+def shuffle_deck(color, exclude_card_pks=(), deck_pks=()):
+    """Shuffles the cards of a color, in the decks if any are given, into a comma separated string of card pks"""
+    if deck_pks:  # Read off the deck memberships, never touching cards outside the decks
+        card_pks = list(set(DeckCard.objects.filter(deck_id__in=deck_pks, type=color).exclude(card_id__in=exclude_card_pks).values_list('card_id', flat=True)))
+    else:
+        card_pks = list(Card.objects.filter(type=color).exclude(pk__in=exclude_card_pks).values_list('pk', flat=True))
+    random.shuffle(card_pks)
+    return ','.join(str(card_pk) for card_pk in card_pks)
+
+
+def submit_card(game_code, card_pk, game_id=None, player_id=None):
+    """Submits a CardGamePlayer in a player's hand to the Judge, returning None if it isn't in their hand"""
+    store = get_state_store()
+    if store:
+        with store.lock(game_code):
+            return HotGame.load(store, game_code).submit_card(card_pk, player_id)
+
+    with transaction.atomic():
+        game = Game.objects.select_for_update().only('pk').get(**({'pk': game_id} if game_id else {'code': game_code}))  # Serializes turns for this game
+        cgp = CardGamePlayer.objects.filter(game=game, card_id=card_pk).first()
+        if cgp is None or cgp.status != CardGamePlayer.HAND or (player_id and cgp.player_id != player_id):
+            return None  # Already submitted by a duplicate message, not playable, or in someone else's hand
+        record_submit(game, card_pk, cgp.player_id)
     cgp.status = CardGamePlayer.SUBMITTED
-    cgp.save()
-    cgp.player.status = Player.SUBMITTED
-    cgp.player.save()
     return cgp
+
+
+def take_from_deck(game, color=Card.GREEN, count=1):
+    """Takes the next count card pks off of a locked game's deck in memory, shuffling one first if the game has none"""
+    deck_field = '{}_deck'.format(color)
+    position_field = '{}_deck_position'.format(color)
+    deck = getattr(game, deck_field)
+    position = getattr(game, position_field)
+    if not deck and not position:  # Game was created without decks, so shuffle what it hasn't used yet
+        deck = shuffle_deck(color, CardGamePlayer.objects.filter(game=game).values_list('card_id', flat=True), game.decks.values_list('pk', flat=True))
+        setattr(game, deck_field, deck)
+        Game.objects.filter(pk=game.pk).update(**{deck_field: deck})
+    card_pks = [int(card_pk) for card_pk in deck.split(',')[position:position + count] if card_pk]
+    setattr(game, position_field, position + len(card_pks))
+    return card_pks
@@ -0,0 +1,87 @@
+"""Compares the size and CPU cost of each WebSocket frame encoding"""
+
+import json
+import os
+import random
+import time
+import timeit
+
+import msgpack
+import msgpack.fallback
+from django.core.management.base import BaseCommand
+from cardgame_channels_app.frame_encodings import ENCODINGS, EncodedValues, JsonEncoding, encode_everywhere
+
+FIXTURE = os.path.join(os.path.dirname(__file__), '..', '..', 'fixtures', 'initial.json')
+
+
+class Command(BaseCommand):
+    """
+        Compares the size and CPU cost of each WebSocket frame encoding
+    """
+    help = "Prints bytes on the wire and encode/decode time per frame for typical join_game, pick_card and new_cards payloads, and the CPU spent encoding every broadcast of a round"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--players', type=int, default=8, help='Players in the benchmark game')
+        parser.add_argument('--number', type=int, default=2000, help='Times to encode and decode each frame')
+
+    def handle(self, **options):
+        """Prints one line per payload and encoding"""
+        frames = build_frames(options['players'])
+        if msgpack.Packer is msgpack.fallback.Packer:
+            self.stdout.write('msgpack is running without its C extension, its times will be much slower than in production\n')
+        self.stdout.write('{:<12} {:<14} {:>8} {:>7} {:>11} {:>11}\n'.format('payload', 'encoding', 'bytes', 'ratio', 'encode us', 'decode us'))
+        for stream, content in frames:
+            json_size = len(frame_data(JsonEncoding.encode(content)))
+            for encoding in ENCODINGS.values():
+                data = frame_data(encoding.encode(content))
+                encode_time = timeit.timeit(lambda: encoding.encode(content), number=options['number'])
+                decode_time = timeit.timeit(lambda: encoding.decode(data), number=options['number'])
+                self.stdout.write('{:<12} {:<14} {:>8} {:>7.2f} {:>11.1f} {:>11.1f}\n'.format(
+                    stream, encoding.name, len(data), len(data) / json_size, encode_time / options['number'] * 1e6, decode_time / options['number'] * 1e6))
+
+        rounds = max(1, options['number'] // 10)
+        started = time.process_time()
+        for _ in range(rounds):
+            encode_round(dict(frames))
+        self.stdout.write('Encoding a round of broadcasts for every encoding takes {:.0f}us of CPU\n'.format((time.process_time() - started) / rounds * 1e6))
+
+
+def build_frames(player_count):
+    """Returns (stream, content) pairs shaped like the consumers' messages for a game with real card data"""
+    random.seed(0)
+    with open(FIXTURE) as fixture:
+        cards = [dict(record['fields'], pk=record['pk']) for record in json.load(fixture) if record['model'] == 'cardgame_channels_app.card']
+    green_cards = [EncodedValues(pk=card['pk'], name=card['name'], text=card['text']) for card in cards if card['type'] == 'green']  # As card_catalog hands them out
+    red_cards = [EncodedValues(pk=card['pk'], name=card['name'], text=card['text']) for card in cards if card['type'] == 'red']
+
+    players = [{'pk': pk, 'name': 'player{}'.format(pk), 'status': 'submitted', 'score': random.randint(0, 5)} for pk in range(1, player_count + 1)]
+    players[0]['status'] = 'judge'
+    hand = random.sample(red_cards, 5)
+    submitted_cards = random.sample(red_cards, player_count - 1)
+    green_card = dict(random.choice(green_cards), status='matching')
+    version = 42
+
+    join_game = {'game_code': 'abcd', 'version': version, 'player': players[-1], 'players': players, 'player_cards': hand, 'green_card': [green_card], 'submitted_cards': submitted_cards, 'all_players_submitted': True, 'judge': players[0]}
+    pick_card = {'game_code': 'abcd', 'version': version, 'picked_player': players[1], 'card': submitted_cards[0]}
+    new_cards = {'game_code': 'abcd', 'version': version, 'judge': players[1], 'green_card': [green_card], 'cards': hand}
+    return [(stream, {'stream': stream, 'payload': {'data': data}}) for stream, data in (('join_game', join_game), ('pick_card', pick_card), ('new_cards', new_cards))]
+
+
+def encode_round(frames):
+    """Encodes the group messages of a round in every encoding, as the consumers would for groups with a connection using each: each player's submit_card and card_was_submitted, then pick_card and everyone's new_cards"""
+    join_game = frames['join_game']['payload']['data']
+    for player in join_game['players'][1:]:
+        encode_for_groups('submit_card', [('player_{}'.format(player['pk']), {'data': {'game_code': 'abcd', 'cards': join_game['player_cards']}})])
+        encode_for_groups('card_was_submitted', [('abcd', {'data': {'game_code': 'abcd', 'version': 42, 'submitting_player': player, 'card': join_game['player_cards'][0], 'all_players_submitted': False}})])
+    encode_for_groups('pick_card', [('abcd', frames['pick_card']['payload'])])
+    encode_for_groups('new_cards', [('player_{}'.format(player['pk']), frames['new_cards']['payload']) for player in join_game['players']])
+
+
+def encode_for_groups(stream, group_payloads):
+    """Encodes each payload in every encoding, as GameMultiplexer.encode_for_groups does for a group with a connection using each"""
+    return [encode_everywhere({'stream': stream, 'payload': payload}) for _, payload in group_payloads]
+
+
+def frame_data(message):
+    """Returns the bytes a channels message puts on the wire"""
+    return message['bytes'] if 'bytes' in message else message['text'].encode('utf8')
@@ -0,0 +1,59 @@
+"""Measures how long the round-end new_cards fan-out takes to publish as the player count grows"""
+
+import statistics
+import time
+import uuid
+
+from channels import DEFAULT_CHANNEL_LAYER, channel_layers
+from django.core.management.base import BaseCommand
+from cardgame_channels_app.frame_encodings import JsonEncoding
+from cardgame_channels_app.management.commands.benchmark_frame_encodings import build_frames
+
+
+class Command(BaseCommand):
+    """
+        Measures how long the round-end new_cards fan-out takes to publish as the player count grows
+    """
+    help = "Publishes a new_cards message to each player's group through the channel layer, one send_group per player and as one send_group_many batch, and prints the median and slowest time per round at each game size"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--players', type=int, nargs='+', default=[3, 8, 20, 50], help='Game sizes to fan out to')
+        parser.add_argument('--repeat', type=int, default=20, help='Rounds published at each game size')
+        parser.add_argument('--layer', default=DEFAULT_CHANNEL_LAYER, help='Channel layer alias to publish through')
+
+    def handle(self, **options):
+        """Prints one line per game size"""
+        channel_layer = channel_layers[options['layer']]
+        batching = 'send_group_many' in getattr(channel_layer, 'extensions', [])
+        if not batching:
+            self.stdout.write('The channel layer has no send_group_many, so only one send_group per player is measured\n')
+        self.stdout.write('{:>8} {:>16} {:>16} {:>16} {:>16}\n'.format('players', 'send_group ms', 'slowest ms', 'send_group_many ms', 'slowest ms'))
+        for player_count in options['players']:
+            content = dict(build_frames(player_count))['new_cards']
+            one_by_one, batched = [], []
+            for _ in range(options['repeat']):
+                one_by_one.append(time_fan_out(channel_layer, player_count, content, batch=False))
+                if batching:
+                    batched.append(time_fan_out(channel_layer, player_count, content, batch=True))
+            self.stdout.write('{:>8} {:>16.2f} {:>16.2f} {:>16} {:>16}\n'.format(
+                player_count, statistics.median(one_by_one), max(one_by_one),
+                '{:.2f}'.format(statistics.median(batched)) if batched else '-', '{:.2f}'.format(max(batched)) if batched else '-'))
+
+
+def time_fan_out(channel_layer, player_count, content, batch):
+    """Returns the milliseconds taken to publish content to player_count fresh one-channel groups"""
+    token = uuid.uuid4().hex
+    groups = [('benchmark-group-sends-{}-{}'.format(token, number), 'benchmark-group-sends.{}.{}'.format(token, number)) for number in range(player_count)]
+    for group, channel in groups:
+        channel_layer.group_add(group, channel)
+    group_messages = [(group, JsonEncoding.encode(content)) for group, _ in groups]
+    started = time.perf_counter()
+    if batch:
+        channel_layer.send_group_many(group_messages)
+    else:
+        for group, message in group_messages:
+            channel_layer.send_group(group, message)
+    elapsed = time.perf_counter() - started
+    for group, channel in groups:
+        channel_layer.group_discard(group, channel)  # The messages expire with the channel layer's expiry
+    return elapsed * 1000
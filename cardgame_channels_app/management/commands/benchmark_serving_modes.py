@@ -0,0 +1,167 @@
+"""Compares game latency and connections held between servers, e.g. daphne with runworker against runasyncserver"""
+
+import asyncio
+import json
+import random
+import time
+from collections import defaultdict
+
+import websockets
+from django.core.management.base import BaseCommand, CommandError
+from cardgame_channels_app.management.commands.benchmark_streams import percentile
+from cardgame_channels_app.models import Game
+
+STREAMS = ['create_game', 'join_game', 'submit_card', 'pick_card', 'boot_player']
+
+
+class Command(BaseCommand):
+    """
+        Compares game latency and connections held between servers
+    """
+    help = "For each --url, opens up to --connections idle WebSockets, then plays --games games at once, and reports connections held per server process and latency per stream"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', action='append', required=True, help='Game WebSocket URL, e.g. ws://localhost:8000/game/ for daphne and ws://localhost:8001/game/ for runasyncserver')
+        parser.add_argument('--processes', type=int, action='append', help='Server processes behind each --url (daphne plus its runworkers), 1 if not given')
+        parser.add_argument('--connections', type=int, default=1000, help='Idle connections to try to hold open')
+        parser.add_argument('--games', type=int, default=20, help='Games played at once')
+        parser.add_argument('--players', type=int, default=4, help='Players in each game')
+        parser.add_argument('--rounds', type=int, default=3, help='Rounds played in each game')
+        parser.add_argument('--timeout', type=float, default=10, help='Seconds to wait for a connection or reply')
+
+    def handle(self, **options):
+        """Benchmarks each URL in turn, then reports"""
+        processes = options['processes'] or []
+        if len(processes) > len(options['url']):
+            raise CommandError('Give at most one --processes for each --url')
+        processes += [1] * (len(options['url']) - len(processes))
+        if options['players'] < 3:
+            raise CommandError('Games need at least 3 players, so that one can be booted')
+
+        loop = asyncio.get_event_loop()
+        self.stdout.write('{:<28} {:>6} {:>11} {:<12} {:>8} {:>8} {:>7}\n'.format('url', 'held', 'per process', 'stream', 'p50 ms', 'p99 ms', 'errors'))
+        for url, process_count in zip(options['url'], processes):
+            run = ServingModeRun(url, options)
+            held = loop.run_until_complete(run.hold_connections(options['connections']))
+            loop.run_until_complete(run.play_games())
+            Game.objects.filter(code__in=run.game_codes).delete()
+            for stream in STREAMS:
+                latencies = sorted(run.latencies[stream])
+                self.stdout.write('{:<28} {:>6} {:>11.0f} {:<12} {:>8.1f} {:>8.1f} {:>7}\n'.format(
+                    url, held, held / process_count, stream, percentile(latencies, 0.5) * 1000 if latencies else 0, percentile(latencies, 0.99) * 1000 if latencies else 0, run.errors[stream]))
+
+
+class BenchmarkSocket(object):
+    """Client WebSocket that can wait for the reply to a request on a stream"""
+
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.waiting = {}  # stream: future for the data of its next message
+        self.hand = []
+        self.reader = asyncio.ensure_future(self.read())
+
+    async def read(self):
+        """Hands each message to the request waiting for its stream, and keeps the hand up to date"""
+        try:
+            async for frame in self.websocket:
+                content = json.loads(frame)
+                data = content['payload']['data']
+                if content['stream'] == 'new_cards':
+                    self.hand = [card['pk'] for card in data['cards']]
+                future = self.waiting.pop(content['stream'], None)
+                if future and not future.done():
+                    future.set_result(data)
+        except websockets.ConnectionClosed:
+            pass
+        for future in self.waiting.values():
+            if not future.done():
+                future.set_exception(ConnectionError('Closed with code {}'.format(self.websocket.close_code)))
+
+    async def request(self, stream, payload, timeout):
+        """Sends the payload on the stream and returns (data of the reply on the stream, seconds it took)"""
+        future = self.waiting[stream] = asyncio.get_event_loop().create_future()
+        started = time.perf_counter()
+        await self.websocket.send(json.dumps({'stream': stream, 'payload': payload}))
+        data = await asyncio.wait_for(future, timeout)
+        return data, time.perf_counter() - started
+
+    async def close(self):
+        """Closes the connection"""
+        await self.websocket.close()
+        await self.reader
+
+
+class ServingModeRun(object):
+    """Benchmarks the server behind one URL"""
+
+    def __init__(self, url, options):
+        self.url = url
+        self.options = options
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.game_codes = []
+
+    async def connect(self):
+        """Returns an open BenchmarkSocket, or None if the server didn't accept one in time"""
+        try:
+            return BenchmarkSocket(await asyncio.wait_for(websockets.connect(self.url), self.options['timeout']))
+        except (OSError, asyncio.TimeoutError, websockets.InvalidHandshake):
+            return None
+
+    async def hold_connections(self, count):
+        """Opens up to count connections in batches, stopping at the first batch that isn't all accepted, and returns how many were held"""
+        sockets = []
+        while len(sockets) < count:
+            batch = [socket for socket in await asyncio.gather(*[self.connect() for _ in range(min(100, count - len(sockets)))]) if socket]
+            sockets.extend(batch)
+            if len(batch) < min(100, count - len(sockets) + len(batch)):
+                break
+        await asyncio.gather(*[socket.close() for socket in sockets])
+        await asyncio.sleep(1)  # Let the server handle the disconnects before timing games
+        return len(sockets)
+
+    async def play_games(self):
+        """Plays --games games at once"""
+        await asyncio.gather(*[self.play_game() for _ in range(self.options['games'])])
+
+    async def play_game(self):
+        """Creates and fills a game, plays the rounds and boots a player, counting the first failed request as an error"""
+        sockets = await asyncio.gather(*[self.connect() for _ in range(self.options['players'])])
+        stream = 'create_game'
+        try:
+            if not all(sockets):
+                raise ConnectionError('Not accepted')
+            game_code = (await self.request(sockets[0], stream, {}))['game_code']
+            self.game_codes.append(game_code)
+            player_pks = {}
+            stream = 'join_game'
+            for number, socket in enumerate(sockets):
+                data = await self.request(socket, stream, {'game_code': game_code, 'player_name': 'player{}'.format(number)})
+                player_pks[data['player']['pk']] = socket
+                socket.hand = [card['pk'] for card in data['player_cards']]
+                judge_pk = data['judge']['pk']
+
+            for _ in range(self.options['rounds']):
+                submitted_card_pks = []
+                stream = 'submit_card'
+                for player_pk, socket in player_pks.items():
+                    if player_pk != judge_pk:
+                        submitted_card_pks.append(socket.hand[0])
+                        socket.hand = [card['pk'] for card in (await self.request(socket, stream, {'game_code': game_code, 'card_pk': socket.hand[0]}))['cards']]
+                stream = 'pick_card'
+                judge_pk = (await self.request(player_pks[judge_pk], stream, {'game_code': game_code, 'card_pk': random.choice(submitted_card_pks)}))['picked_player']['pk']
+
+            stream = 'boot_player'
+            await self.request(player_pks[judge_pk], stream, {'game_code': game_code, 'player_pk': next(player_pk for player_pk in player_pks if player_pk != judge_pk)})
+        except (ConnectionError, asyncio.TimeoutError, KeyError):
+            self.errors[stream] += 1
+        finally:
+            await asyncio.gather(*[socket.close() for socket in sockets if socket])
+
+    async def request(self, socket, stream, payload):
+        """Sends a request and records how long its reply took, raising KeyError for an error reply"""
+        data, seconds = await socket.request(stream, payload, self.options['timeout'])
+        if 'error' in data:
+            raise KeyError(data['error'])
+        self.latencies[stream].append(seconds)
+        return data
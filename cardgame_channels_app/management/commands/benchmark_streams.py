@@ -0,0 +1,169 @@
+"""Plays whole games through every GameDemultiplexer stream and measures each message"""
+
+import json
+import platform
+import subprocess
+import time
+from collections import defaultdict
+
+from asgiref.inmemory import ChannelLayer as InMemoryChannelLayer
+from channels import DEFAULT_CHANNEL_LAYER
+from channels.asgi import ChannelLayerWrapper, channel_layers
+from channels.test import WSClient
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from cardgame_channels_app import card_catalog
+from cardgame_channels_app.game_codes import fill_game_code_pool
+from cardgame_channels_app.game_logic import HAND_SIZE
+from cardgame_channels_app.models import Card, CardGamePlayer, Player
+
+
+class Command(BaseCommand):
+    """
+        Plays whole games through every GameDemultiplexer stream and measures each message
+    """
+    help = "Reports latency percentiles, queries and bytes sent per message for each stream, at each game and deck size, in a throwaway test database"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--players', type=int, nargs='+', default=[3, 8, 20], help='Game sizes to play')
+        parser.add_argument('--deck-sizes', type=int, nargs='+', default=[200, 720], help='Cards of each colour')
+        parser.add_argument('--rounds', type=int, default=5, help='Rounds played in each game')
+        parser.add_argument('--output', help='Write the results as JSON to this file')
+        parser.add_argument('--compare', help='JSON results from an earlier run to compare against')
+
+    def handle(self, **options):
+        """Plays a game for each game and deck size, then reports"""
+        for player_count in options['players']:
+            for deck_size in options['deck_sizes']:
+                if deck_size < player_count * HAND_SIZE + options['rounds'] * (player_count - 1):
+                    raise CommandError('A deck of {} cards runs out in {} rounds of a {} player game'.format(deck_size, options['rounds'], player_count))
+
+        old_layer = channel_layers.set(DEFAULT_CHANNEL_LAYER, ChannelLayerWrapper(InMemoryChannelLayer(), DEFAULT_CHANNEL_LAYER, channel_layers[DEFAULT_CHANNEL_LAYER].routing[:]))
+        old_database_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            results = []
+            for player_count in options['players']:
+                for deck_size in options['deck_sizes']:
+                    samples = GameRun(player_count, deck_size).play(options['rounds'])
+                    results.extend(summarize(stream, stream_samples, player_count, deck_size) for stream, stream_samples in sorted(samples.items()))
+        finally:
+            connection.creation.destroy_test_db(old_database_name, verbosity=0)
+            channel_layers.set(DEFAULT_CHANNEL_LAYER, old_layer)
+
+        previous = {}
+        if options['compare']:
+            with open(options['compare']) as compare_file:
+                previous = {(result['players'], result['deck_size'], result['stream']): result for result in json.load(compare_file)['results']}
+
+        self.stdout.write('{:>7} {:>5} {:<21} {:>5} {:>8} {:>8} {:>8} {:>8} {:>8} {:>9}{}\n'.format(
+            'players', 'deck', 'stream', 'msgs', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'queries', 'bytes', '   p50 vs before' if previous else ''))
+        for result in results:
+            before = previous.get((result['players'], result['deck_size'], result['stream']))
+            change = '   {:>+.0%}'.format(result['p50_ms'] / before['p50_ms'] - 1) if before else ''
+            self.stdout.write('{players:>7} {deck_size:>5} {stream:<21} {messages:>5} {p50_ms:>8.2f} {p90_ms:>8.2f} {p99_ms:>8.2f} {max_ms:>8.2f} {queries_per_message:>8.1f} {bytes_per_message:>9.0f}'.format(**result) + change + '\n')
+
+        if options['output']:
+            with open(options['output'], 'w') as output_file:
+                json.dump({'commit': get_commit(), 'date': timezone.now().isoformat(), 'python': platform.python_version(), 'results': results}, output_file, indent=2)
+
+
+class GameRun(object):
+    """One game played over in-memory WebSockets, recording (seconds, queries, bytes sent) for every message"""
+
+    def __init__(self, player_count, deck_size):
+        self.samples = defaultdict(list)
+        call_command('flush', interactive=False, verbosity=0)
+        cache.clear()
+        Card.objects.bulk_create([Card(name='{} card {}'.format(color, number), type=color, text='Text of {} card {}'.format(color, number)) for color in (Card.GREEN, Card.RED) for number in range(deck_size)])
+        card_catalog.invalidate()  # bulk_create sends no signals
+        fill_game_code_pool(100)  # So create_game isn't timed refilling the pool
+        self.clients = []
+        for _ in range(player_count):
+            client = WSClient()
+            client.send_and_consume('websocket.connect', path='/game/')
+            self.clients.append(client)
+        self.drain()
+
+    def play(self, rounds):
+        """Creates and fills a game, plays the rounds and boots a player, returning the samples by stream"""
+        game_code = self.send(self.clients[0], 'create_game', {})[0]['data']['game_code']
+        player_pks = {}
+        for number, client in enumerate(self.clients):
+            player_name = 'player{}'.format(number)
+            self.send(client, 'validate_game_code', {'game_code': game_code})
+            self.send(client, 'validate_player_name', {'game_code': game_code, 'player_name': player_name})
+            player_pks[self.send(client, 'join_game', {'game_code': game_code, 'player_name': player_name})[0]['data']['player']['pk']] = client
+
+        for _ in range(rounds):
+            judge_pk = Player.objects.get(game__code=game_code, status=Player.JUDGE).pk
+            for player_pk, client in player_pks.items():
+                if player_pk != judge_pk:
+                    card_pk = CardGamePlayer.objects.filter(player_id=player_pk, status=CardGamePlayer.HAND).values_list('card_id', flat=True).first()
+                    self.send(client, 'submit_card', {'game_code': game_code, 'card_pk': card_pk})
+            card_pk = CardGamePlayer.objects.filter(game__code=game_code, status=CardGamePlayer.SUBMITTED).values_list('card_id', flat=True).first()
+            self.send(player_pks[judge_pk], 'pick_card', {'game_code': game_code, 'card_pk': card_pk})
+            self.send(player_pks[judge_pk], 'game_state', {'game_code': game_code})
+
+        judge_pk = Player.objects.get(game__code=game_code, status=Player.JUDGE).pk
+        booted_pk = next(player_pk for player_pk in player_pks if player_pk != judge_pk)
+        self.send(player_pks[judge_pk], 'boot_player', {'game_code': game_code, 'player_pk': booted_pk})
+
+        for client in self.clients:
+            client.send_and_consume('websocket.disconnect', path='/game/')
+        return self.samples
+
+    def send(self, client, stream, payload):
+        """Sends a message and consumes it, recording its cost, and returns the payloads sent back to the sender on the stream"""
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            client.send_and_consume('websocket.receive', path='/game/', text={'stream': stream, 'payload': payload})
+            seconds = time.perf_counter() - started
+        replies = self.drain()
+        self.samples[stream].append((seconds, len(queries), sum(len(message.get('text') or message.get('bytes')) for messages in replies.values() for message in messages)))
+        return [json.loads(message['text'])['payload'] for message in replies[client] if json.loads(message['text'])['stream'] == stream]
+
+    def drain(self):
+        """Takes every message waiting for each client"""
+        replies = {}
+        for client in self.clients:
+            replies[client] = []
+            while True:
+                message = client.receive(json=False)
+                if not message:
+                    break
+                replies[client].append(message if isinstance(message, dict) else {'text': message})
+        return replies
+
+
+def get_commit():
+    """Returns the git commit being benchmarked, if there is one"""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode('utf8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def percentile(sorted_values, fraction):
+    """Nearest rank percentile of an already sorted list"""
+    return sorted_values[min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))]
+
+
+def summarize(stream, samples, player_count, deck_size):
+    """Returns the results row for one stream's samples"""
+    latencies = sorted(seconds * 1000 for seconds, _, _ in samples)
+    return {
+        'players': player_count,
+        'deck_size': deck_size,
+        'stream': stream,
+        'messages': len(samples),
+        'p50_ms': percentile(latencies, 0.5),
+        'p90_ms': percentile(latencies, 0.9),
+        'p99_ms': percentile(latencies, 0.99),
+        'max_ms': latencies[-1],
+        'queries_per_message': sum(queries for _, queries, _ in samples) / len(samples),
+        'bytes_per_message': sum(sent for _, _, sent in samples) / len(samples),
+    }
@@ -2,6 +2,7 @@
 
 from django.core.management.base import BaseCommand
 from cardgame_channels_app.models import Game
+from cardgame_channels_app.state_store import get_state_store
 
 
 class Command(BaseCommand):
@@ -13,5 +14,7 @@ class Command(BaseCommand):
     def handle(self, **options):
         """Removes all games"""
         Game.objects.all().delete()
+        if get_state_store():
+            get_state_store().clear()
 
         self.stdout.write('Complete\n')
@@ -0,0 +1,33 @@
+"""Prints the per-stream metrics workers have published"""
+
+from django.core.management.base import BaseCommand
+from cardgame_channels_app.stream_metrics import FIELDS, get_counters, render_prometheus
+
+
+class Command(BaseCommand):
+    """
+        Prints the per-stream metrics workers have published
+    """
+    help = "Prints each stream's totals across every worker that has published metrics to the cache, or with --prometheus the /metrics text"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--prometheus', action='store_true', help='Print every worker\'s counters in the Prometheus text format')
+
+    def handle(self, **options):
+        """Prints one line per stream, summed over the workers"""
+        if options['prometheus']:
+            self.stdout.write(render_prometheus(), ending='')
+            return
+        workers = get_counters()
+        totals = {}
+        for counters in workers.values():
+            for stream, counts in counters.items():
+                stream_totals = totals.setdefault(stream, dict.fromkeys(FIELDS, 0))
+                for field in FIELDS:
+                    stream_totals[field] += counts[field]
+        self.stdout.write('{} workers\n'.format(len(workers)))
+        self.stdout.write('{:<21} {:>9} {:>8} {:>8} {:>8} {:>8} {:>12}\n'.format('stream', 'messages', 'ms/msg', 'queries', 'query ms', 'groups', 'bytes'))
+        for stream, counts in sorted(totals.items()):
+            messages = counts['messages']
+            self.stdout.write('{:<21} {:>9} {:>8.2f} {:>8.1f} {:>8.2f} {:>8.1f} {:>12}\n'.format(
+                stream, messages, counts['handler_seconds'] / messages * 1000, counts['queries'] / messages, counts['query_seconds'] / messages * 1000, counts['group_sends'] / messages, counts['sent_bytes']))
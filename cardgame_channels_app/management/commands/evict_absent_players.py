@@ -0,0 +1,38 @@
+"""Removes players whose connection closed or went quiet from their games"""
+
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from cardgame_channels_app.consumers import GameDemultiplexer, GameMultiplexer, close_evicted_connection, group_send_player_booted
+from cardgame_channels_app.game_logic import GameState, evict_absent_players
+from cardgame_channels_app.state_store import LocalStateStore, get_state_store
+
+
+class Command(BaseCommand):
+    """
+        Removes players whose connection closed or went quiet from their games
+    """
+    help = "Boots every non-judge player whose WebSocket closed over --grace seconds ago or who sent nothing for --timeout seconds, once or every --interval seconds, closing their connection and telling the rest of their game"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--timeout', type=float, default=getattr(settings, 'PRESENCE_TIMEOUT', 300), help='Seconds without a frame or heartbeat before a connected player is booted')
+        parser.add_argument('--grace', type=float, default=getattr(settings, 'PRESENCE_DISCONNECT_GRACE', 120), help='Seconds after a WebSocket closes before its player is booted')
+        parser.add_argument('--interval', type=float, default=0, help='Seconds between passes, runs once if 0')
+
+    def handle(self, **options):
+        """Evicts absent players and broadcasts a boot for each, printing how many left each game"""
+        if isinstance(get_state_store(), LocalStateStore):
+            raise CommandError("GAME_STATE_STORE is a LocalStateStore, which only the worker holding it can change; use a shared store such as RedisStateStore to evict players from a command")
+        while True:
+            for evicted in evict_absent_players(options['timeout'], options['grace']):
+                state = GameState(evicted['game_code'], evicted['game_id'])
+                first_version = evicted['version'] - len(evicted['players']) + 1  # The eviction bumped the version once per player
+                for number, (player_pk, player_name, reply_channel) in enumerate(evicted['players']):
+                    if reply_channel:
+                        close_evicted_connection(reply_channel, evicted['game_code'], player_pk)
+                    group_send_player_booted(GameMultiplexer, state, player_pk, player_name, full_state=GameDemultiplexer.full_state_broadcasts, version=first_version + number)
+                self.stdout.write('Evicted {} players from game {}\n'.format(len(evicted['players']), evicted['game_code']))
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
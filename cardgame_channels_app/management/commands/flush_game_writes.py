@@ -0,0 +1,33 @@
+"""Writes queued game state changes to the database"""
+
+import time
+
+from django.core.management.base import BaseCommand
+from cardgame_channels_app.game_logic import apply_game_writes
+from cardgame_channels_app.state_store import get_state_store
+
+
+class Command(BaseCommand):
+    """
+        Writes queued game state changes to the database
+    """
+    help = "Writes queued game state changes to the database, once or every --interval seconds"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=0, help='Seconds between passes, runs once if 0')
+
+    def handle(self, **options):
+        """Writes queued game state changes to the database"""
+        store = get_state_store()
+        if not store:
+            self.stdout.write('No GAME_STATE_STORE configured\n')
+            return
+        while True:
+            write_count = 0
+            for game_code in store.dirty_game_codes():
+                with store.lock(game_code):
+                    write_count += apply_game_writes(store, game_code)
+            self.stdout.write('Wrote {} changes\n'.format(write_count))
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
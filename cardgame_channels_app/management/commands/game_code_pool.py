@@ -0,0 +1,32 @@
+"""Reports on the pool of free game codes, and keeps it topped up"""
+
+import time
+
+from django.core.management.base import BaseCommand
+from cardgame_channels_app.game_codes import fill_game_code_pool, get_game_code_pool_stats
+
+
+class Command(BaseCommand):
+    """
+        Reports on the pool of free game codes, and keeps it topped up
+    """
+    help = "Prints how many game codes are in use and pooled, with --fill adds every free code to the pool, and with --keep tops the pool up to that many codes, once or every --interval seconds"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fill', action='store_true', help='Add every code not in use to the pool')
+        parser.add_argument('--keep', type=int, default=0, help='Codes to keep in the pool, so creating a game never has to refill it')
+        parser.add_argument('--interval', type=float, default=0, help='Seconds between top ups with --keep, runs once if 0')
+
+    def handle(self, **options):
+        """Prints the pool occupancy, filling or topping up the pool first if asked"""
+        if options['fill']:
+            self.stdout.write('Added {} codes\n'.format(fill_game_code_pool()))
+        while options['keep']:
+            missing = options['keep'] - get_game_code_pool_stats()['pooled']
+            if missing > 0:
+                self.stdout.write('Added {} codes\n'.format(fill_game_code_pool(missing)))
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
+        stats = get_game_code_pool_stats()
+        self.stdout.write('{in_use} of {capacity} codes in use ({occupancy:.1%}), {pooled} pooled, {unpooled} not yet pooled\n'.format(**stats))
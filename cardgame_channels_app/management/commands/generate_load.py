@@ -0,0 +1,263 @@
+"""Plays many simulated games at once through the channel layer, to find the load the workers sustain"""
+
+import heapq
+import json
+import random
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+from asgiref.inmemory import ChannelLayer as InMemoryChannelLayer
+from channels import DEFAULT_CHANNEL_LAYER
+from channels.asgi import ChannelLayerWrapper, channel_layers
+from channels.routing import route_class
+from channels.worker import Worker
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from cardgame_channels_app.channel_layers import GROUP_SEND_STATS
+from cardgame_channels_app.consumers import GameDemultiplexer
+from cardgame_channels_app.management.commands.benchmark_streams import percentile
+from cardgame_channels_app.models import Game
+
+STREAMS = ['connect', 'create_game', 'join_game', 'submit_card', 'pick_card', 'boot_player']
+
+
+class Command(BaseCommand):
+    """
+        Plays many simulated games at once through the channel layer
+    """
+    help = "Plays --games games, --concurrency at a time, through the configured channel layer (served by runworker, or --workers threads) or an --in-memory one, and reports throughput, latency and errors per stream; --burst has each round's players submit at once"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--games', type=int, default=100, help='Games to play in total')
+        parser.add_argument('--concurrency', type=int, default=20, help='Games in progress at once')
+        parser.add_argument('--players', type=int, default=4, help='Players in each game')
+        parser.add_argument('--rounds', type=int, default=3, help='Rounds played in each game')
+        parser.add_argument('--think', type=float, default=0.5, help='Average seconds a player waits before each move')
+        parser.add_argument('--burst', action='store_true', help="Have every player in a round submit at once, rather than each after the last one's reply, so their submissions contend for the game")
+        parser.add_argument('--timeout', type=float, default=10, help='Seconds to wait for a reply before counting an error')
+        parser.add_argument('--in-memory', action='store_true', help='Use an in-memory channel layer instead of the configured one')
+        parser.add_argument('--workers', type=int, help='Worker threads to run in this process, by default 1 with --in-memory and none otherwise')
+        parser.add_argument('--coalesce-window', type=float, help='GROUP_SEND_COALESCE_WINDOW in milliseconds for the workers in this process')
+        parser.add_argument('--full-state', action='store_true', help='Have the workers in this process broadcast full state, which coalescing can merge')
+        parser.add_argument('--keep-games', action='store_true', help="Don't delete the games afterwards")
+
+    def handle(self, **options):
+        """Runs the workers and the simulated games, then reports"""
+        unknown_streams = set(STREAMS[1:]) - set(GameDemultiplexer.consumers)
+        if unknown_streams:
+            raise CommandError('GameDemultiplexer has no {} streams'.format(', '.join(sorted(unknown_streams))))
+        if options['players'] < 3:
+            raise CommandError('Games need at least 3 players, so that one can be booted')
+
+        old_layer = None
+        if options['in_memory']:
+            old_layer = channel_layers.set(DEFAULT_CHANNEL_LAYER, ChannelLayerWrapper(InMemoryChannelLayer(capacity=10000), DEFAULT_CHANNEL_LAYER, channel_layers[DEFAULT_CHANNEL_LAYER].routing[:]))
+        channel_layer = channel_layers[DEFAULT_CHANNEL_LAYER]
+        worker_count = options['workers'] if options['workers'] is not None else int(options['in_memory'])
+        coalesce_window = options['coalesce_window'] if options['coalesce_window'] is not None else getattr(settings, 'GROUP_SEND_COALESCE_WINDOW', 0)
+        worker_layer = ChannelLayerWrapper(channel_layer.channel_layer, channel_layer.alias, [route_class(type('LoadDemultiplexer', (GameDemultiplexer,), {
+            'full_state_broadcasts': GameDemultiplexer.full_state_broadcasts or options['full_state'], 'coalesce_window': coalesce_window}), path=r"^/game/")])
+        workers = [Worker(worker_layer, signal_handlers=False) for _ in range(worker_count)]
+        for worker in workers:
+            threading.Thread(target=worker.run, daemon=True).start()
+
+        GROUP_SEND_STATS.clear()
+        load = Load(channel_layer, options)
+        try:
+            load.run()
+        finally:
+            for worker in workers:
+                worker.termed = True
+            if old_layer:
+                channel_layers.set(DEFAULT_CHANNEL_LAYER, old_layer)
+            if not options['keep_games']:
+                Game.objects.filter(code__in=load.game_codes).delete()
+
+        self.stdout.write('{} of {} games finished in {:.1f}s, sending {:.0f} messages/s and receiving {:.0f} messages/s\n'.format(
+            load.finished_games, options['games'], load.seconds, load.sent / load.seconds, load.received / load.seconds))
+        self.stdout.write('{:<12} {:>8} {:>8} {:>8} {:>7} {:>8}\n'.format('stream', 'requests', 'p50 ms', 'p99 ms', 'errors', 'error %'))
+        for stream in STREAMS:
+            latencies = sorted(load.latencies[stream])
+            requests = len(latencies) + load.errors[stream]
+            if requests:
+                self.stdout.write('{:<12} {:>8} {:>8.1f} {:>8.1f} {:>7} {:>8.1%}\n'.format(
+                    stream, requests, percentile(latencies, 0.5) * 1000 if latencies else 0, percentile(latencies, 0.99) * 1000 if latencies else 0, load.errors[stream], load.errors[stream] / requests))
+        if workers:
+            self.stdout.write('Workers here published {publishes} group batches carrying {messages} group messages, {replaced} replaced while held, with a {window:g}ms coalescing window\n'.format(
+                window=coalesce_window, **{field: GROUP_SEND_STATS[field] for field in ('publishes', 'messages', 'replaced')}))
+
+
+class Socket(object):
+    """A simulated WebSocket, with what its player knows about the game"""
+
+    def __init__(self, reply_channel, player_name):
+        self.reply_channel = reply_channel
+        self.player_name = player_name
+        self.player_pk = None
+        self.hand = []
+
+
+class Moves(object):
+    """Moves a game made at once, with their replies so far"""
+
+    def __init__(self, moves, burst):
+        self.moves = moves
+        self.burst = burst  # Resume the game with the list of replies, rather than the one reply
+        self.replies = [None] * len(moves)
+        self.pending = len(moves)
+
+
+class Load(object):
+    """Runs every simulated game from one thread, sending each game's moves and matching the replies to them"""
+
+    def __init__(self, channel_layer, options):
+        self.channel_layer = channel_layer
+        self.options = options
+        self.reply_prefix = 'loadgen.{}!'.format(uuid.uuid4().hex)  # Every socket's reply channel is process-local to this one
+        self.socket_count = 0
+        self.sockets = {}  # reply channel: Socket
+        self.due = []  # heap of (time, sequence, game, reply) for moves waiting out a think time
+        self.waiting = {}  # reply channel: (game, stream, time sent, Moves, index) for moves waiting for a reply
+        self.sequence = 0
+        self.active_games = self.started_games = self.finished_games = 0
+        self.sent = self.received = 0
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.game_codes = []
+        self.seconds = 0.0
+
+    def run(self):
+        """Plays --games games, starting another whenever fewer than --concurrency are in progress"""
+        started = time.monotonic()
+        while self.started_games < self.options['games'] or self.active_games:
+            while self.active_games < self.options['concurrency'] and self.started_games < self.options['games']:
+                self.started_games += 1
+                self.active_games += 1
+                self.schedule(self.play(), None, 0)
+            while self.due and self.due[0][0] <= time.monotonic():
+                _, _, game, reply = heapq.heappop(self.due)
+                self.move(game, reply)
+            self.expire_moves()
+            if not self.read_replies():
+                time.sleep(0.001)
+        self.seconds = time.monotonic() - started
+
+    def play(self):
+        """One game, as a generator of (socket, stream, payload) moves, or lists of them made at once, that is sent the data of each move's reply, or a list of them"""
+        sockets = []
+        for number in range(self.options['players']):
+            self.socket_count += 1
+            socket = Socket('{}socket{}'.format(self.reply_prefix, self.socket_count), 'player{}'.format(number))
+            self.sockets[socket.reply_channel] = socket
+            sockets.append(socket)
+        try:
+            for socket in sockets:
+                yield socket, 'connect', None
+
+            game_code = (yield sockets[0], 'create_game', {})['game_code']
+            self.game_codes.append(game_code)
+            for socket in sockets:
+                data = yield socket, 'join_game', {'game_code': game_code, 'player_name': socket.player_name}
+                socket.player_pk = data['player']['pk']
+                socket.hand = [card['pk'] for card in data['player_cards']]
+                judge_pk = data['judge']['pk']
+
+            for _ in range(self.options['rounds']):
+                submitters = [socket for socket in sockets if socket.player_pk != judge_pk]
+                submitted_card_pks = [socket.hand[0] for socket in submitters]
+                submits = [(socket, 'submit_card', {'game_code': game_code, 'card_pk': socket.hand[0]}) for socket in submitters]
+                if self.options['burst']:
+                    replies = yield submits
+                else:
+                    replies = []
+                    for submit in submits:
+                        replies.append((yield submit))
+                for socket, data in zip(submitters, replies):
+                    socket.hand = [card['pk'] for card in data['cards']]
+                judge = next(socket for socket in sockets if socket.player_pk == judge_pk)
+                judge_pk = (yield judge, 'pick_card', {'game_code': game_code, 'card_pk': random.choice(submitted_card_pks)})['picked_player']['pk']
+
+            judge = next(socket for socket in sockets if socket.player_pk == judge_pk)
+            booted = next(socket for socket in sockets if socket.player_pk != judge_pk)
+            yield judge, 'boot_player', {'game_code': game_code, 'player_pk': booted.player_pk}
+        finally:
+            for socket in sockets:
+                self.send('websocket.disconnect', socket, {'path': '/game/'})
+                del self.sockets[socket.reply_channel]
+
+    def schedule(self, game, reply, think):
+        """Queues a game's next move for after a random think time averaging think seconds"""
+        self.sequence += 1
+        heapq.heappush(self.due, (time.monotonic() + random.uniform(0, 2 * think), self.sequence, game, reply))
+
+    def move(self, game, reply):
+        """Sends a game's next move or moves, or counts the game finished"""
+        try:
+            next_moves = game.send(reply)
+        except StopIteration:
+            self.active_games -= 1
+            self.finished_games += 1
+            return
+        moves = Moves(next_moves if isinstance(next_moves, list) else [next_moves], isinstance(next_moves, list))
+        for index, (socket, stream, payload) in enumerate(moves.moves):
+            if stream == 'connect':
+                self.send('websocket.connect', socket, {'path': '/game/', 'query_string': ''})
+            else:
+                self.send('websocket.receive', socket, {'path': '/game/', 'text': json.dumps({'stream': stream, 'payload': payload})})
+            self.waiting[socket.reply_channel] = (game, stream, time.monotonic(), moves, index)
+
+    def read_replies(self):
+        """Takes every message waiting for the sockets, resuming the games they answer, and returns how many there were"""
+        count = 0
+        while True:
+            reply_channel, message = self.channel_layer.receive_many([self.reply_prefix], block=False)
+            if reply_channel is None:
+                return count
+            count += 1
+            self.received += 1
+            content = json.loads(message['text']) if 'text' in message else {}
+            if content.get('stream') == 'new_cards' and reply_channel in self.sockets:
+                self.sockets[reply_channel].hand = [card['pk'] for card in content['payload']['data']['cards']]
+            if reply_channel not in self.waiting:
+                continue
+            game, stream, sent, moves, index = self.waiting[reply_channel]
+            if stream == 'connect' and 'accept' in message:
+                data = None
+            elif content.get('stream') == stream:
+                data = content['payload']['data']
+            else:
+                continue  # Someone else's move, or the other consumers accepting the connection
+            del self.waiting[reply_channel]
+            if (stream == 'connect' and not message['accept']) or (data and 'error' in data):
+                self.fail(game, stream)
+            else:
+                self.latencies[stream].append(time.monotonic() - sent)
+                moves.replies[index] = data
+                moves.pending -= 1
+                if not moves.pending:
+                    self.schedule(game, moves.replies if moves.burst else data, 0 if stream == 'connect' else self.options['think'])
+
+    def expire_moves(self):
+        """Fails the games of moves that have waited longer than --timeout for a reply"""
+        now = time.monotonic()
+        for reply_channel, (game, stream, sent, _, _) in list(self.waiting.items()):
+            if reply_channel in self.waiting and now - sent > self.options['timeout']:
+                del self.waiting[reply_channel]
+                self.fail(game, stream)
+
+    def fail(self, game, stream):
+        """Counts an error on the stream and abandons the game, with the rest of its moves"""
+        self.errors[stream] += 1
+        self.active_games -= 1
+        for reply_channel, waiting in list(self.waiting.items()):
+            if waiting[0] is game:
+                del self.waiting[reply_channel]
+        game.close()
+
+    def send(self, channel, socket, content):
+        """Sends a message from a socket, as the interface server would"""
+        content['reply_channel'] = socket.reply_channel
+        self.channel_layer.send(channel, content)
+        self.sent += 1
@@ -0,0 +1,55 @@
+"""Imports a card pack from a JSON lines or CSV file, streaming it in chunks"""
+
+import csv
+import io
+import json
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+from cardgame_channels_app.card_packs import import_cards
+
+
+class Command(BaseCommand):
+    """
+        Imports a card pack from a JSON lines or CSV file
+    """
+    help = "Streams cards with name, type, text and optional key and deck fields from a .jsonl or .csv file (- for stdin) into the database, --chunk-size cards per transaction, updating cards whose key was imported before"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='File to import, or - for stdin')
+        parser.add_argument('--format', choices=['jsonl', 'csv'], help='File format, taken from the extension if not given')
+        parser.add_argument('--deck', help='Deck to add the cards to, for rows without a deck of their own')
+        parser.add_argument('--chunk-size', type=int, default=500, help='Cards upserted per transaction')
+
+    def handle(self, **options):
+        """Imports the rows, printing each chunk's counts"""
+        file_format = options['format'] or ('csv' if options['path'].lower().endswith('.csv') else 'jsonl')
+        if options['path'] == '-':
+            stream = io.TextIOWrapper(sys.stdin.buffer, encoding='utf8', newline='')
+        else:
+            stream = open(options['path'], encoding='utf8', newline='')
+        totals = {'cards': 0, 'created': 0, 'updated': 0, 'added_to_decks': 0}
+        try:
+            rows = csv.DictReader(stream) if file_format == 'csv' else read_json_lines(stream)
+            for chunk in import_cards(rows, options['deck'], options['chunk_size']):
+                for name, count in chunk.items():
+                    totals[name] += count
+                self.stdout.write('Imported {cards} cards: {created} created, {updated} updated, {added_to_decks} added to decks\n'.format(**chunk))
+        except ValueError as error:
+            raise CommandError(str(error))
+        finally:
+            stream.close()
+        self.stdout.write('Done, {cards} cards: {created} created, {updated} updated, {added_to_decks} added to decks\n'.format(**totals))
+
+
+def read_json_lines(stream):
+    """Yields the object on each non-blank line, raising ValueError for a line that isn't one"""
+    for line_number, line in enumerate(stream, 1):
+        if line.strip():
+            try:
+                row = json.loads(line)
+            except ValueError:
+                raise ValueError('Line {}: not JSON'.format(line_number))
+            if not isinstance(row, dict):
+                raise ValueError('Line {}: not a JSON object'.format(line_number))
+            yield row
@@ -0,0 +1,30 @@
+"""Deletes games nobody has played for a while"""
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from cardgame_channels_app.game_logic import reap_idle_games
+from cardgame_channels_app.state_store import LocalStateStore, get_state_store
+
+
+class Command(BaseCommand):
+    """
+        Deletes games nobody has played for a while
+    """
+    help = "Deletes games untouched for --idle-minutes in batches of --batch-size, once or every --interval seconds"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--idle-minutes', type=float, default=24 * 60, help='Minutes since a game last changed before it is deleted')
+        parser.add_argument('--batch-size', type=int, default=100, help='Games deleted per transaction')
+        parser.add_argument('--interval', type=float, default=0, help='Seconds between passes, runs once if 0')
+
+    def handle(self, **options):
+        """Deletes idle games, printing what each batch reclaimed"""
+        if isinstance(get_state_store(), LocalStateStore):
+            raise CommandError("GAME_STATE_STORE is a LocalStateStore, which only the worker holding it can change; use a shared store such as RedisStateStore to reap games from a command")
+        while True:
+            for batch in reap_idle_games(options['idle_minutes'] * 60, options['batch_size']):
+                self.stdout.write('Deleted {games} games, {players} players and {cards} cards in {seconds:.3f}s\n'.format(**batch))
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
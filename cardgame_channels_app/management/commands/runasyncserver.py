@@ -0,0 +1,40 @@
+"""Serves the game WebSockets from an asyncio event loop in this process, without runworker"""
+
+import asyncio
+import resource
+
+from django.core.management.base import BaseCommand
+from cardgame_channels_app.async_server import GameServer
+
+
+class Command(BaseCommand):
+    """
+        Serves the game WebSockets from an asyncio event loop in this process
+    """
+    help = "Serves /game/ WebSockets on --port, running the consumers on --threads threads in this process. Broadcasts go through the channel layer, so it can run next to daphne and runworker"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+        parser.add_argument('--port', type=int, default=8001, help='Port to listen on')
+        parser.add_argument('--threads', type=int, default=8, help='Threads running consumers, and so the most database connections held')
+        parser.add_argument('--status-interval', type=int, default=60, help='Seconds between printing the connection count and memory, 0 for never')
+
+    def handle(self, **options):
+        """Serves until interrupted"""
+        loop = asyncio.get_event_loop()
+        server = GameServer(options['threads'])
+        loop.run_until_complete(server.serve(options['host'], options['port']))
+        self.stdout.write('Serving game WebSockets on ws://{}:{}/game/ with {} threads\n'.format(options['host'], options['port'], options['threads']))
+        if options['status_interval']:
+            loop.call_later(options['status_interval'], self.print_status, loop, server, options['status_interval'])
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.stop()
+
+    def print_status(self, loop, server, interval):
+        """Prints the open connections and peak memory, then schedules itself again"""
+        self.stdout.write('{} connections, {:.0f} MB peak memory\n'.format(len(server.connections), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+        loop.call_later(interval, self.print_status, loop, server, interval)
@@ -0,0 +1,44 @@
+"""Runs a single-threaded worker that also owns a share of the games, see game_affinity"""
+
+import threading
+
+from channels import DEFAULT_CHANNEL_LAYER, channel_layers
+from channels.management.commands import runworker
+from channels.routing import route
+from django.conf import settings
+from django.core.management.base import CommandError
+from cardgame_channels_app import game_affinity
+from cardgame_channels_app.consumers import receive_forwarded
+
+
+class Command(runworker.Command):
+    """
+        Runs a single-threaded worker that also owns a share of the games
+    """
+    help = "Runs a worker like runworker, registered as a game worker with a channel of its own that GAME_AFFINITY forwards its games' frames to"
+
+    def handle(self, *args, **options):
+        """Registers the worker and keeps its heartbeat going while it runs"""
+        if options.get('threads', 1) != 1:
+            raise CommandError("A game worker must run one thread, so that it handles each of its games' frames in order")
+        name = game_affinity.make_worker_name()
+        channel_layer = channel_layers[options.get('layer') or DEFAULT_CHANNEL_LAYER]
+        channel_layer.router.add_route(route(game_affinity.WORKER_CHANNEL_PREFIX + name, receive_forwarded))
+        game_affinity.set_worker(name)
+        game_affinity.register_worker(name)
+        stopped = threading.Event()
+        threading.Thread(target=self.heartbeat, args=(name, channel_layer, stopped), daemon=True).start()
+        try:
+            super(Command, self).handle(*args, **options)
+        finally:
+            stopped.set()
+            game_affinity.unregister_worker(name)
+            game_affinity.set_worker(None)
+
+    @staticmethod
+    def heartbeat(name, channel_layer, stopped):
+        """Renews the worker's registration until stopped, leaving the check for other workers and writing out its games to its own loop"""
+        interval = getattr(settings, 'GAME_AFFINITY_WORKER_TIMEOUT', 15) / 3
+        while not stopped.wait(interval):
+            game_affinity.register_worker(name)
+            game_affinity.request_rebalance(name, channel_layer)  # Games are handed off between messages, never during one
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 18:30
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cardgame_channels_app', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='green_deck',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='green_deck_position',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='red_deck',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='red_deck_position',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 18:43
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cardgame_channels_app', '0003_game_state_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GameCode',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('code', models.CharField(max_length=255, unique=True)),
+            ],
+            options={
+                'verbose_name_plural': 'game codes',
+                'ordering': ['pk'],
+            },
+        ),
+    ]
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 18:48
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def backfill_counters(apps, schema_editor):
+    """Counts the rounds, waiting players and hand sizes of existing games"""
+    CardGamePlayer = apps.get_model('cardgame_channels_app', 'CardGamePlayer')
+    Game = apps.get_model('cardgame_channels_app', 'Game')
+    Player = apps.get_model('cardgame_channels_app', 'Player')
+
+    rounds = dict(CardGamePlayer.objects.filter(status='won').order_by().values_list('game_id').annotate(count=Count('pk')))
+    waiting_player_counts = dict(Player.objects.filter(status='waiting').order_by().values_list('game_id').annotate(count=Count('pk')))
+    for game_pk in set(rounds) | set(waiting_player_counts):
+        Game.objects.filter(pk=game_pk).update(round=rounds.get(game_pk, 0), waiting_player_count=waiting_player_counts.get(game_pk, 0))
+
+    for player_pk, hand_size in CardGamePlayer.objects.filter(status='hand').order_by().values_list('player_id').annotate(count=Count('pk')):
+        Player.objects.filter(pk=player_pk).update(hand_size=hand_size)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cardgame_channels_app', '0004_game_code_pool'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='round',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='waiting_player_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='player',
+            name='hand_size',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='cardgameplayer',
+            index=models.Index(fields=['game', 'status'], name='cardgame_ch_game_id_10d4c3_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='cardgameplayer',
+            index=models.Index(fields=['player', 'status'], name='cardgame_ch_player__5c099a_idx'),
+        ),
+        migrations.RunPython(backfill_counters, migrations.RunPython.noop),
+    ]
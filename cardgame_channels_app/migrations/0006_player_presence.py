@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 19:06
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cardgame_channels_app', '0005_round_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='player',
+            name='connected',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AddField(
+            model_name='player',
+            name='last_seen',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
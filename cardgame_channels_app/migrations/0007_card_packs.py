@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 19:22
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cardgame_channels_app', '0006_player_presence'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Deck',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('date_created', models.DateTimeField(auto_now_add=True)),
+                ('date_updated', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name_plural': 'decks',
+                'ordering': ['name'],
+            },
+        ),
+        migrations.CreateModel(
+            name='DeckCard',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('type', models.CharField(blank=True, max_length=255, null=True)),
+            ],
+            options={
+                'verbose_name': 'Deck Card',
+                'verbose_name_plural': 'Deck Cards',
+            },
+        ),
+        migrations.AddField(
+            model_name='card',
+            name='key',
+            field=models.CharField(blank=True, max_length=255, null=True, unique=True),
+        ),
+        migrations.AddField(
+            model_name='deckcard',
+            name='card',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='cardgame_channels_app.Card'),
+        ),
+        migrations.AddField(
+            model_name='deckcard',
+            name='deck',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='cardgame_channels_app.Deck'),
+        ),
+        migrations.AddField(
+            model_name='deck',
+            name='cards',
+            field=models.ManyToManyField(related_name='decks', through='cardgame_channels_app.DeckCard', to='cardgame_channels_app.Card'),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='decks',
+            field=models.ManyToManyField(blank=True, related_name='games', to='cardgame_channels_app.Deck'),
+        ),
+        migrations.AddIndex(
+            model_name='deckcard',
+            index=models.Index(fields=['deck', 'type'], name='cardgame_ch_deck_id_9af0f3_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='deckcard',
+            unique_together=set([('deck', 'card')]),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 19:25
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cardgame_channels_app', '0007_card_packs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Round',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.IntegerField()),
+                ('submitted_cards', models.TextField(blank=True, default='')),
+                ('date_created', models.DateTimeField(auto_now_add=True)),
+                ('game', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rounds', to='cardgame_channels_app.Game')),
+                ('green_card', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='cardgame_channels_app.Card')),
+                ('judge', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='judged_rounds', to='cardgame_channels_app.Player')),
+                ('picked_card', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='cardgame_channels_app.Card')),
+                ('winner', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='won_rounds', to='cardgame_channels_app.Player')),
+            ],
+            options={
+                'verbose_name_plural': 'rounds',
+                'ordering': ['game', 'number'],
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='round',
+            unique_together=set([('game', 'number')]),
+        ),
+    ]
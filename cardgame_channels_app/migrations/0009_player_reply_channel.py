@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 20:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cardgame_channels_app', '0008_rounds'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='player',
+            name='reply_channel',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 20:03
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cardgame_channels_app', '0009_player_reply_channel'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='round',
+            name='green_card',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='cardgame_channels_app.Card'),
+        ),
+        migrations.AlterField(
+            model_name='round',
+            name='picked_card',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='cardgame_channels_app.Card'),
+        ),
+    ]
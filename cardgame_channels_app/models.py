@@ -1,6 +1,7 @@
 """Django Models"""
 
 from django.db import models
+from django.utils import timezone
 
 
 class Card(models.Model):
@@ -13,6 +14,7 @@ class Card(models.Model):
     name = models.CharField(max_length=255)
     type = models.CharField(max_length=255, blank=True, null=True)
     text = models.TextField(blank=True, null=True)
+    key = models.CharField(max_length=255, unique=True, blank=True, null=True)  # Identifies an imported card, so importing its pack again updates it
     players = models.ManyToManyField('Player', through='CardGamePlayer')
     games = models.ManyToManyField('Game', through='CardGamePlayer')
     date_created = models.DateTimeField(auto_now_add=True)
@@ -34,8 +36,8 @@ class CardGamePlayer(models.Model):
     SUBMITTED = 'submitted'  # Submitted as choice to the chooser
     PICKED = 'picked'  # Chosen as the winner by the chooser
     MATCHING = 'matching'  # Actively being matched by the players
-    WON = 'won'  # won as the prize by being picked by the chooser
-    LOST = 'lost'  # not picked by the chooser
+    WON = 'won'  # won as the prize by being picked by the chooser, archived in a Round
+    LOST = 'lost'  # not picked by the chooser, archived in a Round
 
     status = models.CharField(max_length=30, default='hand', db_index=True)
     card = models.ForeignKey('Card')
@@ -47,6 +49,10 @@ class CardGamePlayer(models.Model):
 
     class Meta(object):
         ordering = ['date_created']
+        indexes = [
+            models.Index(fields=['game', 'status']),
+            models.Index(fields=['player', 'status']),
+        ]
         unique_together = (('card', 'game'),)
         verbose_name_plural = "Card Game Players"
         verbose_name = "Card Game Player"
@@ -55,13 +61,58 @@ class CardGamePlayer(models.Model):
         return str(self.game.code + ":" + self.card.name + ":" + self.status)
 
 
+class Deck(models.Model):
+    """Pack of cards that games can choose to draw from"""
+
+    name = models.CharField(max_length=255, unique=True)
+    cards = models.ManyToManyField('Card', through='DeckCard', related_name='decks')
+    date_created = models.DateTimeField(auto_now_add=True)
+    date_updated = models.DateTimeField(auto_now=True)
+
+    class Meta(object):
+        ordering = ['name']
+        verbose_name_plural = "decks"
+
+    def __str__(self):
+        return str(self.name)
+
+
+class DeckCard(models.Model):
+    """Card in a deck, with the card's color copied so a deck's cards of a color are read from the index alone"""
+
+    deck = models.ForeignKey('Deck')
+    card = models.ForeignKey('Card')
+    type = models.CharField(max_length=255, blank=True, null=True)
+
+    class Meta(object):
+        indexes = [
+            models.Index(fields=['deck', 'type']),
+        ]
+        unique_together = (('deck', 'card'),)
+        verbose_name_plural = "Deck Cards"
+        verbose_name = "Deck Card"
+
+    def __str__(self):
+        return str(self.deck.name + ":" + self.card.name)
+
+
 class Game(models.Model):
     """Game for cardgame"""
 
     code = models.CharField(max_length=255, unique=True, db_index=True)
     cards = models.ManyToManyField('Card', through='CardGamePlayer')
+    decks = models.ManyToManyField('Deck', blank=True, related_name='games')  # Decks the game draws from, all cards if none
     # players available as players
 
+    # Decks are shuffled once per game, stored as comma separated card pks, and dealt from the position onward
+    green_deck = models.TextField(blank=True, default='')
+    green_deck_position = models.IntegerField(default=0)
+    red_deck = models.TextField(blank=True, default='')
+    red_deck_position = models.IntegerField(default=0)
+    state_version = models.IntegerField(default=0)  # Bumped on every change to the game, so clients can spot missed broadcasts
+    round = models.IntegerField(default=0)  # Cards picked so far
+    waiting_player_count = models.IntegerField(default=0)  # Players who have yet to submit a card this round
+
     date_created = models.DateTimeField(auto_now_add=True)
     date_updated = models.DateTimeField(auto_now=True)
 
@@ -73,6 +124,19 @@ class Game(models.Model):
         return str(self.code)
 
 
+class GameCode(models.Model):
+    """Free game code, waiting in the pool to be handed out in pk order"""
+
+    code = models.CharField(max_length=255, unique=True)
+
+    class Meta(object):
+        ordering = ['pk']
+        verbose_name_plural = "game codes"
+
+    def __str__(self):
+        return str(self.code)
+
+
 class Player(models.Model):
     """Player for cardgame."""
 
@@ -86,6 +150,10 @@ class Player(models.Model):
     cards = models.ManyToManyField('Card', through=CardGamePlayer)
     status = models.CharField(max_length=20, default='waiting')  # waiting, submitted, judge
     score = models.IntegerField(default=0)
+    hand_size = models.IntegerField(default=0)  # Red cards in hand
+    connected = models.BooleanField(default=True)  # False once the player's WebSocket has closed
+    last_seen = models.DateTimeField(default=timezone.now)  # Last frame from the player, updated at most every PRESENCE_HEARTBEAT_INTERVAL
+    reply_channel = models.CharField(max_length=255, blank=True, default='')  # Connection the player joined from, closed if they are evicted
     date_created = models.DateTimeField(auto_now_add=True)
     date_updated = models.DateTimeField(auto_now=True)
 
@@ -95,3 +163,24 @@ class Player(models.Model):
 
     def __str__(self):
         return str(self.name)
+
+
+class Round(models.Model):
+    """Finished round of a game, archived in one row so CardGamePlayer only holds the cards in play"""
+
+    game = models.ForeignKey('Game', related_name='rounds')
+    number = models.IntegerField()  # Game.round once this round was picked
+    judge = models.ForeignKey('Player', blank=True, null=True, on_delete=models.SET_NULL, related_name='judged_rounds')
+    winner = models.ForeignKey('Player', blank=True, null=True, on_delete=models.SET_NULL, related_name='won_rounds')
+    green_card = models.ForeignKey('Card', blank=True, null=True, on_delete=models.SET_NULL, related_name='+')  # None once the green deck ran out, or if the card was deleted
+    picked_card = models.ForeignKey('Card', blank=True, null=True, on_delete=models.SET_NULL, related_name='+')  # None if the card was deleted
+    submitted_cards = models.TextField(blank=True, default='')  # Comma separated pks of every card submitted, picked card included
+    date_created = models.DateTimeField(auto_now_add=True)
+
+    class Meta(object):
+        ordering = ['game', 'number']
+        unique_together = (('game', 'number'),)
+        verbose_name_plural = "rounds"
+
+    def __str__(self):
+        return str(self.game.code + ":" + str(self.number))
@@ -0,0 +1,136 @@
+"""Stores for the live state of active games, with a queue of database writes behind them
+
+Configure with GAME_STATE_STORE, e.g. {'BACKEND': 'cardgame_channels_app.state_store.RedisStateStore', 'OPTIONS': {'host': 'redis'}}
+"""
+import json
+import threading
+from collections import defaultdict
+
+import redis
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+_STORE = {}
+
+
+class LocalStateStore(object):
+    """In-process store, for running and testing offline with a single worker, or with GAME_AFFINITY and rungameworker
+
+    Only the process holding it sees its games, so games can't be changed from another process, e.g. by
+    evict_absent_players or reap_idle_games run as commands.
+    """
+
+    def __init__(self, **options):
+        self.games = {}
+        self.writes = defaultdict(list)
+        self.locks = defaultdict(threading.Lock)
+
+    def get(self, game_code):
+        """Returns the stored state for a game, or None"""
+        state = self.games.get(game_code)
+        return json.loads(state) if state else None
+
+    def set(self, game_code, state):
+        """Stores the state for a game"""
+        self.games[game_code] = json.dumps(state)
+
+    def delete(self, game_code):
+        """Drops the stored state for a game"""
+        self.games.pop(game_code, None)
+
+    def lock(self, game_code):
+        """Returns a context manager that serializes changes to a game"""
+        return self.locks[game_code]
+
+    def push_write(self, game_code, write):
+        """Queues a write for the database"""
+        self.writes[game_code].append(json.dumps(write))
+
+    def get_writes(self, game_code):
+        """Returns a game's queued writes, oldest first"""
+        return [json.loads(write) for write in self.writes.get(game_code, [])]
+
+    def clear_writes(self, game_code, count):
+        """Removes the oldest count writes once they have been applied"""
+        del self.writes[game_code][:count]
+        if not self.writes[game_code]:
+            del self.writes[game_code]
+
+    def dirty_game_codes(self):
+        """Returns the codes of games with queued writes"""
+        return list(self.writes)
+
+    def clear(self):
+        """Drops every stored game and queued write"""
+        self.games.clear()
+        self.writes.clear()
+
+
+class RedisStateStore(object):
+    """Store shared by every worker, kept in the Redis we already run for the channel layer"""
+
+    def __init__(self, host='localhost', port=6379, db=0, prefix='game-state:', expiry=3600, lock_timeout=10):
+        self.connection = redis.StrictRedis(host=host, port=port, db=db)
+        self.prefix = prefix
+        self.expiry = expiry  # Idle games drop out of the store, and are reloaded from the database when next used
+        self.lock_timeout = lock_timeout
+
+    def get(self, game_code):
+        """Returns the stored state for a game, or None"""
+        state = self.connection.get(self.prefix + game_code)
+        return json.loads(state.decode('utf8')) if state else None
+
+    def set(self, game_code, state):
+        """Stores the state for a game"""
+        self.connection.setex(self.prefix + game_code, self.expiry, json.dumps(state))
+
+    def delete(self, game_code):
+        """Drops the stored state for a game"""
+        self.connection.delete(self.prefix + game_code)
+
+    def lock(self, game_code):
+        """Returns a context manager that serializes changes to a game across workers"""
+        return self.connection.lock(self.prefix + 'lock:' + game_code, timeout=self.lock_timeout)
+
+    def push_write(self, game_code, write):
+        """Queues a write for the database"""
+        pipeline = self.connection.pipeline()
+        pipeline.rpush(self.prefix + 'writes:' + game_code, json.dumps(write))
+        pipeline.sadd(self.prefix + 'dirty', game_code)
+        pipeline.execute()
+
+    def get_writes(self, game_code):
+        """Returns a game's queued writes, oldest first"""
+        return [json.loads(write.decode('utf8')) for write in self.connection.lrange(self.prefix + 'writes:' + game_code, 0, -1)]
+
+    def clear_writes(self, game_code, count):
+        """Removes the oldest count writes once they have been applied"""
+        self.connection.ltrim(self.prefix + 'writes:' + game_code, count, -1)
+        if not self.connection.llen(self.prefix + 'writes:' + game_code):
+            self.connection.srem(self.prefix + 'dirty', game_code)
+
+    def dirty_game_codes(self):
+        """Returns the codes of games with queued writes"""
+        return [game_code.decode('utf8') for game_code in self.connection.smembers(self.prefix + 'dirty')]
+
+    def clear(self):
+        """Drops every stored game and queued write"""
+        for key in self.connection.scan_iter(self.prefix + '*'):
+            self.connection.delete(key)
+
+
+def get_state_store():
+    """Returns the configured state store, or None if games are played straight against the database"""
+    if 'store' not in _STORE:
+        config = getattr(settings, 'GAME_STATE_STORE', None)
+        _STORE['store'] = import_string(config['BACKEND'])(**config.get('OPTIONS', {})) if config else None
+    return _STORE['store']
+
+
+@receiver(setting_changed)
+def reset_state_store(setting, **kwargs):
+    """Rebuilds the store the next time it is needed when GAME_STATE_STORE changes, e.g. in tests"""
+    if setting == 'GAME_STATE_STORE':
+        _STORE.clear()
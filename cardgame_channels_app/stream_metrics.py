@@ -0,0 +1,110 @@
+"""Per-stream counters of the work GameDemultiplexer does, kept in each worker and published to the cache for scraping
+
+Only recorded when STREAM_METRICS is on. The cache must be shared between workers, as the docker-compose settings'
+Redis cache is, for the /metrics endpoint and dump_stream_metrics to see every worker, not just the one that answers.
+"""
+import os
+import socket
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from .worker_registry import WorkerRegistry
+
+FIELDS = OrderedDict([
+    ('messages', 'Messages handled'),
+    ('handler_seconds', 'Seconds spent handling messages'),
+    ('queries', 'Database queries made'),
+    ('query_seconds', 'Seconds spent in database queries'),
+    ('group_sends', 'Messages sent to groups'),
+    ('sent_bytes', 'Bytes of frames sent'),
+])
+WORKER = '{}:{}'.format(socket.gethostname(), os.getpid())
+WORKERS = WorkerRegistry('stream-metrics:workers')
+
+_COUNTERS = {}  # stream: {field: total}
+_LOCK = threading.Lock()  # runserver handles messages in several threads
+_LOCAL = threading.local()  # The current message's counts, for count_sent
+_PUBLISHED = {'at': 0.0}
+
+
+def count_sent(messages, group_sends=0):
+    """Adds frames sent (and how many went to groups) to the message being recorded, if there is one"""
+    counts = getattr(_LOCAL, 'counts', None)
+    if counts is not None:
+        counts['group_sends'] += group_sends
+        counts['sent_bytes'] += sum(len(message['bytes']) if 'bytes' in message else len(message['text'].encode('utf8')) for message in messages)
+
+
+def enabled():
+    """Returns whether messages should be recorded"""
+    return getattr(settings, 'STREAM_METRICS', False)
+
+
+def get_counters():
+    """Returns {worker: {stream: {field: total}}} for every worker that has published, with this one up to date"""
+    keys = {'stream-metrics:{}'.format(worker): worker for worker in WORKERS.names()}
+    workers = {keys[key]: counters for key, counters in cache.get_many(list(keys)).items()}
+    with _LOCK:
+        if _COUNTERS:
+            workers[WORKER] = {stream: dict(counts) for stream, counts in _COUNTERS.items()}
+    return workers
+
+
+def publish():
+    """Puts this worker's counters in the cache"""
+    timeout = getattr(settings, 'STREAM_METRICS_TIMEOUT', 3600)
+    with _LOCK:
+        counters = {stream: dict(counts) for stream, counts in _COUNTERS.items()}
+        _PUBLISHED['at'] = time.monotonic()
+    cache.set('stream-metrics:{}'.format(WORKER), counters, timeout)
+    WORKERS.register(WORKER, timeout)
+
+
+@contextmanager
+def record(stream):
+    """Times the message handled inside the block and counts its queries and sends against the stream"""
+    counts = dict.fromkeys(FIELDS, 0)
+    counts['messages'] = 1
+    _LOCAL.counts = counts
+    started = time.perf_counter()
+    try:
+        with CaptureQueriesContext(connection) as queries:
+            yield
+    finally:
+        counts['handler_seconds'] = time.perf_counter() - started
+        counts['queries'] = len(queries)
+        counts['query_seconds'] = sum(float(query['time']) for query in queries.captured_queries)
+        _LOCAL.counts = None
+        with _LOCK:
+            totals = _COUNTERS.setdefault(stream, dict.fromkeys(FIELDS, 0))
+            for field, count in counts.items():
+                totals[field] += count
+            due = time.monotonic() - _PUBLISHED['at'] > getattr(settings, 'STREAM_METRICS_PUBLISH_INTERVAL', 10)
+        if due:
+            publish()
+
+
+def render_prometheus():
+    """Returns every worker's counters in the Prometheus text exposition format"""
+    workers = get_counters()
+    lines = []
+    for field, description in FIELDS.items():
+        name = 'cardgame_stream_{}_total'.format(field)
+        lines.extend(['# HELP {} {}'.format(name, description), '# TYPE {} counter'.format(name)])
+        for worker, counters in sorted(workers.items()):
+            for stream, counts in sorted(counters.items()):
+                lines.append('{}{{stream="{}",worker="{}"}} {}'.format(name, stream, worker, counts[field]))
+    return '\n'.join(lines) + '\n'
+
+
+def reset():
+    """Forgets this worker's counters"""
+    with _LOCK:
+        _COUNTERS.clear()
@@ -1,17 +1,124 @@
+import copy
+import json
 import logging
-
+import pickle
+import tempfile
+import time
+from collections import Counter, defaultdict
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+
+from channels import DEFAULT_CHANNEL_LAYER, Group, channel_layers
+from channels.message import Message
+from channels.sessions import session_for_reply_channel
 from channels.test import ChannelTestCase, WSClient
-
-from .game_logic import add_player_to_game
-from .models import Player, Game, CardGamePlayer, Card
+from redis.exceptions import ResponseError
+from django.core.cache import cache, caches
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.db.models import F
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from . import audience, card_catalog, frame_encodings, game_affinity, stream_metrics
+from .async_server import GameServer
+from .channel_layers import GROUP_SEND_STATS, BatchingRedisChannelLayer, GroupBatch, get_group_coalescer
+from .consumers import GameDemultiplexer, GameMultiplexer, close_evicted_connection, receive_forwarded
+from .frame_encodings import DeflateJsonEncoding, MsgpackEncoding, dumps_frame, get_group_encodings
+from .card_packs import import_cards
+from .checks import check_shared_cache
+from .forms import CreateGameForm, GameCodeForm, JoinGameForm
+from .game_codes import GameCodesExhausted, code_at, fill_game_code_pool, get_game_code_pool_stats
+from .game_index import game_exists, get_player_names
+from .game_logic import GameState, add_player_to_game, apply_game_writes, boot_player_from_game, create_game_code, draw_card, evict_absent_players, get_all_players_submitted, get_cards_in_hand_values_list, pick_card, reap_idle_games, replenish_hands, submit_card
+from .models import Player, Game, GameCode, CardGamePlayer, Card, Deck, Round
+from .state_store import get_state_store
+from .worker_registry import WorkerRegistry
 
 LOGGER = logging.getLogger("cardgame_channels_app")
 
 
+class StubRedis(object):
+    """Just enough of an in-memory redis.Redis to run BatchingRedisChannelLayer's group sends against"""
+
+    def __init__(self):
+        self.lists = defaultdict(list)
+        self.sorted_sets = defaultdict(dict)
+        self.counters = Counter()
+        self.errors = {}  # list key: error the send script raises for it
+        self.round_trips = 0
+
+    def pipeline(self, transaction=True):
+        return StubPipeline(self)
+
+    def register_script(self, source):
+        return lambda keys, args, client: client.queue(client.connection.run_script, source, keys, args)  # Runs on the pipeline's server, like a real Script
+
+    def run_script(self, source, keys, args):
+        if source != BatchingRedisChannelLayer.lua_chansend:
+            self.counters.update(keys)  # The statistics counters script
+        elif keys[1] in self.errors:
+            raise ResponseError(self.errors[keys[1]])
+        elif len(self.lists[keys[1]]) >= int(args[2]):
+            raise ResponseError('full')
+        else:
+            self.lists[keys[1]].append(args[0])
+
+    def zrange(self, key, start, end):
+        return [member.encode('utf8') for member in sorted(self.sorted_sets[key], key=self.sorted_sets[key].get)]
+
+    def zremrangebyscore(self, key, low, high):
+        expired = [member for member, score in self.sorted_sets[key].items() if low <= score <= high]
+        for member in expired:
+            del self.sorted_sets[key][member]
+        return len(expired)
+
+
+class StubPipeline(object):
+    """Queues StubRedis commands and runs them in one round trip, as a non-transactional redis pipeline would"""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.commands = []
+
+    def __getattr__(self, name):
+        return lambda *args: self.queue(getattr(self.connection, name), *args)
+
+    def __len__(self):
+        return len(self.commands)
+
+    def queue(self, command, *args):
+        self.commands.append((command, args))
+
+    def execute(self, raise_on_error=True):
+        results = []
+        for command, args in self.commands:
+            try:
+                results.append(command(*args))
+            except ResponseError as error:
+                results.append(error)
+        self.commands = []
+        self.connection.round_trips += 1
+        errors = [result for result in results if isinstance(result, ResponseError)]
+        if raise_on_error and errors:
+            raise errors[0]
+        return results
+
+
+class StubRedisChannelLayer(BatchingRedisChannelLayer):
+    """BatchingRedisChannelLayer with a StubRedis for each host"""
+
+    def _generate_connections(self, hosts, redis_kwargs):
+        return [StubRedis() for _ in hosts]
+
+
 class GameModelTests(ChannelTestCase):
-    fixtures = ['test_card_data.json']  # 100 green and 100 red cards
+    fixtures = ['test_card_data.json']  # 50 green and 50 red cards
 
     def setUp(self):
+        cache.clear()  # The game index outlives each test's database
         self.game1 = Game.objects.create(pk=1, code='abcd')
 
     def test_cards(self):
@@ -32,13 +139,301 @@ class GameModelTests(ChannelTestCase):
     def test_game(self):
         self.assertIsNotNone(str(self.game1))
 
+    def test_create_game_code_shuffles_decks(self):
+        game = Game.objects.get(code=create_game_code())
+        self.assertEqual(50, len(game.green_deck.split(',')))
+        self.assertEqual(50, len(game.red_deck.split(',')))
+        self.assertEqual(0, game.red_deck_position)
+
+    @override_settings(GAME_CODE_POOL_BATCH=3)
+    def test_game_code_pool(self):
+        GameCode.objects.create(code='abcd')  # Stale entry for a code that is in use
+        game_codes = [create_game_code() for _ in range(4)]
+        self.assertEqual(4, len(set(game_codes)))
+        self.assertNotIn('abcd', game_codes)
+        self.assertEqual(2, GameCode.objects.count())  # Left from the second refill of 3
+
+        # Deleted games go to the back of the pool
+        Game.objects.get(code=game_codes[0]).delete()
+        self.assertEqual(game_codes[0], GameCode.objects.last().code)
+        self.assertEqual({'capacity': 456976, 'in_use': 4, 'pooled': 3, 'unpooled': 456969, 'occupancy': 4 / 456976}, get_game_code_pool_stats())
+
+        # Codes are sampled by index, and a refill that collides with a concurrent one leaves its codes be
+        self.assertEqual(('aaaa', 'aaab', 'zzzz'), (code_at(0), code_at(1), code_at(456975)))
+        with mock.patch('cardgame_channels_app.game_codes._sample_free_codes', return_value=['zzzy', game_codes[0]]):
+            self.assertEqual(0, fill_game_code_pool(2))
+        self.assertFalse(GameCode.objects.filter(code='zzzy').exists())
+
+        # The pool is kept topped up outside of game creation
+        call_command('game_code_pool', keep=10, stdout=StringIO())
+        self.assertEqual(10, GameCode.objects.count())
+
+    def test_reap_idle_games(self):
+        idle_codes = [create_game_code(), create_game_code()]
+        live_code = create_game_code()
+        for game_code in idle_codes + [live_code]:
+            add_player_to_game(game_code, 'tim')
+        Game.objects.exclude(pk=self.game1.pk).update(date_updated=timezone.now() - timedelta(hours=2))
+        add_player_to_game(live_code, 'bob')  # Playing marks the game active
+
+        batches = list(reap_idle_games(3600, batch_size=1))
+        self.assertEqual([(1, 1, 6), (1, 1, 6)], [(batch['games'], batch['players'], batch['cards']) for batch in batches])
+        self.assertEqual(['abcd', live_code], sorted(Game.objects.values_list('code', flat=True)))
+        self.assertEqual(set(idle_codes), set(GameCode.objects.filter(code__in=idle_codes).values_list('code', flat=True)))
+        self.assertEqual(11, CardGamePlayer.objects.count())  # tim's hand and green card, and bob's hand
+
+    def test_game_index(self):
+        add_player_to_game(self.game1.code, 'Tim')
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual({'tim'}, get_player_names('abcd'))
+            self.assertFalse(JoinGameForm({'game_code': 'ABCD', 'player_name': 'TIM'}).is_valid())
+            self.assertFalse(GameCodeForm({'game_code': 'zzzz'}).is_valid())
+            self.assertFalse(GameCodeForm({'game_code': 'zzzz'}).is_valid())
+        self.assertEqual(2, len(queries))  # One load for each game code
+
+        # Joining and booting players, and deleting games, keep the index in sync
+        bob = add_player_to_game(self.game1.code, 'bob')
+        self.assertEqual({'tim', 'bob'}, get_player_names('abcd'))
+        boot_player_from_game(self.game1.code, bob.pk)
+        self.assertEqual({'tim'}, get_player_names('abcd'))
+        game_code = create_game_code()
+        with self.assertNumQueries(0):
+            self.assertEqual(set(), get_player_names(game_code))
+        Game.objects.get(code=game_code).delete()
+        self.assertFalse(game_exists(game_code))
+
+    def test_shared_cache_check(self):
+        self.assertEqual([], check_shared_cache(None))
+        with self.settings(GAME_AFFINITY=True, STREAM_METRICS=True):
+            self.assertEqual(['cardgame_channels_app.W001'] * 2, [warning.id for warning in check_shared_cache(None)])
+        with self.settings(GAME_AFFINITY=True, CACHES={'default': {'BACKEND': 'django_redis.cache.RedisCache', 'LOCATION': 'redis://redis:6379/1'}}):
+            self.assertEqual([], check_shared_cache(None))
+        with self.settings(CHANNEL_LAYERS={'default': {'BACKEND': 'asgi_redis.RedisChannelLayer', 'ROUTING': 'cardgame_channels_app.routing.channel_routing'}}):  # Workers in processes of their own
+            self.assertEqual(['CHANNEL_SESSION_ENGINE', 'Frame'], [warning.msg.split()[0] for warning in check_shared_cache(None)])
+
+    def test_draw_card_deals_from_deck(self):
+        player = add_player_to_game(self.game1.code, 'tim')  # game1 has no decks yet, so they are shuffled on first draw
+        draw_card(self.game1, player, Card.RED, 45)
+        self.game1.refresh_from_db()
+        self.assertEqual(50, self.game1.red_deck_position)
+        self.assertEqual(self.game1.red_deck.split(','), [str(card_pk) for card_pk in CardGamePlayer.objects.filter(game=self.game1, status=CardGamePlayer.HAND).order_by('pk').values_list('card_id', flat=True)])
+
+        # Deck is empty, so nothing more is dealt
+        draw_card(self.game1, player, Card.RED, 1)
+        self.assertEqual(50, CardGamePlayer.objects.filter(game=self.game1, status=CardGamePlayer.HAND).count())
+
+    def test_replenish_hands_query_count(self):
+        query_counts = []
+        for player_count in (3, 8):
+            game_code = create_game_code()
+            for player_number in range(player_count):
+                add_player_to_game(game_code, 'player{}'.format(player_number))
+            for player in Player.objects.filter(game__code=game_code):  # Play a card from each hand
+                CardGamePlayer.objects.filter(pk__in=player.cardgameplayer_set.filter(status=CardGamePlayer.HAND).values_list('pk', flat=True)[:1]).update(status=CardGamePlayer.LOST)
+                Player.objects.filter(pk=player.pk).update(hand_size=F('hand_size') - 1)
+
+            with CaptureQueriesContext(connection) as queries:
+                replenish_hands(game_code)
+            query_counts.append(len(queries))
+
+            for player in Player.objects.filter(game__code=game_code):
+                self.assertEqual(5, player.cardgameplayer_set.filter(status=CardGamePlayer.HAND).count())
+        self.assertEqual(query_counts[0], query_counts[1])
+
+    def test_pick_card_statement_count(self):
+        query_counts = []
+        for player_count in (3, 6):
+            game_code = create_game_code()
+            for player_number in range(player_count):
+                add_player_to_game(game_code, 'player{}'.format(player_number))
+            for player in Player.objects.filter(game__code=game_code, status=Player.WAITING):
+                submitted_card_pk = player.cardgameplayer_set.filter(status=CardGamePlayer.HAND).first().card_id
+                submit_card(game_code, submitted_card_pk)
+
+            with CaptureQueriesContext(connection) as queries:
+                cgp = pick_card(game_code, submitted_card_pk)
+            query_counts.append(len(queries))
+
+            winner = Player.objects.get(pk=cgp.player_id)
+            self.assertEqual((1, Player.JUDGE), (winner.score, winner.status))
+            self.assertEqual(player_count - 1, Player.objects.filter(game__code=game_code, status=Player.WAITING).count())
+            self.assertEqual(1, CardGamePlayer.objects.filter(game__code=game_code, status=CardGamePlayer.MATCHING, player=winner).count())
+            finished_round = Round.objects.get(game__code=game_code)
+            self.assertEqual((1, winner.pk, submitted_card_pk), (finished_round.number, finished_round.winner_id, finished_round.picked_card_id))
+            self.assertEqual(player_count - 1, len(finished_round.submitted_cards.split(',')))
+            self.assertEqual(player_count * 5 + 1, CardGamePlayer.objects.filter(game__code=game_code).count())  # Only the cards in play
+            self.assertEqual(player_count * 5, CardGamePlayer.objects.filter(game__code=game_code, status=CardGamePlayer.HAND).count())
+
+            # A duplicate pick is ignored
+            self.assertIsNone(pick_card(game_code, submitted_card_pk))
+            self.assertEqual(1, Player.objects.get(pk=winner.pk).score)
+        self.assertEqual(query_counts[0], query_counts[1])
+
+        # Deleting a card keeps the rounds it was played in
+        Card.objects.filter(pk=submitted_card_pk).delete()
+        self.assertEqual([None], list(Round.objects.filter(game__code=game_code).values_list('picked_card_id', flat=True)))
+
+    def test_round_counters(self):
+        tim = add_player_to_game(self.game1.code, 'tim')
+        bob = add_player_to_game(self.game1.code, 'bob')
+        sue = add_player_to_game(self.game1.code, 'sue')
+        self.assertEqual([5, 5, 5], [Player.objects.get(pk=player.pk).hand_size for player in (tim, bob, sue)])
+        self.assertEqual((0, 2), Game.objects.values_list('round', 'waiting_player_count').get(pk=self.game1.pk))
+
+        bobs_card_pk = bob.cardgameplayer_set.filter(status=CardGamePlayer.HAND).first().card_id
+        submit_card(self.game1.code, bobs_card_pk)
+        self.assertEqual(4, Player.objects.get(pk=bob.pk).hand_size)
+        self.assertFalse(get_all_players_submitted(self.game1.code))
+        submit_card(self.game1.code, sue.cardgameplayer_set.filter(status=CardGamePlayer.HAND).first().card_id)
+        self.assertTrue(get_all_players_submitted(self.game1.code))
+
+        pick_card(self.game1.code, bobs_card_pk)
+        self.assertEqual((1, 2), Game.objects.values_list('round', 'waiting_player_count').get(pk=self.game1.pk))
+        self.assertEqual([5, 5, 5], [Player.objects.get(pk=player.pk).hand_size for player in (tim, bob, sue)])
+
+        # Booting a waiting player takes them out of the count
+        boot_player_from_game(self.game1.code, sue.pk)
+        self.assertEqual(1, Game.objects.get(pk=self.game1.pk).waiting_player_count)
+
+    def test_submit_card_duplicate(self):
+        add_player_to_game(self.game1.code, 'tim')
+        bob = add_player_to_game(self.game1.code, 'bob')
+        card_pk = bob.cardgameplayer_set.filter(status=CardGamePlayer.HAND).first().card_id
+        self.assertEqual(CardGamePlayer.SUBMITTED, submit_card(self.game1.code, card_pk).status)
+        self.assertIsNone(submit_card(self.game1.code, card_pk))
+        self.assertEqual(Player.SUBMITTED, Player.objects.get(pk=bob.pk).status)
+
+    def test_game_state(self):
+        tim = add_player_to_game(self.game1.code, 'tim')
+        bob = add_player_to_game(self.game1.code, 'bob')
+        submitted_card = bob.cardgameplayer_set.filter(status=CardGamePlayer.HAND).first()
+        submit_card(self.game1.code, submitted_card.card_id)
+
+        card_catalog.get_card(submitted_card.card_id)  # Loads the catalog
+        with CaptureQueriesContext(connection) as queries:
+            state = GameState(self.game1.code)
+            self.assertEqual(['bob', 'tim'], [player.get('name') for player in state.players])
+            self.assertEqual(tim.pk, state.judge.get('pk'))
+            self.assertEqual('matching', state.green_card.get('status'))
+            self.assertEqual([submitted_card.card_id], [card.get('pk') for card in state.submitted_cards])
+            self.assertEqual(4, len(state.get_hand(bob.pk)))
+            self.assertEqual(5, len(state.get_hand(tim.pk)))
+            self.assertTrue(state.all_players_submitted)
+        self.assertEqual(2, len(queries))
+
+    @override_settings(GAME_STATE_STORE={'BACKEND': 'cardgame_channels_app.state_store.LocalStateStore'})
+    def test_state_store(self):
+        tim = add_player_to_game(self.game1.code, 'tim')
+        bob = add_player_to_game(self.game1.code, 'bob')
+        GameState(self.game1.code)  # Loads the game into the store
+        card_pk = bob.cardgameplayer_set.filter(status=CardGamePlayer.HAND).first().card_id
+
+        # Turns are played against the store without touching the database
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(bob.pk, submit_card(self.game1.code, card_pk).player_id)
+            self.assertIsNone(submit_card(self.game1.code, card_pk))
+            self.assertEqual(bob.pk, pick_card(self.game1.code, card_pk).player_id)
+            self.assertIsNone(pick_card(self.game1.code, card_pk))  # The picked card has left play
+            state = GameState(self.game1.code)
+        self.assertEqual(0, len(queries))
+        self.assertEqual(bob.pk, state.judge.get('pk'))
+        self.assertEqual(5, len(state.get_hand(bob.pk)))
+        self.assertEqual(5, len(state.get_hand(tim.pk)))
+        self.assertEqual(CardGamePlayer.HAND, CardGamePlayer.objects.get(game=self.game1, card_id=card_pk).status)
+
+        # Queued writes bring the database up to date with the store
+        self.assertEqual(2, apply_game_writes(get_state_store(), self.game1.code))
+        with self.settings(GAME_STATE_STORE=None):
+            database_state = GameState(self.game1.code)
+        self.assertEqual(state.players, database_state.players)
+        self.assertEqual(sorted(map(tuple, state.cards)), sorted(database_state.cards))
+        self.assertEqual([(bob.pk, card_pk)], list(Round.objects.filter(game=self.game1).values_list('winner_id', 'picked_card_id')))
+        self.assertFalse(CardGamePlayer.objects.filter(game=self.game1, card_id=card_pk).exists())
+
+    def test_card_catalog(self):
+        self.addCleanup(card_catalog.invalidate)  # Test rollback does not fire the Card signals
+        player = add_player_to_game(self.game1.code, 'tim')
+        get_cards_in_hand_values_list(player)  # Loads the catalog
+        with CaptureQueriesContext(connection) as queries:
+            cards = get_cards_in_hand_values_list(player)
+        self.assertEqual(1, len(queries))  # Only the CardGamePlayer lookup
+        self.assertEqual(5, len(cards))
+        self.assertEqual(sorted(card.get('name') for card in cards), [card.get('name') for card in cards])
+
+        # Saving a card invalidates the catalog
+        card = Card.objects.get(pk=cards[0].get('pk'))
+        card.name = 'Renamed'
+        card.save()
+        self.assertIn('Renamed', [card.get('name') for card in get_cards_in_hand_values_list(player)])
+
+    def test_frame_json(self):
+        self.addCleanup(card_catalog.invalidate)
+        cards = get_cards_in_hand_values_list(add_player_to_game(self.game1.code, 'tim'))
+        self.assertIs(cards[0], card_catalog.get_card_values(cards[0]['pk']))  # Shared, so each card is encoded once
+        with self.assertRaises(TypeError):
+            cards[0]['status'] = 'matching'
+        for copied in (pickle.loads(pickle.dumps(cards[0])), copy.copy(cards[0]), copy.deepcopy({'cards': cards})['cards'][0]):
+            self.assertEqual(dict(cards[0]), copied)
+            copied['status'] = 'matching'  # Copies are plain dicts
+
+        # Card lists are spliced in already encoded, and the frame reads the same as one encoded whole
+        content = {'stream': 'new_cards', 'payload': {'data': {'game_code': 'abcd', 'cards': cards, 'card': cards[0]}}}
+        text = dumps_frame(content)
+        self.assertIn(cards[1].json, text)
+        self.assertEqual(json.loads(json.dumps(content)), json.loads(text))
+
+        # An encoder that isn't installed falls back to the json module
+        with override_settings(FRAME_JSON_ENCODER='orjson'), mock.patch.dict('sys.modules', {'orjson': None}), mock.patch.dict(frame_encodings._DUMPS, clear=True):
+            self.assertEqual(json.loads(json.dumps(content)), json.loads(dumps_frame(content)))
+
+    def test_card_packs(self):
+        self.addCleanup(card_catalog.invalidate)
+        rows = [{'name': 'Green {}'.format(number), 'type': 'green'} for number in range(3)] + [{'name': 'Red {}'.format(number), 'type': 'red', 'text': 'old'} for number in range(6)]
+        self.assertEqual([2, 2, 2, 2, 1], [chunk['created'] for chunk in import_cards(rows, 'Starter', chunk_size=2)])
+
+        # Importing again updates cards by key, and rows can name their own deck
+        rows[3]['text'] = 'new'
+        rows.append({'name': 'Red 9', 'type': 'red', 'deck': 'Extra'})
+        self.assertEqual([{'cards': 10, 'created': 1, 'updated': 1, 'added_to_decks': 1}], list(import_cards(rows, 'Starter')))
+        self.assertEqual('new', Card.objects.get(key='red:Red 0').text)
+        with tempfile.NamedTemporaryFile('w', suffix='.csv') as pack:
+            pack.write('name,type,text\nGreen 0,green,fresh\n')
+            pack.flush()
+            call_command('import_cards', pack.name, deck='Greens', stdout=StringIO())
+        self.assertEqual('fresh', Card.objects.get(key='green:Green 0').text)
+        self.assertEqual(['Greens', 'Starter'], list(Deck.objects.filter(deckcard__type=Card.GREEN).distinct().values_list('name', flat=True)))
+
+        # Games draw only from their decks' memberships
+        starter = Deck.objects.get(name='Starter')
+        create_game_form = CreateGameForm({'decks': ['Starter', 'Extra']})
+        self.assertTrue(create_game_form.is_valid())
+        self.assertEqual(sorted(Deck.objects.filter(name__in=['Starter', 'Extra']).values_list('pk', flat=True)), create_game_form.cleaned_data['deck_pks'])
+        self.assertFalse(CreateGameForm({'decks': ['Nope']}).is_valid())
+        self.assertFalse(CreateGameForm({'decks': ['Greens']}).is_valid())  # No red cards to deal
+        with CaptureQueriesContext(connection) as queries:
+            game_code = create_game_code([starter.pk])
+        self.assertFalse([query for query in queries if 'FROM "cardgame_channels_app_card"' in query['sql']])
+        game = Game.objects.get(code=game_code)
+        self.assertEqual(set(starter.cards.filter(type=Card.RED).values_list('pk', flat=True)), {int(card_pk) for card_pk in game.red_deck.split(',')})
+        self.assertEqual([starter.pk], list(game.decks.values_list('pk', flat=True)))
+        player = add_player_to_game(game_code, 'tim')
+        self.assertTrue(set(player.cards.values_list('pk', flat=True)) <= set(starter.cards.values_list('pk', flat=True)))
+
 
 class GameConsumerTests(ChannelTestCase):
-    fixtures = ['test_card_data.json']  # 100 green and 100 red cards
+    fixtures = ['test_card_data.json']  # 50 green and 50 red cards
 
     def setUp(self):
+        cache.clear()  # The game index outlives each test's database
         self.game1 = Game.objects.create(pk=1, code='abcd')
 
+    @staticmethod
+    def bind_player(client, player):
+        """Binds a connection to a player added with add_player_to_game, as joining over the connection would"""
+        session = session_for_reply_channel(client.reply_channel)
+        session.update({'game_code': player.game.code, 'game_id': player.game_id, 'player_id': player.pk})
+        session.save()
+
     def test_create_game(self):
         client = WSClient()
 
@@ -50,6 +445,13 @@ class GameConsumerTests(ChannelTestCase):
         self.assertEqual(receive_reply.get('stream'), 'create_game')
         self.assertEqual(4, len(receive_reply.get('payload').get('data').get('game_code')))
 
+        # Running out of codes is an error reply, not a dropped frame
+        with mock.patch('cardgame_channels_app.game_logic.allocate_game_code', side_effect=GameCodesExhausted('All 456976 game codes are in use')):
+            client.send_and_consume('websocket.receive', path='/game/', text={'stream': 'create_game', 'payload': {}})
+        data = client.receive().get('payload').get('data')
+        self.assertEqual('create game failed', data.get('error'))
+        self.assertEqual({'__all__': ['All 456976 game codes are in use']}, data.get('errors'))
+
         disconnect_consumer = client.send_and_consume('websocket.disconnect', path='/game/')
         disconnect_consumer.close()
 
@@ -122,14 +524,18 @@ class GameConsumerTests(ChannelTestCase):
         receive_reply = client.receive()  # receive() grabs the content of the next message off of the client's reply_channel
         LOGGER.debug(receive_reply)
         self.assertEqual('join_game', receive_reply.get('stream'))
+        data = receive_reply.get('payload').get('data')
+        self.assertEqual(1, len(data.get('players')))
+        self.assertEqual(1, data.get('version'))
 
         # Player Joined Group Event
         receive_reply = client.receive()  # receive() grabs the content of the next message off of the client's reply_channel
         LOGGER.debug(receive_reply)
         self.assertEqual('player_joined_game', receive_reply.get('stream'))
         data = receive_reply.get('payload').get('data')
-        self.assertEqual(1, len(data.get('players')))
-        self.assertEqual('judge', data.get('players')[0].get('status'))
+        self.assertNotIn('players', data)  # Only the new player is broadcast
+        self.assertEqual(1, data.get('version'))
+        self.assertEqual('judge', data.get('player').get('status'))
         self.assertEqual('tim', data.get('player').get('name'))
 
         tim = Player.objects.get(name='tim')
@@ -139,6 +545,243 @@ class GameConsumerTests(ChannelTestCase):
         disconnect_consumer = client.send_and_consume('websocket.disconnect', path='/game/')
         disconnect_consumer.close()
 
+    def test_join_game_encodings(self):
+        json_client = WSClient()
+        json_client.send_and_consume('websocket.connect', path='/game/')  # Connect is forwarded to ALL multiplexed consumers under this demultiplexer
+        while json_client.receive():
+            pass  # Grab connection success message from each consumer
+        json_client.send_and_consume('websocket.receive', path='/game/', text={'stream': 'join_game', 'payload': {'game_code': 'abcd', 'player_name': 'tim'}})  # Text arg is JSON as if it came from browser
+        while json_client.receive():
+            pass
+
+        # Binary frames in and out for a msgpack connection
+        msgpack_client = WSClient()
+        msgpack_client.send_and_consume('websocket.connect', path='/game/?encoding=msgpack')
+        while msgpack_client.receive():
+            pass  # Grab connection success message from each consumer
+        msgpack_client.send_and_consume('websocket.receive', {'bytes': MsgpackEncoding.encode({'stream': 'join_game', 'payload': {'game_code': 'abcd', 'player_name': 'bob'}})['bytes']}, path='/game/')
+        receive_reply = MsgpackEncoding.decode(msgpack_client.receive(json=False)['bytes'])
+        self.assertEqual('join_game', receive_reply.get('stream'))
+        self.assertEqual(2, len(receive_reply.get('payload').get('data').get('players')))
+        receive_reply = MsgpackEncoding.decode(msgpack_client.receive(json=False)['bytes'])
+        self.assertEqual('player_joined_game', receive_reply.get('stream'))
+        self.assertEqual('bob', receive_reply.get('payload').get('data').get('player').get('name'))
+
+        # The same broadcast reaches the JSON connection as text
+        receive_reply = json_client.receive()
+        self.assertEqual('player_joined_game', receive_reply.get('stream'))
+        self.assertEqual('bob', receive_reply.get('payload').get('data').get('player').get('name'))
+        self.assertIsNone(json_client.receive())
+
+        # Broadcasts are only encoded for the encodings in use in each group
+        self.assertEqual({'abcd': ['json', 'msgpack'], 'audience_abcd': ['json', 'json-deflate', 'msgpack']}, get_group_encodings(['abcd', 'audience_abcd']))  # Nobody counted into the audience, so it could be anyone
+        msgpack_client.send_and_consume('websocket.disconnect', path='/game/')
+        self.assertEqual({'abcd': ['json']}, get_group_encodings(['abcd']))
+        self.assertEqual(['abcd'], [group for group, _ in GameMultiplexer.encode_for_groups('player_joined_game', [('abcd', {})])])
+
+        # A join keeps every count in the group, and a group whose counts the cache lost gets every encoding
+        with mock.patch.object(cache, 'touch', create=True) as touch:
+            frame_encodings.add_group_encoding('abcd', 'json')
+        self.assertEqual(['group-encodings:abcd:json', 'group-encodings:abcd:json-deflate', 'group-encodings:abcd:msgpack'], sorted(call[0][0] for call in touch.call_args_list))
+        cache.delete_many(['group-encodings:abcd:json', 'group-encodings:abcd:msgpack'])
+        self.assertEqual({'abcd': ['json', 'json-deflate', 'msgpack']}, get_group_encodings(['abcd']))
+
+        # Compressed JSON round trips
+        self.assertEqual({'stream': 'join_game', 'payload': {}}, DeflateJsonEncoding.decode(DeflateJsonEncoding.encode({'stream': 'join_game', 'payload': {}})['bytes']))
+
+        # Unknown encodings are refused
+        with self.assertRaises(AssertionError):
+            WSClient().send_and_consume('websocket.connect', path='/game/?encoding=xml')
+
+    def test_async_server_replies_directly(self):
+        server = GameServer(threads=1)
+        server.loop = mock.Mock(call_soon_threadsafe=lambda callback, message: callback(message))
+        connection = mock.Mock()
+        server.connections[server.reply_prefix + '1'] = connection
+        server.consume('websocket.connect', {'reply_channel': server.reply_prefix + '1', 'path': '/game/', 'query_string': '', 'order': 0})
+        server.consume('websocket.receive', {'reply_channel': server.reply_prefix + '1', 'path': '/game/', 'order': 1, 'text': json.dumps({'stream': 'create_game', 'payload': {}})})
+        server.stop()
+
+        # The accept and the reply skip the channel layer
+        messages = [call[0][0] for call in connection.deliver.call_args_list]
+        self.assertTrue(messages[0]['accept'])
+        self.assertEqual('create_game', json.loads(messages[-1]['text'])['stream'])
+        self.assertEqual((None, None), server.channel_layer.receive_many([server.reply_prefix]))
+
+    @override_settings(GAME_AFFINITY=True, GAME_AFFINITY_REFRESH=0)
+    def test_game_affinity(self):
+        # Only the games of a worker that leaves get a new owner
+        game_codes = ['{:04d}'.format(number) for number in range(200)]
+        owners = {game_code: game_affinity.get_owner(game_code, ('a', 'b', 'c')) for game_code in game_codes}
+        self.assertEqual({'a', 'b', 'c'}, set(owners.values()))
+        for game_code in game_codes:
+            if owners[game_code] != 'c':
+                self.assertEqual(owners[game_code], game_affinity.get_owner(game_code, ('a', 'b')))
+
+        client = WSClient()
+        client.send_and_consume('websocket.connect', path='/game/')
+        while client.receive():
+            pass  # Grab connection success message from each consumer
+
+        # A frame about a game another worker owns is forwarded to it
+        game_affinity.register_worker('other')
+        client.send_and_consume('websocket.receive', path='/game/', text={'stream': 'join_game', 'payload': {'game_code': 'abcd', 'player_name': 'tim'}})
+        self.assertIsNone(client.receive())
+        self.assertFalse(Player.objects.exists())
+        forwarded = client.get_next_message('game.worker.other')
+        self.assertEqual('other', forwarded['game_worker'])
+
+        # and handled there, replying to the connection as usual
+        game_affinity.set_worker('other')
+        try:
+            receive_forwarded(Message(forwarded.content, forwarded.channel.name, forwarded.channel_layer))
+        finally:
+            game_affinity.set_worker(None)
+        self.assertEqual('join_game', client.receive().get('stream'))
+        self.assertEqual(['tim'], list(Player.objects.values_list('name', flat=True)))
+        while client.receive():
+            pass  # player_joined_game broadcast
+
+        # With no game workers, every process handles its own frames
+        game_affinity.unregister_worker('other')
+        client.send_and_consume('websocket.receive', path='/game/', text={'stream': 'validate_game_code', 'payload': {'game_code': 'abcd'}})
+        self.assertEqual('validate_game_code', client.receive().get('stream'))
+
+    @override_settings(GAME_AFFINITY=True, GAME_AFFINITY_REFRESH=0, GAME_STATE_STORE={'BACKEND': 'cardgame_channels_app.state_store.LocalStateStore'})
+    def test_game_affinity_rebalance(self):
+        add_player_to_game(self.game1.code, 'tim')
+        newcomer = next(name for name in 'bcdefgh' if game_affinity.get_owner(self.game1.code, ('a', name)) == name)
+        game_affinity.set_worker('a')
+        game_affinity.register_worker('a')
+        try:
+            self.assertEqual(('a',), game_affinity.get_workers())
+            GameState(self.game1.code)  # Loads the game into the store
+            store = get_state_store()
+
+            # A worker joining takes the game over only once the heartbeat's nudge reaches the owner's own loop
+            game_affinity.register_worker(newcomer)
+            self.assertIn(self.game1.code, store.games)
+            game_affinity.request_rebalance('a', channel_layers[DEFAULT_CHANNEL_LAYER])
+            nudge = self.get_next_message('game.worker.a', require=True)
+            receive_forwarded(Message(nudge.content, nudge.channel.name, nudge.channel_layer))
+            self.assertNotIn(self.game1.code, store.games)
+        finally:
+            game_affinity.unregister_worker(newcomer)
+            game_affinity.unregister_worker('a')
+            game_affinity.set_worker(None)
+            game_affinity.get_workers()
+
+        # Commands run in a process of their own, which can't reach the worker's LocalStateStore
+        for command in ('evict_absent_players', 'reap_idle_games'):
+            with self.assertRaises(CommandError):
+                call_command(command, stdout=StringIO())
+
+    @override_settings(GAME_AFFINITY=True, GAME_AFFINITY_REFRESH=0, GAME_STATE_STORE={'BACKEND': 'cardgame_channels_app.state_store.LocalStateStore'})
+    def test_game_affinity_handover(self):
+        tim = add_player_to_game(self.game1.code, 'tim')
+        bob = add_player_to_game(self.game1.code, 'bob')
+        ann = add_player_to_game(self.game1.code, 'ann')
+        card_pks = {player.pk: player.cardgameplayer_set.filter(status=CardGamePlayer.HAND).first().card_id for player in (bob, ann)}
+        newcomer = next(name for name in 'bcdefgh' if game_affinity.get_owner(self.game1.code, ('a', name)) == name)
+        store = get_state_store()
+        client = WSClient()
+        client.send_and_consume('websocket.connect', path='/game/')
+        while client.receive():
+            pass  # Grab connection success message from each consumer
+
+        def move(player, stream, card_pk):
+            """Sends a move from a process that is no game worker, which forwards it to the game's owner"""
+            game_affinity.set_worker(None)
+            self.bind_player(client, player)
+            client.send_and_consume('websocket.receive', path='/game/', text={'stream': stream, 'payload': {'game_code': self.game1.code, 'card_pk': card_pk}})
+
+        def handle(worker):
+            """Handles the next message on a game worker's channel, as that worker"""
+            game_affinity.set_worker(worker)
+            message = self.get_next_message(game_affinity.WORKER_CHANNEL_PREFIX + worker, require=True)
+            receive_forwarded(Message(message.content, message.channel.name, message.channel_layer))
+
+        def status(card_pk):
+            return CardGamePlayer.objects.get(game=self.game1, card_id=card_pk).status
+
+        game_affinity.register_worker('a')
+        try:
+            # The owner plays against its store, leaving the database behind
+            move(bob, 'submit_card', card_pks[bob.pk])
+            handle('a')
+            self.assertEqual(CardGamePlayer.HAND, status(card_pks[bob.pk]))
+            self.assertEqual('a', cache.get('game-affinity:lease:{}'.format(self.game1.code)))
+
+            # A move made while the game changes hands goes to the new owner, which passes it on to the holder
+            game_affinity.register_worker(newcomer)
+            move(ann, 'submit_card', card_pks[ann.pk])
+            handle(newcomer)
+            self.assertIsNone(self.get_next_message(game_affinity.WORKER_CHANNEL_PREFIX + newcomer))
+            handle('a')  # Plays the move, then writes out and drops the game it no longer owns
+            self.assertEqual([CardGamePlayer.SUBMITTED] * 2, [status(card_pk) for card_pk in card_pks.values()])
+            self.assertNotIn(self.game1.code, store.games)
+            self.assertIsNone(cache.get('game-affinity:lease:{}'.format(self.game1.code)))
+            while client.receive():
+                pass
+
+            # The new owner loads the game with both moves, and writes its own out when its heartbeat nudges it
+            move(tim, 'pick_card', card_pks[ann.pk])
+            handle(newcomer)
+            self.assertIn(self.game1.code, store.games)  # Picked in the store, whose round the database doesn't have yet
+            self.assertFalse(Round.objects.filter(game=self.game1).exists())
+            game_affinity.request_rebalance(newcomer, channel_layers[DEFAULT_CHANNEL_LAYER])
+            handle(newcomer)
+            self.assertEqual([(ann.pk, card_pks[ann.pk])], list(Round.objects.filter(game=self.game1).values_list('winner_id', 'picked_card_id')))
+            self.assertIn(self.game1.code, store.games)
+        finally:
+            game_affinity.unregister_worker(newcomer)
+            game_affinity.unregister_worker('a')
+            game_affinity.set_worker(None)
+            game_affinity.get_workers()
+            cache.delete('game-affinity:lease:{}'.format(self.game1.code))
+
+    @override_settings(STREAM_METRICS=True)
+    def test_stream_metrics(self):
+        stream_metrics.reset()
+        client = WSClient()
+        client.send_and_consume('websocket.connect', path='/game/')
+        while client.receive():
+            pass  # Grab connection success message from each consumer
+        client.send_and_consume('websocket.receive', path='/game/', text={'stream': 'join_game', 'payload': {'game_code': 'abcd', 'player_name': 'tim'}})
+        with self.assertRaises(ValueError):  # Still counted, under one label however many unknown streams clients make up
+            client.send_and_consume('websocket.receive', path='/game/', text={'stream': 'nonsense', 'payload': {}})
+        while client.receive():
+            pass
+
+        counts = stream_metrics.get_counters()[stream_metrics.WORKER]['join_game']
+        self.assertEqual(1, counts['messages'])
+        self.assertGreater(counts['queries'], 0)
+        self.assertEqual(1, counts['group_sends'])  # player_joined_game, the join_game reply goes straight back
+        self.assertGreater(counts['sent_bytes'], 0)
+        self.assertEqual(1, stream_metrics.get_counters()[stream_metrics.WORKER]['unknown']['messages'])
+
+        response = self.client.get('/metrics')
+        self.assertEqual(200, response.status_code)
+        self.assertIn('cardgame_stream_messages_total{{stream="join_game",worker="{}"}} 1'.format(stream_metrics.WORKER), response.content.decode('utf8'))
+
+        # Nothing is recorded when metrics are off
+        stream_metrics.reset()
+        with override_settings(STREAM_METRICS=False):
+            client.send_and_consume('websocket.receive', path='/game/', text={'stream': 'validate_game_code', 'payload': {'game_code': 'abcd'}})
+        self.assertNotIn('validate_game_code', stream_metrics.get_counters().get(stream_metrics.WORKER, {}))
+
+    def test_worker_registry(self):
+        first, second = WorkerRegistry('test-workers'), WorkerRegistry('test-workers')  # As two processes
+        self.assertTrue(first.register('a', 60))
+        with mock.patch.object(cache, 'get_many', return_value={}):  # Both see slot 0 free, only cache.add decides
+            self.assertTrue(second.register('b', 60))
+        self.assertTrue(first.register('a', 60))  # Renewed in place
+        self.assertEqual(['a', 'b'], first.names())
+        with self.assertLogs(LOGGER, logging.WARNING):
+            self.assertFalse(WorkerRegistry('test-workers', slots=2).register('c', 60))
+        second.unregister('b')
+        self.assertEqual(['a'], second.names())
+
     def test_validate_game_code(self):
         client = WSClient()
 
@@ -248,6 +891,7 @@ class GameConsumerTests(ChannelTestCase):
         self.assertEqual(receive_reply.get('stream'), 'boot_player')
         self.assertEqual(self.game1.code, receive_reply.get('payload').get('data').get('game_code'))
         self.assertEqual('bob', receive_reply.get('payload').get('data').get('player_name'))
+        self.assertEqual(bob_pk, receive_reply.get('payload').get('data').get('player_pk'))
         self.assertTrue(receive_reply.get('payload').get('data').get('valid'))
         self.assertFalse(Player.objects.filter(pk=bob_pk))
 
@@ -261,6 +905,94 @@ class GameConsumerTests(ChannelTestCase):
         disconnect_consumer = client.send_and_consume('websocket.disconnect', path='/game/')
         disconnect_consumer.close()
 
+    def test_presence(self):
+        add_player_to_game(self.game1.code, 'tim')  # The judge, never evicted
+        clients = {}
+        for name in ['bob', 'ann']:
+            client = clients[name] = WSClient()
+            client.send_and_consume('websocket.connect', path='/game/')
+            while client.receive():
+                pass
+            client.send_and_consume('websocket.receive', path='/game/', text={'stream': 'join_game', 'payload': {'game_code': self.game1.code, 'player_name': name}})
+        while clients['ann'].receive():
+            pass
+        bob = Player.objects.get(name='bob')
+
+        # Heartbeats answer with the interval, and only write last_seen once it has passed
+        clients['ann'].send_and_consume('websocket.receive', path='/game/', text={'stream': 'heartbeat', 'payload': {}})
+        self.assertEqual(30, clients['ann'].receive()['payload']['data']['interval'])
+        with override_settings(PRESENCE_HEARTBEAT_INTERVAL=0):
+            Player.objects.filter(name='ann').update(last_seen=timezone.now() - timedelta(hours=1))
+            clients['ann'].send_and_consume('websocket.receive', path='/game/', text={'stream': 'heartbeat', 'payload': {}})
+            clients['ann'].receive()
+        self.assertGreater(Player.objects.get(name='ann').last_seen, timezone.now() - timedelta(minutes=1))
+
+        # Disconnecting leaves the game's groups and marks the player disconnected
+        layer = clients['bob'].channel_layer
+        self.assertIn(clients['bob'].reply_channel, layer.group_channels('abcd'))
+        clients['bob'].send_and_consume('websocket.disconnect', path='/game/')
+        self.assertNotIn(clients['bob'].reply_channel, layer.group_channels('abcd'))
+        self.assertNotIn(clients['bob'].reply_channel, layer.group_channels('player_{}'.format(bob.pk)))
+        self.assertFalse(Player.objects.get(pk=bob.pk).connected)
+        self.assertEqual([], list(session_for_reply_channel(clients['bob'].reply_channel).keys()))  # Sessions live in the cache, and go with the connection
+
+        # A player who just disconnected survives a pass, in case they come back
+        call_command('evict_absent_players', stdout=StringIO())
+        self.assertTrue(Player.objects.filter(pk=bob.pk).exists())
+
+        # Eviction boots disconnected players once the grace period is over and tells the rest of the game
+        version = Game.objects.get(pk=self.game1.pk).state_version
+        Player.objects.filter(pk=bob.pk).update(last_seen=timezone.now() - timedelta(minutes=5))
+        call_command('evict_absent_players', stdout=StringIO())
+        self.assertFalse(Player.objects.filter(pk=bob.pk).exists())
+        self.assertFalse(CardGamePlayer.objects.filter(player_id=bob.pk).exists())
+        game = Game.objects.get(pk=self.game1.pk)
+        self.assertEqual(version + 1, game.state_version)
+        self.assertEqual(1, game.waiting_player_count)
+        data = clients['ann'].receive()['payload']['data']
+        self.assertEqual(('bob', bob.pk, version + 1), (data['player_name'], data['player_pk'], data['version']))
+
+        # Players who go quiet are evicted too, but never the judge
+        ann = Player.objects.get(name='ann')
+        self.assertEqual(clients['ann'].reply_channel, ann.reply_channel)
+        Player.objects.filter(game=self.game1).update(last_seen=timezone.now() - timedelta(hours=1))
+        evicted = list(evict_absent_players(60))
+        self.assertEqual([('ann', clients['ann'].reply_channel)], [(name, reply_channel) for _, name, reply_channel in evicted[0]['players']])
+        self.assertEqual(version + 2, evicted[0]['version'])
+        self.assertEqual(['tim'], [player.name for player in Player.objects.filter(game=self.game1)])
+
+        # and their still open connection leaves the game's groups and is closed
+        close_evicted_connection(clients['ann'].reply_channel, self.game1.code, ann.pk)
+        self.assertNotIn(clients['ann'].reply_channel, layer.group_channels('abcd'))
+        self.assertNotIn(clients['ann'].reply_channel, layer.group_channels('player_{}'.format(ann.pk)))
+        self.assertEqual([], list(session_for_reply_channel(clients['ann'].reply_channel).keys()))
+        self.assertTrue(self.get_next_message(clients['ann'].reply_channel, require=True).content.get('close'))
+
+    def test_turns_need_joined_game(self):
+        tim = add_player_to_game(self.game1.code, 'tim')
+        bob = add_player_to_game(self.game1.code, 'bob')
+        bobs_card_pk = bob.cardgameplayer_set.filter(status=CardGamePlayer.HAND).first().card_id
+
+        client = WSClient()
+        client.send_and_consume('websocket.connect', path='/game/')  # Connect is forwarded to ALL multiplexed consumers under this demultiplexer
+        while client.receive():
+            pass  # Grab connection success message from each consumer
+
+        # Never joined
+        for stream, payload in (('submit_card', {'card_pk': bobs_card_pk}), ('pick_card', {'card_pk': bobs_card_pk}), ('boot_player', {'player_pk': bob.pk})):
+            client.send_and_consume('websocket.receive', path='/game/', text={'stream': stream, 'payload': dict(payload, game_code=self.game1.code)})  # Text arg is JSON as if it came from browser
+            self.assertEqual(['You have not joined that game.'], client.receive().get('payload').get('data').get('errors').get('game_code'))
+        self.assertTrue(Player.objects.filter(pk=bob.pk))
+
+        # Joined as tim, who can't play bob's cards
+        self.bind_player(client, tim)
+        with CaptureQueriesContext(connection) as queries:
+            client.send_and_consume('websocket.receive', path='/game/', text={'stream': 'submit_card', 'payload': {'game_code': self.game1.code, 'card_pk': bobs_card_pk}})  # Text arg is JSON as if it came from browser
+        self.assertEqual('submit card failed', client.receive().get('payload').get('data').get('error'))
+        self.assertFalse([query for query in queries if 'django_session' in query['sql']])  # The joined ids come from the session, in the cache
+        self.assertEqual(CardGamePlayer.HAND, CardGamePlayer.objects.get(card_id=bobs_card_pk, game=self.game1).status)
+
+    @mock.patch.object(GameDemultiplexer, 'full_state_broadcasts', True)
     def test_whole_game(self):
         client = WSClient()
 
@@ -392,3 +1124,196 @@ class GameConsumerTests(ChannelTestCase):
 
         disconnect_consumer = client.send_and_consume('websocket.disconnect', path='/game/')
         disconnect_consumer.close()
+
+    def test_pick_card_fan_out(self):
+        query_counts = []
+        for player_count in (3, 6):
+            client = WSClient()
+            client.send_and_consume('websocket.connect', path='/game/')  # Connect is forwarded to ALL multiplexed consumers under this demultiplexer
+            while client.receive():
+                pass  # Grab connection success message from each consumer
+
+            game_code = create_game_code()
+            for player_number in range(player_count):
+                player = add_player_to_game(game_code, 'player{}'.format(player_number))
+                Group('player_{}'.format(player.pk)).add(client.reply_channel)  # Listen in on every player's hand
+                if player.status == Player.JUDGE:
+                    self.bind_player(client, player)
+                else:
+                    submitted_card_pk = player.cardgameplayer_set.filter(status=CardGamePlayer.HAND).first().card_id
+                    submit_card(game_code, submitted_card_pk)
+            Group(game_code).add(client.reply_channel)
+
+            with CaptureQueriesContext(connection) as queries:
+                client.send_and_consume('websocket.receive', path='/game/', text={'stream': 'pick_card', 'payload': {'game_code': game_code, 'card_pk': submitted_card_pk}})  # Text arg is JSON as if it came from browser
+            query_counts.append(len(queries))
+
+            self.assertEqual('pick_card', client.receive().get('stream'))
+            new_cards = [client.receive() for _ in range(player_count)]
+            self.assertEqual(['new_cards'] * player_count, [reply.get('stream') for reply in new_cards])
+            self.assertEqual([5] * player_count, [len(reply.get('payload').get('data').get('cards')) for reply in new_cards])
+            self.assertIsNone(client.receive())
+        self.assertEqual(query_counts[0], query_counts[1])
+
+    def test_send_group_many(self):
+        layer = StubRedisChannelLayer(hosts=[('redis1', 6379), ('redis2', 6379)], capacity=2)
+        members = {'player_1': ['daphne.response.a!1'], 'player_2': ['daphne.response.b!2'], 'player_3': ['daphne.response.d!4'], 'abcd': ['daphne.response.a!1', 'daphne.response.b!2', 'daphne.response.c!3']}
+        for group, channels in members.items():
+            layer.connection(layer.consistent_hash(group)).sorted_sets[layer._group_key(group)] = {channel: time.time() for channel in channels}
+
+        def stats(stat_name):
+            return sum(connection.counters[layer.stats_prefix + layer.global_stats_key + ':' + stat_name] for connection in layer._connection_list)
+
+        def received(channel):
+            connection = layer.connection(layer.consistent_hash(channel))
+            return [layer.deserialize(connection.lists[layer.prefix + channel][0])] if connection.lists[layer.prefix + channel] else []
+
+        self.assertEqual([], layer.send_group_many([('player_1', {'text': 'a'}), ('player_2', {'text': 'b'}), ('abcd', {'text': 'c'})]))
+        self.assertEqual([{'text': 'c', '__asgi_channel__': 'daphne.response.c!3'}], received('daphne.response.c!'))
+        self.assertEqual(5, stats(layer.STAT_MESSAGES_COUNT))
+        self.assertLessEqual(sum(connection.round_trips for connection in layer._connection_list), 3 * 2)  # Lookups, deliveries and counters, per shard
+
+        # Full channels are skipped and counted, not counted as sent
+        GROUP_SEND_STATS.clear()
+        with self.assertLogs(LOGGER, logging.WARNING):
+            GroupBatch(channel_layer=layer).send([('abcd', {'text': 'd'})], immediately=True)
+        self.assertEqual({'publishes': 1, 'messages': 1, 'channel_full': 2}, dict(GROUP_SEND_STATS))
+        self.assertEqual((6, 2), (stats(layer.STAT_MESSAGES_COUNT), stats(layer.STAT_CHANNEL_FULL)))
+
+        # Any other error is raised once the rest of the batch has gone out
+        failing = layer.connection(layer.consistent_hash('daphne.response.a!'))
+        failing.errors[layer.prefix + 'daphne.response.a!'] = 'OOM command not allowed when used memory > maxmemory'
+        with self.assertRaises(ResponseError):
+            layer.send_group_many([('player_1', {'text': 'e'}), ('player_3', {'text': 'f'})])
+        self.assertEqual([{'text': 'f', '__asgi_channel__': 'daphne.response.d!4'}], received('daphne.response.d!'))
+        self.assertEqual((7, 2), (stats(layer.STAT_MESSAGES_COUNT), stats(layer.STAT_CHANNEL_FULL)))
+
+    def test_benchmark_group_sends(self):
+        output = StringIO()
+        call_command('benchmark_group_sends', players=[2, 4], repeat=2, stdout=output)
+        self.assertEqual(['2', '4'], [line.split()[0] for line in output.getvalue().splitlines()[2:]])  # The in-memory layer can't batch
+
+    def test_spectate(self):
+        add_player_to_game(self.game1.code, 'tim')
+        spectator = WSClient()
+        spectator.send_and_consume('websocket.connect', path='/game/')
+        spectator.send_and_consume('websocket.receive', path='/game/', text={'stream': 'spectate', 'payload': {'game_code': self.game1.code}})
+        data = spectator.receive()['payload']['data']
+        self.assertEqual(['tim'], [player['name'] for player in data['players']])
+        self.assertNotIn('player_cards', data)
+
+        # Moves only queue a snapshot, and several moves before it is sent make one snapshot of the latest state
+        player = WSClient()
+        player.send_and_consume('websocket.connect', path='/game/')
+        with override_settings(SPECTATOR_SNAPSHOT_INTERVAL=60):
+            for name in ('bob', 'ann'):
+                player.send_and_consume('websocket.receive', path='/game/', text={'stream': 'join_game', 'payload': {'game_code': self.game1.code, 'player_name': name}})
+            self.assertIsNone(spectator.receive())
+            audience.get_throttle().flush()
+            audience.get_throttle().request(self.game1.code)
+            audience.get_throttle().flush()  # Nothing changed, so nothing is sent
+        data = spectator.receive()
+        self.assertEqual('spectate', data['stream'])
+        self.assertEqual(['ann', 'bob', 'tim'], [player['name'] for player in data['payload']['data']['players']])
+        self.assertIsNone(spectator.receive())
+        self.assertEqual(3, Player.objects.filter(game=self.game1).count())  # Spectators aren't players
+
+        # Spectators leave the audience when they disconnect
+        spectator.send_and_consume('websocket.disconnect', path='/game/')
+        self.assertNotIn(spectator.reply_channel, spectator.channel_layer.group_channels(audience.audience_group(self.game1.code)))
+
+    @override_settings(CACHES={alias: {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'shared'} for alias in ('default', 'spectator')})
+    def test_spectate_shared_cache(self):
+        # The spectator's worker and the mover's reach the same cache through connections of their own, as with Redis
+        add_player_to_game(self.game1.code, 'tim')
+        self.assertIsNot(caches['default'], caches['spectator'])
+        spectator = WSClient()
+        spectator.send_and_consume('websocket.connect', path='/game/')
+        with mock.patch.object(audience, 'cache', caches['spectator']):
+            spectator.send_and_consume('websocket.receive', path='/game/', text={'stream': 'spectate', 'payload': {'game_code': self.game1.code}})
+        self.assertEqual(['tim'], [player['name'] for player in spectator.receive()['payload']['data']['players']])
+
+        player = WSClient()
+        player.send_and_consume('websocket.connect', path='/game/')
+        with override_settings(SPECTATOR_SNAPSHOT_INTERVAL=60):
+            player.send_and_consume('websocket.receive', path='/game/', text={'stream': 'join_game', 'payload': {'game_code': self.game1.code, 'player_name': 'bob'}})
+            audience.get_throttle().flush()
+        self.assertEqual(['bob', 'tim'], [player['name'] for player in spectator.receive()['payload']['data']['players']])
+
+    def test_coalesced_broadcasts(self):
+        watcher = WSClient()
+        game_code = create_game_code()
+        players = [add_player_to_game(game_code, name) for name in ('tim', 'bob', 'ann')]
+        Group(game_code).add(watcher.reply_channel)
+        for name in [game_code] + ['player_{}'.format(player.pk) for player in players]:
+            frame_encodings.add_group_encoding(name, 'json')  # As joining over JSON connections would
+        clients = []
+        for player in players[1:]:
+            client = WSClient()
+            client.send_and_consume('websocket.connect', path='/game/')
+            self.bind_player(client, player)
+            clients.append(client)
+
+        GROUP_SEND_STATS.clear()
+        with mock.patch.object(GameDemultiplexer, 'coalesce_window', 60000), mock.patch.object(GameDemultiplexer, 'full_state_broadcasts', True):  # As generate_load's demultiplexer sets them
+            for client, player in zip(clients, players[1:]):
+                card_pk = player.cardgameplayer_set.filter(status=CardGamePlayer.HAND).first().card_id
+                client.send_and_consume('websocket.receive', path='/game/', text={'stream': 'submit_card', 'payload': {'game_code': game_code, 'card_pk': card_pk}})
+            self.assertIsNone(watcher.receive())  # Held for the window
+            self.assertIsNone(get_group_coalescer(channel_layers[DEFAULT_CHANNEL_LAYER]))  # GROUP_SEND_COALESCE_WINDOW stays off
+            get_group_coalescer(channel_layers[DEFAULT_CHANNEL_LAYER], 60000).flush()
+
+        # Both submissions reach the game as one frame with the latest state
+        reply = watcher.receive()
+        self.assertEqual('card_was_submitted', reply['stream'])
+        self.assertEqual(2, len(reply['payload']['data']['submitted_cards']))
+        self.assertTrue(reply['payload']['data']['all_players_submitted'])
+        self.assertIsNone(watcher.receive())
+        self.assertEqual({'publishes': 3, 'messages': 3, 'replaced': 1}, dict(GROUP_SEND_STATS))  # Only JSON is in use, and the in-memory layer can't batch, so publishes one message at a time
+
+    def test_versioned_broadcasts(self):
+        tim = add_player_to_game(self.game1.code, 'tim')
+        bob = add_player_to_game(self.game1.code, 'bob')
+        submitted_card_pk = bob.cardgameplayer_set.filter(status=CardGamePlayer.HAND).first().card_id
+
+        client = WSClient()
+        client.send_and_consume('websocket.connect', path='/game/')  # Connect is forwarded to ALL multiplexed consumers under this demultiplexer
+        while client.receive():
+            pass  # Grab connection success message from each consumer
+        Group(self.game1.code).add(client.reply_channel)
+
+        # Submit only sends what changed
+        self.bind_player(client, bob)
+        client.send_and_consume('websocket.receive', path='/game/', text={'stream': 'submit_card', 'payload': {'game_code': self.game1.code, 'card_pk': submitted_card_pk}})  # Text arg is JSON as if it came from browser
+        data = client.receive().get('payload').get('data')
+        self.assertEqual(3, data.get('version'))
+        self.assertEqual('submitted', data.get('submitting_player').get('status'))
+        self.assertEqual(submitted_card_pk, data.get('card').get('pk'))
+        self.assertTrue(data.get('all_players_submitted'))
+        self.assertNotIn('players', data)
+        self.assertNotIn('submitted_cards', data)
+
+        # Pick only sends the picked player and card
+        self.bind_player(client, tim)
+        client.send_and_consume('websocket.receive', path='/game/', text={'stream': 'pick_card', 'payload': {'game_code': self.game1.code, 'card_pk': submitted_card_pk}})  # Text arg is JSON as if it came from browser
+        data = client.receive().get('payload').get('data')
+        self.assertEqual(4, data.get('version'))
+        self.assertEqual(('bob', 'judge', 1), (data.get('picked_player').get('name'), data.get('picked_player').get('status'), data.get('picked_player').get('score')))
+        self.assertNotIn('players', data)
+
+        # A client that missed a version asks for the full state
+        client.send_and_consume('websocket.receive', path='/game/', text={'stream': 'game_state', 'payload': {'game_code': self.game1.code}})  # Text arg is JSON as if it came from browser
+        data = client.receive().get('payload').get('data')
+        self.assertEqual(4, data.get('version'))
+        self.assertEqual([(bob.pk, 'judge', 1), (tim.pk, 'waiting', 0)], [(player.get('pk'), player.get('status'), player.get('score')) for player in data.get('players')])
+        self.assertEqual([], data.get('submitted_cards'))
+        self.assertEqual('bob', data.get('judge').get('name'))
+        self.assertEqual(sorted(tim.cardgameplayer_set.filter(status=CardGamePlayer.HAND).values_list('card_id', flat=True)), sorted(card.get('pk') for card in data.get('player_cards')))
+
+        # and gets back a hand whose new_cards message it missed
+        self.bind_player(client, bob)
+        client.send_and_consume('websocket.receive', path='/game/', text={'stream': 'game_state', 'payload': {'game_code': self.game1.code}})
+        player_cards = client.receive().get('payload').get('data').get('player_cards')
+        self.assertEqual(5, len(player_cards))
+        self.assertNotIn(submitted_card_pk, [card.get('pk') for card in player_cards])
+        self.assertEqual(sorted(bob.cardgameplayer_set.filter(status=CardGamePlayer.HAND).values_list('card_id', flat=True)), sorted(card.get('pk') for card in player_cards))
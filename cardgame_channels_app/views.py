@@ -1,6 +1,9 @@
 import logging
 
-from django.views.generic import TemplateView
+from django.http import HttpResponse
+from django.views.generic import TemplateView, View
+
+from cardgame_channels_app import stream_metrics
 
 LOGGER = logging.getLogger("cardgame_channels_app")
 
@@ -9,3 +12,10 @@ class HomePage(TemplateView):
     """Display Home Page"""
     template_name = 'cardgame/home.html'
 
+
+class StreamMetrics(View):
+    """Serve per-stream metrics for Prometheus to scrape"""
+
+    def get(self, request):
+        """Renders every worker's counters in the Prometheus text format"""
+        return HttpResponse(stream_metrics.render_prometheus(), content_type='text/plain; version=0.0.4')
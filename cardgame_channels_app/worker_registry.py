@@ -0,0 +1,57 @@
+"""Registry of live worker processes in the cache, built on cache.add so that workers registering at once never lose each other
+
+Each worker holds one of a fixed number of numbered slots. A free slot can only be claimed with cache.add, which one
+process wins, and is renewed by its holder well before it expires, so it is never free while its worker is alive.
+Listing the workers reads every slot in one get_many.
+"""
+import logging
+import threading
+
+from django.core.cache import cache
+
+LOGGER = logging.getLogger("cardgame_channels_app")
+
+
+class WorkerRegistry(object):
+    """Names of the workers registered under a prefix, each in a slot of its own that expires unless renewed"""
+
+    def __init__(self, prefix, slots=64):
+        self.prefix = prefix
+        self.slots = slots
+        self.claimed = {}  # name: slot this process holds for it
+        self.lock = threading.Lock()
+
+    def names(self):
+        """Returns the registered workers' names, in slot order"""
+        keys = self._keys()
+        values = cache.get_many(keys)
+        return list(dict.fromkeys(values[key] for key in keys if key in values))
+
+    def register(self, name, timeout):
+        """Adds the worker for timeout seconds, or renews it, returning False if every slot is taken"""
+        with self.lock:
+            slot = self.claimed.get(name)
+            if slot is not None and cache.get(self._key(slot)) == name:
+                cache.set(self._key(slot), name, timeout)
+                return True
+            keys = self._keys()
+            taken = cache.get_many(keys)
+            for slot, key in enumerate(keys):
+                if key not in taken and cache.add(key, name, timeout):
+                    self.claimed[name] = slot
+                    return True
+        LOGGER.warning('All %s %s slots are taken, %s is not registered', self.slots, self.prefix, name)
+        return False
+
+    def unregister(self, name):
+        """Takes the worker out of the registry"""
+        with self.lock:
+            slot = self.claimed.pop(name, None)
+            if slot is not None and cache.get(self._key(slot)) == name:
+                cache.delete(self._key(slot))
+
+    def _key(self, slot):
+        return '{}:slot:{}'.format(self.prefix, slot)
+
+    def _keys(self):
+        return [self._key(slot) for slot in range(self.slots)]
@@ -1,5 +1,6 @@
 #!/usr/bin/env bash
 docker-compose run interfaceserver python manage.py migrate --noinput
 docker-compose run interfaceserver python manage.py loaddata initial
+docker-compose run interfaceserver python manage.py game_code_pool --fill
 docker-compose run interfaceserver python manage.py collectstatic --noinput
 docker-compose run interfaceserver python manage.py createsuperuser
\ No newline at end of file